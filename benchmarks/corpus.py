@@ -0,0 +1,224 @@
+"""
+Synthetic message corpus for the benchmarks.
+
+    python -m benchmarks.corpus <output dir> [--count N]
+
+writes the corpus to disk as .eml files, so it can also be fed to email-decode.py.
+"""
+import argparse
+import base64
+import os
+import os.path
+import quopri
+import random
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip'
+).split()
+
+NAMES = ['Alice Example', 'Bob Jones', 'Carol Smith', 'Dave Brown', 'Eve Black', 'Frank White']
+
+
+def _address(rnd, i=None):
+    name = rnd.choice(NAMES)
+    local = name.split()[0].lower() + (str(i) if i is not None else '')
+    return '"%s" <%s@%s>' % (name, local, rnd.choice(['example.com', 'example.org', 'example.net']))
+
+
+def _text(rnd, words):
+    lines = []
+    line = []
+    for i in xrange(words):
+        line.append(rnd.choice(WORDS))
+        if len(line) == 12:
+            lines.append(' '.join(line))
+            line = []
+    lines.append(' '.join(line))
+    return '\r\n'.join(lines)
+
+
+def _html(rnd, paragraphs):
+    return '<html><body>' + ''.join('<p>%s</p>\r\n' % _text(rnd, 40) for i in xrange(paragraphs)) + '</body></html>'
+
+
+def _random_bytes(rnd, size):
+    return ''.join(chr(rnd.getrandbits(8)) for _ in xrange(size))
+
+
+def _base64(data):
+    return base64.encodestring(data).replace('\n', '\r\n')
+
+
+def _headers(rnd, n, extra=()):
+    headers = [
+        'Received: from mx%d.example.com (mx%d.example.com [10.0.0.%d]) by mail.example.com; '
+        'Tue, 3 Oct 2017 12:%02d:14 +0000' % (i, i, i, i % 60)
+        for i in xrange(3)
+    ]
+    headers += [
+        'From: %s' % _address(rnd),
+        'To: %s' % ', '.join(_address(rnd, i) for i in xrange(3)),
+        'Cc: %s' % _address(rnd),
+        'Subject: %s' % _text(rnd, 8),
+        'Date: Tue, 3 Oct 2017 14:%02d:12 +0200' % (n % 60),
+        'Message-ID: <msg%d@example.com>' % n,
+        'References: <root%d@example.com> <prev%d@example.com>' % (n, n),
+        'MIME-Version: 1.0',
+    ]
+    headers.extend(extra)
+    return '\r\n'.join(headers) + '\r\n'
+
+
+def plain(rnd, n):
+    return (_headers(rnd, n, ['Content-Type: text/plain; charset=utf-8']) + '\r\n' + _text(rnd, 300))
+
+
+def alternative(rnd, n):
+    return (
+        _headers(rnd, n, ['Content-Type: multipart/alternative; boundary="alt"']) + '\r\n'
+        '--alt\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' + _text(rnd, 300) + '\r\n'
+        '--alt\r\nContent-Type: text/html; charset=utf-8\r\n\r\n' + _html(rnd, 8) + '\r\n'
+        '--alt--\r\n'
+    )
+
+
+def nested(rnd, n, depth=25):
+    body = 'Content-Type: text/plain; charset=utf-8\r\n\r\n' + _text(rnd, 50) + '\r\n'
+    for level in xrange(depth):
+        boundary = 'level%d' % level
+        body = (
+            'Content-Type: multipart/mixed; boundary="%s"\r\n\r\n' % boundary +
+            '--%s\r\n' % boundary + body +
+            '--%s\r\nContent-Type: text/plain\r\n\r\n%s\r\n' % (boundary, _text(rnd, 10)) +
+            '--%s--\r\n' % boundary
+        )
+    return _headers(rnd, n) + body
+
+
+def many_attachments(rnd, n, count=100):
+    parts = ['--mix\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' + _text(rnd, 50) + '\r\n']
+    for i in xrange(count):
+        data = _random_bytes(rnd, 2048)
+        parts.append(
+            '--mix\r\nContent-Type: image/png; name="img%d.png"\r\n'
+            'Content-Disposition: attachment; filename="img%d.png"\r\n'
+            'Content-Transfer-Encoding: base64\r\n\r\n%s' % (i, i, _base64(data))
+        )
+    return (
+        _headers(rnd, n, ['Content-Type: multipart/mixed; boundary="mix"']) + '\r\n' +
+        ''.join(parts) + '--mix--\r\n'
+    )
+
+
+def huge_attachment(rnd, n, size=10 * 1024 * 1024):
+    block = _random_bytes(rnd, 64 * 1024)
+    data = block * (size // len(block))
+    return (
+        _headers(rnd, n, ['Content-Type: multipart/mixed; boundary="mix"']) + '\r\n'
+        '--mix\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' + _text(rnd, 50) + '\r\n'
+        '--mix\r\nContent-Type: application/pdf; name="scan.pdf"\r\n'
+        'Content-Disposition: attachment; filename="scan.pdf"\r\n'
+        'Content-Transfer-Encoding: base64\r\n\r\n' + _base64(data) +
+        '--mix--\r\n'
+    )
+
+
+def newsletter(rnd, n, paragraphs=2000):
+    # A large HTML body with a quoted-printable Latin-1 text alternative
+    text = _text(rnd, 3000).replace('dolor', 'd\xf4l\xf6r')
+    qp = quopri.encodestring(text.replace('\r\n', '\n')).replace('\n', '\r\n')
+    return (
+        _headers(rnd, n, ['Content-Type: multipart/alternative; boundary="alt"']) + '\r\n'
+        '--alt\r\nContent-Type: text/plain; charset=iso-8859-1\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n' + qp + '\r\n'
+        '--alt\r\nContent-Type: text/html; charset=utf-8\r\n\r\n' + _html(rnd, paragraphs) + '\r\n'
+        '--alt--\r\n'
+    )
+
+
+def html_only(rnd, n, rows=4000):
+    # A marketing message: only a (quoted-printable) HTML body, a table layout with inline styles,
+    # tracking links and a hidden preheader
+    row = (
+        '<tr><td class="content" style="padding:0 24px;font-family:Arial,sans-serif;font-size:14px" align="left">'
+        '<a href="https://click.example.com/track?id=%d&amp;u=%x"><img src="https://img.example.com/%d.png" alt="" width="600"></a>'
+        '<span style="color:#333333">%s&nbsp;&mdash; %s</span></td></tr>\r\n'
+    )
+    html = (
+        '<html><head><style>td { color: #333333; }</style></head><body>'
+        '<div style="display:none;max-height:0">%s</div><table width="100%%" cellpadding="0">' % _text(rnd, 12) +
+        ''.join(row % (i, rnd.getrandbits(32), i, _text(rnd, 12), _text(rnd, 8)) for i in xrange(rows)) +
+        '</table></body></html>'
+    )
+    qp = quopri.encodestring(html.replace('\r\n', '\n')).replace('\n', '\r\n')
+    return (
+        _headers(rnd, n, ['Content-Type: text/html; charset=utf-8', 'Content-Transfer-Encoding: quoted-printable']) + '\r\n' + qp
+    )
+
+
+def header_heavy(rnd, n, count=200):
+    extra = []
+    for i in xrange(count):
+        kind = i % 4
+        if kind == 0:
+            extra.append(
+                'Received: from relay%d.example.net (relay%d.example.net [192.0.2.%d])\r\n'
+                '\tby relay%d.example.net with ESMTPS id %x; Tue, 3 Oct 2017 12:%02d:%02d +0000'
+                % (i, i, i % 255, i + 1, rnd.getrandbits(48), i % 60, i % 60)
+            )
+        elif kind == 1:
+            extra.append(
+                'DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com; s=sel%d;\r\n'
+                '\th=from:to:subject:date; bh=%s;\r\n\tb=%s' % (i, _base64(_random_bytes(rnd, 32)).strip(), _base64(_random_bytes(rnd, 96)).replace('\r\n', ''))
+            )
+        elif kind == 2:
+            extra.append('ARC-Authentication-Results: i=%d; mx.example.com; spf=pass smtp.mailfrom=example.com' % i)
+        else:
+            extra.append('X-Header-%d: %s' % (i, _text(rnd, 6)))
+    extra.append('Content-Type: text/plain; charset=utf-8')
+    return _headers(rnd, n, extra) + '\r\n' + _text(rnd, 50)
+
+
+KINDS = [
+    ('plain', plain),
+    ('alternative', alternative),
+    ('nested', nested),
+    ('many_attachments', many_attachments),
+    ('huge_attachment', huge_attachment),
+    ('header_heavy', header_heavy),
+    ('newsletter', newsletter),
+    ('html_only', html_only),
+]
+
+
+def generate(kind, count, seed=0):
+    """
+    Generate synthetic raw messages.
+
+    :param str kind: One of the names in KINDS
+    :param int count: How many messages to generate
+    :param int seed: Seed for the random generator, so corpora are reproducible
+    :return list[str]
+    """
+    rnd = random.Random(seed)
+    generator = dict(KINDS)[kind]
+    return [generator(rnd, n) for n in xrange(count)]
+
+
+def write_corpus(directory, count, seed=0):
+    for kind, _ in KINDS:
+        kind_dir = os.path.join(directory, kind)
+        if not os.path.isdir(kind_dir):
+            os.makedirs(kind_dir)
+        for n, raw in enumerate(generate(kind, count, seed)):
+            with open(os.path.join(kind_dir, '%05d.eml' % n), 'wb') as f:
+                f.write(raw)
+
+
+if __name__ == '__main__':
+    opt_parser = argparse.ArgumentParser(description='Writes the synthetic benchmark corpus to disk')
+    opt_parser.add_argument('directory', type=str, help='Where to write the corpus')
+    opt_parser.add_argument('--count', dest='count', type=int, help='Messages per kind', default=10)
+    opt_parser.add_argument('--seed', dest='seed', type=int, help='Random seed', default=0)
+    args = opt_parser.parse_args()
+    write_corpus(args.directory, args.count, args.seed)
@@ -0,0 +1,177 @@
+"""
+Measures how long starting up takes: importing the modules, and running email-decode.py on
+one message (in process, and through a decoder daemon when one is given).
+
+    python -m benchmarks.imports [--runs N] [--modules ...] [--daemon SOCKET] [--out results.json]
+
+Every measurement is taken in a fresh interpreter, since a module is only imported once per
+process. For each module the slowest imports it triggers are listed too, with their own time
+(excluding what they import in turn) and their cumulative time, so it can be seen which
+dependencies make up the total. Results are written as JSON like benchmarks.run writes them.
+"""
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import corpus
+
+MODULES = [
+    'email_decoder.framing',
+    'email_decoder.daemon',
+    'email_decoder.parser',
+    'email_decoder.output',
+    'email_decoder.batch',
+    'email_decoder.search',
+    'email_decoder.server',
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'email-decode.py')
+
+# Run in a fresh interpreter: times the import of sys.argv[1] and every import it triggers, and
+# prints the result as JSON
+_PROBE = r'''
+import sys, time, json, __builtin__
+_import = __builtin__.__import__
+_stack = []
+_times = {}
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    loaded = name in sys.modules
+    start = time.time()
+    _stack.append(0.0)
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        children = _stack.pop()
+        elapsed = time.time() - start
+        if _stack:
+            _stack[-1] += elapsed
+        if not loaded and name in sys.modules:
+            _times[name] = (elapsed, elapsed - children)
+
+__builtin__.__import__ = _timed_import
+start = time.time()
+_import(sys.argv[1])
+total = time.time() - start
+__builtin__.__import__ = _import
+print(json.dumps({"total": total, "imports": _times}))
+'''
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return env
+
+
+def measure_import(module, runs=5, top=10):
+    """
+    :param str module: Module to import
+    :param int runs: Fresh interpreters to import it in
+    :param int top: How many of the slowest imports it triggers to list
+    :return dict
+    """
+    totals = []
+    imports = {}
+    for _ in xrange(runs):
+        output = subprocess.check_output([sys.executable, '-c', _PROBE, module], env=_environment())
+        probe = json.loads(output)
+        totals.append(probe['total'])
+        for name, times in probe['imports'].items():
+            imports.setdefault(name, []).append(times)
+
+    slowest = sorted(imports.items(), key=lambda item: -median([cumulative for cumulative, _ in item[1]]))[:top]
+    return {
+        "median_ms": median(totals) * 1000,
+        "min_ms": min(totals) * 1000,
+        "modules_imported": len(imports),
+        "slowest": [{
+            "module": name,
+            "cumulative_ms": median([cumulative for cumulative, _ in times]) * 1000,
+            "self_ms": median([own for _, own in times]) * 1000,
+        } for name, times in slowest],
+    }
+
+
+def measure_command(args, runs=5):
+    """
+    :param list[str] args: Command line to run
+    :param int runs: How many times to run it
+    :return dict Wall time of the runs
+    """
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in xrange(runs):
+            start = time.time()
+            status = subprocess.call(args, stdout=devnull, stderr=devnull, env=_environment())
+            times.append(time.time() - start)
+            if status != 0:
+                return {"error": "exit status %d" % status}
+    return {"median_ms": median(times) * 1000, "min_ms": min(times) * 1000}
+
+
+def run_benchmarks(modules, runs=5, top=10, daemon=None, fmt='json'):
+    results = {"imports": {}, "commands": {}}
+    for module in modules:
+        results["imports"][module] = measure_import(module, runs, top)
+
+    directory = tempfile.mkdtemp()
+    try:
+        sample = os.path.join(directory, 'sample.eml')
+        with open(sample, 'wb') as f:
+            f.write(corpus.generate('alternative', 1)[0])
+
+        results["commands"]["python"] = measure_command([sys.executable, '-c', 'pass'], runs)
+        results["commands"]["email-decode.py"] = measure_command([sys.executable, SCRIPT, '--format', fmt, sample], runs)
+        if daemon:
+            results["commands"]["email-decode.py --daemon"] = measure_command(
+                [sys.executable, SCRIPT, '--daemon', daemon, '--format', fmt, sample], runs)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main(argv=None):
+    opt_parser = argparse.ArgumentParser(description='Measures import and startup times')
+    opt_parser.add_argument('--runs', dest='runs', type=int, help='Fresh interpreters per measurement', default=5)
+    opt_parser.add_argument('--top', dest='top', type=int, help='Slowest imports to list per module', default=10)
+    opt_parser.add_argument('--modules', dest='modules', type=str, help='Comma-separated modules to import', default=','.join(MODULES))
+    opt_parser.add_argument('--format', dest='format', type=str, help='Output format for the email-decode.py runs', default='json')
+    opt_parser.add_argument('--daemon', dest='daemon', type=str, help='Also time email-decode.py --daemon against the daemon on this socket', default=None)
+    opt_parser.add_argument('--out', dest='out', type=str, help='Write the JSON results to this file instead of stdout', default=None)
+    args = opt_parser.parse_args(argv)
+
+    results = run_benchmarks(args.modules.split(','), args.runs, args.top, args.daemon, args.format)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "runs": args.runs,
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
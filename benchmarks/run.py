@@ -0,0 +1,277 @@
+"""
+Benchmarks the parser and serializers stage by stage over the synthetic corpus.
+
+    python -m benchmarks.run [--count N] [--kinds plain,nested] [--stages ...] [--out results.json]
+
+Every (corpus kind, stage) pair runs in its own forked process so peak memory can be attributed
+to it. The retained_messages stage measures how much memory each parsed Message takes while it
+is kept around. Results are written as JSON so runs can be compared across versions.
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+from flanker import mime
+from email_decoder.parser import Parser
+from email_decoder.parser import ParserState
+from email_decoder.parser import headers_from_mimepart
+from email_decoder.output import message_to_json
+from email_decoder.output import message_to_msgpack
+from email_decoder.columnar import ColumnarWriter
+from email_decoder.scanner import scan_parts
+from email_decoder.search import document_terms
+from email_decoder.htmltext import html_to_text
+from benchmarks import corpus
+
+
+class NullLogger(object):
+    """
+    Swallows the parser's log output so it doesn't skew the timings.
+    """
+    def _log(self, *args, **kwargs):
+        pass
+
+    debug = info = warning = error = _log
+
+
+def _message(parser, raw):
+    return parser.message_from_mimepart(mime.from_string(raw))
+
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+# Chunks are written (and packed) every 100 messages, like a real export would
+_columnar_writer = ColumnarWriter(NullFile(), chunk_rows=100)
+
+# Compared with the default (flanker) engine of the parser every stage gets
+_scanner_parser = Parser(logger=NullLogger(), engine='scanner')
+
+# Compared with the default parser, which leaves body_text empty for messages with only HTML
+_html_text_parser = Parser(logger=NullLogger(), html_text='full')
+
+
+# Each stage is (setup, run): setup(parser, raw) prepares the input outside of the timed
+# region, run(parser, prepared) is what gets timed.
+STAGES = [
+    ('mime.from_string', (
+        lambda parser, raw: raw,
+        lambda parser, raw: mime.from_string(raw))),
+    ('scanner.scan_parts', (
+        lambda parser, raw: raw,
+        lambda parser, raw: scan_parts(raw))),
+    ('Parser.message_from_bytes', (
+        lambda parser, raw: raw,
+        lambda parser, raw: parser.message_from_bytes(raw))),
+    ('Parser.message_from_bytes[scanner]', (
+        lambda parser, raw: raw,
+        lambda parser, raw: _scanner_parser.message_from_bytes(raw))),
+    ('Parser.message_from_bytes[html_text]', (
+        lambda parser, raw: raw,
+        lambda parser, raw: _html_text_parser.message_from_bytes(raw))),
+    ('Parser.message_from_mimepart', (
+        lambda parser, raw: mime.from_string(raw),
+        lambda parser, mimepart: parser.message_from_mimepart(mimepart))),
+    ('Parser.parsed_headers_from_raw_headers', (
+        lambda parser, raw: headers_from_mimepart(mime.from_string(raw)),
+        lambda parser, raw_headers: parser.parsed_headers_from_raw_headers(raw_headers))),
+    ('Parser._walk_parts', (
+        lambda parser, raw: mime.from_string(raw),
+        lambda parser, mimepart: parser._walk_parts(ParserState(), mimepart))),
+    ('message_to_json', (
+        _message,
+        lambda parser, msg: message_to_json(msg))),
+    ('message_to_msgpack', (
+        _message,
+        lambda parser, msg: message_to_msgpack(msg))),
+    ('ColumnarWriter.add', (
+        _message,
+        lambda parser, msg: _columnar_writer.add(msg))),
+    ('htmltext.html_to_text', (
+        lambda parser, raw: _message(parser, raw).body_html or '',
+        lambda parser, html: html_to_text(html))),
+    ('search.document_terms', (
+        _message,
+        lambda parser, msg: document_terms(msg))),
+]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(raws, stage, iterations=1):
+    """
+    Run a single stage over the messages and collect timings.
+
+    :param list[str] raws: Raw messages
+    :param str stage: Name of the stage (see STAGES)
+    :param int iterations: How many times to go over the messages
+    :return dict
+    """
+    setup, run = dict(STAGES)[stage]
+    parser = Parser(logger=NullLogger())
+
+    latencies = []
+    total_bytes = 0
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for _ in xrange(iterations):
+        prepared = [setup(parser, raw) for raw in raws]
+        for raw, arg in zip(raws, prepared):
+            start = time.time()
+            run(parser, arg)
+            latencies.append(time.time() - start)
+            total_bytes += len(raw)
+        del prepared
+
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = sum(latencies)
+    latencies.sort()
+
+    return {
+        "stage": stage,
+        "messages": len(latencies),
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "messages_per_sec": len(latencies) / seconds if seconds else None,
+        "mb_per_sec": total_bytes / 1048576.0 / seconds if seconds else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_kb": peak_after,
+        "peak_rss_growth_kb": max(0, peak_after - peak_before),
+    }
+
+
+def _current_rss_kb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def measure_retained(raws, copies=20):
+    """
+    Measure how much memory parsed messages take while they are kept around (e.g. for threading).
+    Only works where /proc/self/statm exists (Linux).
+
+    :param list[str] raws: Raw messages
+    :param int copies: How many times each message is parsed and kept
+    :return dict
+    """
+    parser = Parser(logger=NullLogger())
+    for raw in raws:
+        parser.message_from_mimepart(mime.from_string(raw))
+    gc.collect()
+
+    before = _current_rss_kb()
+    kept = []
+    for _ in xrange(copies):
+        for raw in raws:
+            kept.append(parser.message_from_mimepart(mime.from_string(raw)))
+    gc.collect()
+    after = _current_rss_kb()
+
+    return {
+        "stage": "retained_messages",
+        "messages": len(kept),
+        "rss_growth_kb": after - before,
+        "kb_per_message": (after - before) / float(len(kept)),
+    }
+
+
+def _measure_in_child(queue, raws, stage, iterations):
+    try:
+        if stage == 'retained_messages':
+            queue.put(measure_retained(raws))
+        else:
+            queue.put(measure(raws, stage, iterations))
+    except Exception as e:
+        queue.put({"stage": stage, "error": "%s: %s" % (type(e).__name__, e)})
+
+
+def run_benchmarks(kinds, stages, count=20, iterations=1, seed=0, isolate=True):
+    """
+    :param list[str] kinds: Corpus kinds to run (see benchmarks.corpus.KINDS)
+    :param list[str] stages: Stages to run (see STAGES)
+    :param int count: Messages per corpus kind
+    :param int iterations: How many times each stage goes over the messages
+    :param int seed: Corpus seed
+    :param bool isolate: Run every measurement in a forked process, so peak memory is per stage
+    :return list[dict]
+    """
+    results = []
+    for kind in kinds:
+        raws = corpus.generate(kind, count, seed)
+        for stage in stages:
+            if isolate:
+                queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(target=_measure_in_child, args=(queue, raws, stage, iterations))
+                proc.start()
+                result = queue.get()
+                proc.join()
+            elif stage == 'retained_messages':
+                result = measure_retained(raws)
+            else:
+                result = measure(raws, stage, iterations)
+            result["kind"] = kind
+            results.append(result)
+            sys.stderr.write("%-18s %-40s %s\n" % (kind, stage, _summary(result)))
+    return results
+
+
+def _summary(result):
+    if 'error' in result:
+        return result['error']
+    if 'kb_per_message' in result:
+        return "%8.1f kB per retained message" % result['kb_per_message']
+    return "%8.1f msg/s %8.2f MB/s  p50 %8.2fms  p99 %8.2fms  peak +%dkB" % (
+        result['messages_per_sec'] or 0, result['mb_per_sec'] or 0, result['p50_ms'], result['p99_ms'],
+        result['peak_rss_growth_kb'])
+
+
+def main(argv=None):
+    kind_names = [k for k, _ in corpus.KINDS]
+    stage_names = [s for s, _ in STAGES] + ['retained_messages']
+
+    opt_parser = argparse.ArgumentParser(description='Benchmarks the parser and serializers')
+    opt_parser.add_argument('--count', dest='count', type=int, help='Messages per corpus kind', default=20)
+    opt_parser.add_argument('--iterations', dest='iterations', type=int, help='Passes over the messages per stage', default=1)
+    opt_parser.add_argument('--seed', dest='seed', type=int, help='Corpus seed', default=0)
+    opt_parser.add_argument('--kinds', dest='kinds', type=str, help='Comma-separated corpus kinds: ' + ','.join(kind_names), default=','.join(kind_names))
+    opt_parser.add_argument('--stages', dest='stages', type=str, help='Comma-separated stages: ' + ','.join(stage_names), default=','.join(stage_names))
+    opt_parser.add_argument('--no-isolate', dest='isolate', action='store_false', help='Run everything in this process (peak memory is then cumulative)')
+    opt_parser.add_argument('--out', dest='out', type=str, help='Write the JSON results to this file instead of stdout', default=None)
+    args = opt_parser.parse_args(argv)
+
+    results = run_benchmarks(args.kinds.split(','), args.stages.split(','), args.count, args.iterations, args.seed, args.isolate)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "count": args.count,
+        "iterations": args.iterations,
+        "seed": args.seed,
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
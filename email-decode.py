@@ -1,37 +1,165 @@
-import logging
 import sys
 import os.path
 import argparse
-from flanker import mime
-from email_decoder.parser import Parser
-from email_decoder.output import message_to_json
-from email_decoder.output import message_to_msgpack
-from email_decoder.output import message_to_debug_out
 
+# Only the standard library is imported up front; each mode imports what it needs once the
+# arguments are parsed (importing flanker alone takes a few hundred milliseconds, which the
+# --daemon client and --search never need)
 opt_parser = argparse.ArgumentParser(description='Reads a raw email file and outputs a structured version in various formats')
-opt_parser.add_argument('file', metavar='file', type=str, help='Path to an email file to parse')
-opt_parser.add_argument('--format', dest="format", type=str, help='The output format: json, msgpack, debug', default="debug")
+opt_parser.add_argument('file', metavar='file', type=str, nargs='*', help='Path to an email file to parse. In batch mode: files, directories or glob patterns')
+opt_parser.add_argument('--format', dest="format", type=str, help='The output format: json, msgpack, debug. Batch mode also supports columnar (see email_decoder.columnar)', default="debug")
+opt_parser.add_argument('--batch', dest="batch", action='store_true', help='Decode many files, writing NDJSON (json) or length-prefixed msgpack records to stdout')
+opt_parser.add_argument('--stdin', dest="stdin", action='store_true', help='Batch mode: read a newline-delimited list of paths from stdin')
+opt_parser.add_argument('--workers', dest="workers", type=int, help='Batch and spool mode: number of worker processes (default: CPU count)', default=None)
+opt_parser.add_argument('--chunksize', dest="chunksize", type=int, help='Batch mode: number of files handed to a worker at a time', default=16)
+opt_parser.add_argument('--chunk-rows', dest="chunk_rows", type=int, help='Columnar format: messages per chunk', default=1000)
+opt_parser.add_argument('--compact', dest="compact", action='store_true', help='Write JSON without any whitespace')
+opt_parser.add_argument('--headers-only', dest="headers_only", action='store_true', help='Only parse the header block; body parts are not read or decoded')
+opt_parser.add_argument('--thread-index', dest="thread_index", type=str, help='Add messages to the thread index (SQLite) at this path. In batch mode each record gets a thread_id', default=None)
+opt_parser.add_argument('--result-cache', dest="result_cache", type=str, help='Keep parse results in a cache (SQLite) at this path and reuse them for messages seen before', default=None)
+opt_parser.add_argument('--result-cache-size', dest="result_cache_size", type=int, help='Maximum size of the result cache in MB', default=1024)
+opt_parser.add_argument('--spool', dest="spool", type=str, help='Coordinated mode: decode the messages in this spool directory together with every other worker (on any host) running on it', default=None)
+opt_parser.add_argument('--out-dir', dest="out_dir", type=str, help='Spool mode: directory each worker writes its output file to', default=None)
+opt_parser.add_argument('--lease-seconds', dest="lease_seconds", type=int, help='Spool mode: messages leased by a worker that has not renewed its lease for this long are taken over', default=600)
+opt_parser.add_argument('--claim-size', dest="claim_size", type=int, help='Spool mode: number of messages a worker claims at a time', default=16)
+opt_parser.add_argument('--engine', dest="engine", choices=('flanker', 'scanner'), help='How the parts of a message are found: flanker, or scanner (faster on large messages; falls back to flanker for anything it does not handle)', default='flanker')
+opt_parser.add_argument('--search-index', dest="search_index", type=str, help='Add messages to the search index in this directory (see email_decoder.search), with their path as key', default=None)
+opt_parser.add_argument('--search', dest="search", type=str, help='Search the index given with --search-index and print the key and date of each match, e.g. \'from:@example.com "quarterly report" after:2017-10-01\'', default=None)
+opt_parser.add_argument('--limit', dest="limit", type=int, help='Search: print at most this many matches, newest first', default=None)
+opt_parser.add_argument('--html-text', dest="html_text", choices=('full', 'reply'), help='When a message has an HTML body but no text body, extract the text from the HTML: all of it (full), or without quoted replies and signatures (reply)', default=None)
+opt_parser.add_argument('--daemon', dest="daemon", type=str, help='Have the decoder daemon listening on this Unix socket decode the file (see email_decoder.daemon); decodes it here if the daemon is not running', default=None)
 args = opt_parser.parse_args()
 
+if args.search:
+    from datetime import datetime
+    from email_decoder.search import Searcher
+
+    if not args.search_index or not os.path.isdir(args.search_index):
+        print("Searching requires an existing --search-index")
+        sys.exit(1)
+    try:
+        hits = Searcher(args.search_index).search(args.search, limit=args.limit, newest_first=args.limit is not None)
+    except ValueError as e:
+        print("Invalid query: %s" % e)
+        sys.exit(1)
+    for hit in hits:
+        print("%s\t%s" % (hit["key"], datetime.utcfromtimestamp(hit["date"]).isoformat(' ') if hit["date"] is not None else ''))
+    sys.stderr.write("%d matches\n" % len(hits))
+    sys.exit(0)
+
+if args.daemon:
+    if args.batch or args.stdin or args.spool or len(args.file) != 1:
+        print("--daemon decodes a single file")
+        sys.exit(1)
+    if args.format not in ('json', 'msgpack', 'debug'):
+        print("--daemon requires --format json, msgpack or debug")
+        sys.exit(1)
+    if args.thread_index or args.search_index or args.result_cache or args.html_text:
+        # The daemon's own settings apply (see python -m email_decoder.daemon serve --help)
+        print("--daemon does not support --thread-index, --search-index, --result-cache or --html-text")
+        sys.exit(1)
+    if not os.path.isfile(args.file[0]):
+        print("The file specified does not exist")
+        sys.exit(1)
+
+    import socket
+    from email_decoder.daemon import decode_via_daemon
+    from email_decoder.daemon import DaemonError
+    try:
+        output, errors, status = decode_via_daemon(args.daemon, args.file[0], fmt=args.format, compact=args.compact, headers_only=args.headers_only)
+    except (socket.error, DaemonError) as e:
+        sys.stderr.write("Decoder daemon unavailable (%s), decoding here\n" % e)
+    else:
+        sys.stdout.write(output)
+        sys.stderr.write(errors)
+        sys.exit(status)
+
+result_cache = None
+if args.result_cache:
+    from email_decoder.resultcache import ResultCache
+    result_cache = ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+
+if args.spool:
+    from email_decoder.spool import run_spool
+    from email_decoder.spool import Spool
+
+    if args.format not in ('json', 'msgpack', 'columnar'):
+        print("Spool mode requires --format json, msgpack or columnar")
+        sys.exit(1)
+    if not args.out_dir:
+        print("Spool mode requires --out-dir")
+        sys.exit(1)
+    if not os.path.isdir(args.spool):
+        print("The spool directory does not exist")
+        sys.exit(1)
+    if args.thread_index:
+        # Workers on other hosts couldn't share it
+        print("Spool mode does not support --thread-index")
+        sys.exit(1)
+    if args.search_index:
+        print("Spool mode does not support --search-index")
+        sys.exit(1)
+
+    total, failed = run_spool(args.spool, args.out_dir, fmt=args.format, workers=args.workers, claim_size=args.claim_size, headers_only=args.headers_only,
+                              lease_seconds=args.lease_seconds, result_cache=result_cache, engine=args.engine, html_text=args.html_text)
+    sys.stderr.write("Decoded %d files, %d failed\n" % (total - failed, failed))
+    sys.stderr.write("Spool: %(done)d done, %(leased)d leased, %(pending)d not done\n" % Spool(args.spool).progress())
+    sys.exit(1 if failed else 0)
+
+if args.batch or args.stdin or len(args.file) > 1 or args.format == 'columnar':
+    from email_decoder.batch import iter_paths
+    from email_decoder.batch import run_batch
+
+    if args.format not in ('json', 'msgpack', 'columnar'):
+        print("Batch mode requires --format json, msgpack or columnar")
+        sys.exit(1)
+
+    paths = iter_paths(args.file, read_stdin=args.stdin)
+    stats = {}
+    total, failed = run_batch(paths, sys.stdout, fmt=args.format, workers=args.workers, chunksize=args.chunksize, headers_only=args.headers_only, thread_index=args.thread_index, chunk_rows=args.chunk_rows,
+                              result_cache=result_cache, stats=stats, engine=args.engine, search_index=args.search_index,
+                              html_text=args.html_text)
+    sys.stderr.write("Decoded %d files, %d failed\n" % (total - failed, failed))
+    if result_cache is not None:
+        sys.stderr.write("Result cache: %d of %d files (%.1f%%)\n" % (stats["result_cache_hits"], total, 100.0 * stats["result_cache_hits"] / total if total else 0))
+    sys.exit(1 if failed else 0)
+
 if not args.file:
     print("An argument is required (the name of the file)")
     sys.exit(1)
 
-file_path = args.file
+file_path = args.file[0]
 if not os.path.isfile(file_path):
     print("The file specified does not exist")
     sys.exit(1)
 
-with open(file_path, 'r') as f:
-    file_contents = f.read()
+from email_decoder.parser import Parser
+from email_decoder.limits import Limits
+from email_decoder.output import message_to_json
+from email_decoder.output import message_to_msgpack
+from email_decoder.output import message_to_debug_out
+
+parser = Parser(limits=Limits(), result_cache=result_cache, engine=args.engine, html_text=args.html_text)
+
+if args.headers_only:
+    with open(file_path, 'rb') as f:
+        msg = parser.headers_from_file(f)
+else:
+    msg = parser.message_from_path(file_path)
 
-mimepart = mime.from_string(file_contents)
+if args.thread_index:
+    from email_decoder.threader import ThreadIndex
+    thread_id = ThreadIndex(args.thread_index).add(msg)
+    sys.stderr.write("Thread: %d\n" % thread_id)
 
-parser = Parser()
-msg = parser.message_from_mimepart(mimepart)
+if args.search_index:
+    from email_decoder.search import IndexWriter
+    writer = IndexWriter(args.search_index)
+    writer.add(msg, key=file_path)
+    writer.close()
 
 if args.format == "json":
-    print message_to_json(msg)
+    print message_to_json(msg, compact=args.compact)
 elif args.format == "msgpack":
     print message_to_msgpack(msg)
 else:
@@ -0,0 +1,249 @@
+import glob
+import os
+import os.path
+import struct
+import sys
+import multiprocessing
+import structlog
+from email_decoder.parser import Parser
+from email_decoder.limits import Limits
+from email_decoder.output import JsonEncoder
+from email_decoder.output import MsgpackEncoder
+from email_decoder.threader import ThreadIndex
+from email_decoder.columnar import ColumnarWriter
+from email_decoder.columnar import message_rows
+from email_decoder.columnar import error_rows
+from email_decoder.search import IndexWriter
+from email_decoder.search import document_terms
+
+FORMATS = ('json', 'msgpack', 'columnar')
+
+# Set in each pool worker by init_worker() so that one Parser (and ThreadIndex) is
+# reused for every file the worker handles.
+_worker_parser = None
+_worker_thread_index = None
+
+
+def init_worker(thread_index_path=None, result_cache=None, engine='flanker', html_text=None):
+    """
+    Pool initializer: creates the Parser the worker process will reuse.
+
+    :param str thread_index_path: Also add every message to the ThreadIndex at this path
+    :param email_decoder.resultcache.ResultCache result_cache: Result cache for the parser
+    :param str engine: The parser's engine (see Parser.engine)
+    :param str html_text: Derive body_text from HTML bodies (see Parser.html_text)
+    """
+    global _worker_parser, _worker_thread_index
+    _worker_parser = make_parser(result_cache, engine, html_text)
+    _worker_thread_index = ThreadIndex(thread_index_path) if thread_index_path else None
+
+
+def make_parser(result_cache=None, engine='flanker', html_text=None):
+    """
+    Creates a Parser that logs to stderr, keeping stdout free for the records. One bad message
+    shouldn't stall a worker, so the default Limits apply.
+
+    :param email_decoder.resultcache.ResultCache result_cache: Result cache for the parser
+    :param str engine: The parser's engine (see Parser.engine)
+    :param str html_text: Derive body_text from HTML bodies (see Parser.html_text)
+    """
+    return Parser(logger=structlog.wrap_logger(structlog.PrintLogger(sys.stderr)), limits=Limits(),
+                  result_cache=result_cache, engine=engine, html_text=html_text)
+
+
+def iter_paths(inputs, read_stdin=False, stdin=None):
+    """
+    Expands the inputs into individual file paths. Directories are walked recursively,
+    glob patterns are expanded and anything else is passed through as-is (a missing file
+    is reported as a failure for that path rather than aborting the run).
+
+    :param list[str] inputs: Paths, directories or glob patterns
+    :param bool read_stdin: Also read a newline-delimited list of paths from stdin
+    :param file stdin: Stream to read paths from (defaults to sys.stdin)
+    :return generator[str]
+    """
+    for item in inputs:
+        for path in _expand_input(item):
+            yield path
+
+    if read_stdin:
+        stdin = stdin or sys.stdin
+        for line in iter(stdin.readline, ''):
+            item = line.strip()
+            if item:
+                for path in _expand_input(item):
+                    yield path
+
+
+def _expand_input(item):
+    if os.path.isdir(item):
+        for dirpath, dirnames, filenames in os.walk(item):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+    elif glob.has_magic(item):
+        for path in sorted(glob.glob(item)):
+            if os.path.isdir(path):
+                for sub_path in _expand_input(path):
+                    yield sub_path
+            else:
+                yield path
+    else:
+        yield item
+
+
+def decode_path(path, parser=None, headers_only=False, thread_index=None):
+    """
+    Parses a single file into a result record. Failures are captured in the record
+    instead of being raised so one bad file never aborts a batch.
+
+    :param str path: Path to the raw email file
+    :param email_decoder.parser.Parser parser: The parser to use (defaults to the worker parser)
+    :param bool headers_only: Only read and parse the header block
+    :param email_decoder.threader.ThreadIndex thread_index: Add the message to this index (defaults to the worker's) and record its thread_id
+    :return dict
+    """
+    parser = parser or _worker_parser or make_parser()
+    thread_index = thread_index or _worker_thread_index
+    try:
+        if headers_only:
+            with open(path, 'rb') as f:
+                msg = parser.headers_from_file(f)
+        else:
+            msg = parser.message_from_path(path)
+        if thread_index is not None:
+            return {"path": path, "message": msg, "thread_id": thread_index.add(msg)}
+        return {"path": path, "message": msg}
+    except Exception as e:
+        parser.logger.error('Failed to decode file', path=path, error=e)
+        return {"path": path, "error": "%s: %s" % (type(e).__name__, e)}
+
+
+def encode_record(record, fmt):
+    """
+    Serializes a result record for the output stream: one compact JSON document per
+    line (NDJSON), or a msgpack document prefixed with its length as a 4-byte big-endian int.
+
+    :param dict record: The record from decode_path()
+    :param str fmt: 'json' or 'msgpack'
+    :return str
+    """
+    if fmt == 'msgpack':
+        encoder = MsgpackEncoder()
+        encoder.encode(record)
+        packed = encoder.getvalue()
+        return struct.pack('>I', len(packed)) + packed
+
+    out = []
+    JsonEncoder(out.append).encode(record)
+    out.append('\n')
+    return ''.join(out)
+
+
+def record_rows(record):
+    """
+    Converts a result record into the rows it adds to the columnar tables (see email_decoder.columnar).
+
+    :param dict record: The record from decode_path()
+    :return dict[str, list[tuple]]
+    """
+    if 'error' in record:
+        return error_rows(record['path'], record['error'])
+    return message_rows(record['message'], record['path'], record.get('thread_id'))
+
+
+def _decode_and_encode(args):
+    path, fmt, headers_only, index = args
+    result_cache = _worker_parser.result_cache if _worker_parser is not None else None
+    hits = result_cache.hits if result_cache is not None else 0
+
+    record = decode_path(path, headers_only=headers_only)
+    cached = result_cache is not None and result_cache.hits > hits
+    # The parent process adds the terms to its IndexWriter
+    document = (path,) + document_terms(record['message']) if index and 'error' not in record else None
+    if fmt == 'columnar':
+        # The parent process adds the rows to its ColumnarWriter
+        return record_rows(record), 'error' not in record, cached, document
+    return encode_record(record, fmt), 'error' not in record, cached, document
+
+
+def run_batch(paths, out, fmt='json', workers=None, chunksize=16, maxtasksperchild=None, headers_only=False, thread_index=None, chunk_rows=1000,
+              result_cache=None, stats=None, engine='flanker', search_index=None, html_text=None):
+    """
+    Decodes every path and writes the results to a single output stream. Parsing is spread
+    across a process pool; each worker keeps one Parser for its whole lifetime.
+
+    :param iterable[str] paths: Paths of the files to decode
+    :param file out: Stream the records are written to
+    :param str fmt: 'json' (NDJSON), 'msgpack' (length-prefixed) or 'columnar' (see email_decoder.columnar)
+    :param int workers: Number of worker processes (defaults to the CPU count, 1 runs in-process)
+    :param int chunksize: Number of paths handed to a worker at a time
+    :param int maxtasksperchild: Recycle workers after this many chunks
+    :param bool headers_only: Only parse the header block of each file
+    :param str thread_index: Path of a ThreadIndex to add every message to (each record then has a thread_id)
+    :param int chunk_rows: Columnar format: messages per chunk
+    :param email_decoder.resultcache.ResultCache result_cache: Read results back from (and add new ones to) this cache
+    :param dict stats: Gets more counters of the run: result_cache_hits
+    :param str engine: How the parsers find the parts of a message (see Parser.engine)
+    :param str search_index: Directory of a search index to add every message to, with its path as key (see email_decoder.search)
+    :param str html_text: Derive body_text from HTML bodies when there is no text part (see Parser.html_text)
+    :return tuple[int, int] Number of files processed and number of failures
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unsupported batch format: %s" % fmt)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if thread_index:
+        ThreadIndex(thread_index).create().close()
+    if result_cache is not None:
+        result_cache.create().close()
+
+    tasks = ((path, fmt, headers_only, bool(search_index)) for path in paths)
+    total = 0
+    failed = 0
+    cached = 0
+    write = out.write
+    columnar = None
+    if fmt == 'columnar':
+        columnar = ColumnarWriter(out, chunk_rows)
+        write = columnar.add_rows
+
+    if workers <= 1:
+        init_worker(thread_index, result_cache, engine, html_text)
+        results = (_decode_and_encode(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(thread_index, result_cache, engine, html_text), maxtasksperchild=maxtasksperchild)
+        results = pool.imap_unordered(_decode_and_encode, tasks, chunksize)
+
+    # Opened once the workers are forked, so they don't inherit its merge thread
+    index_writer = IndexWriter(search_index) if search_index else None
+    try:
+        for encoded, ok, from_cache, document in results:
+            write(encoded)
+            if document is not None:
+                index_writer.add_terms(*document)
+            total += 1
+            if not ok:
+                failed += 1
+            if from_cache:
+                cached += 1
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if columnar is not None:
+        columnar.close()
+    out.flush()
+    if index_writer is not None:
+        index_writer.close()
+    if stats is not None:
+        stats["result_cache_hits"] = cached
+    return total, failed
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry once it is full.
+    Keeps hit/miss counts so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        """
+        Maximum number of entries. 0 disables the cache.
+        :type int
+        """
+
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Get a cached value and mark it as recently used.
+
+        :param key: The key to look up
+        :param default: Returned when the key is not cached
+        :return mixed
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        """
+        :return dict Size and hit/miss counters of the cache
+        """
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
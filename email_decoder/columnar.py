@@ -0,0 +1,247 @@
+"""
+Column-oriented bulk export of parsed messages, for loading into a warehouse.
+
+Messages are buffered and written out in chunks. Every chunk holds one table:
+
+    messages     one row per message (or per file that failed to parse)
+    addresses    one row per From/Reply-To/To/CC/BCC address
+    attachments  one row per attached file
+    headers      one row per raw header
+
+The other tables refer to the messages table by its "key" column (the message's position in
+the file, starting at 0).
+
+File layout: the MAGIC bytes, then the chunks back to back. A chunk is a 4-byte big-endian
+length, a msgpack map {"table": name, "rows": count, "columns": [[name, size], ...]} of that
+length, and then each column as a msgpack array of `size` bytes. Readers can skip the tables and
+columns they don't need without decoding them.
+"""
+import struct
+import msgpack
+from flanker.mime.message.headers.encoding import encode
+from flanker.mime.message.headers.wrappers import WithParams
+from flanker.mime.message.headers.wrappers import ContentType
+
+MAGIC = 'EDCOLS01'
+
+_LENGTH = struct.Struct('>I')
+
+TABLES = [
+    ('messages', (
+        'key', 'path', 'error', 'message_id', 'subject', 'from_name', 'from_email', 'reply_to', 'date',
+        'message_date', 'references', 'body_text_size', 'body_html_size', 'attachment_count', 'header_count',
+        'truncated', 'thread_id')),
+    ('addresses', ('key', 'field', 'name', 'email')),
+    ('attachments', ('key', 'filename', 'content_type', 'size', 'is_inline', 'content_id', 'digest', 'data')),
+    ('headers', ('key', 'name', 'value')),
+]
+
+TABLE_COLUMNS = dict(TABLES)
+
+# Message fields holding addresses, and what the addresses table calls them
+_ADDRESS_FIELDS = [
+    ('from_addr', 'from'), ('reply_to_addr', 'reply_to'), ('to_addrs', 'to'), ('cc_addrs', 'cc'),
+    ('bcc_addrs', 'bcc')
+]
+
+
+def message_rows(msg, path=None, thread_id=None):
+    """
+    The rows a message adds to each table, without their key column. Rows only hold plain
+    values, so they can be built in a worker process and sent to the one writing the file.
+
+    :param email_decoder.models.message.Message msg: The message
+    :param str path: Where the message was read from
+    :param int thread_id: Thread of the message (see email_decoder.threader)
+    :return dict[str, list[tuple]] Rows by table name
+    """
+    addresses = []
+    for attr, field in _ADDRESS_FIELDS:
+        value = getattr(msg, attr)
+        if not value:
+            continue
+        for addr in (value if type(value) is list else [value]):
+            addresses.append((field, addr.name, addr.email))
+
+    attachments = [
+        (f.filename, f.content_type, f.size, f.is_inline, f.content_id, f.digest, f.data)
+        for f in msg.files
+    ]
+
+    headers = []
+    if msg.raw_headers is not None:
+        for hname, hs in msg.raw_headers.headers.iteritems():
+            for h in hs:
+                value = h.value
+                if isinstance(value, (ContentType, WithParams)):
+                    # Back to the header text, e.g. 'text/plain; charset="utf-8"'
+                    value = encode(h.proper_name, value)
+                headers.append((hname, value))
+
+    from_addr = msg.from_addr
+    reply_to = msg.reply_to_addr
+    truncated = msg.truncated
+    return {
+        'messages': [(
+            path, None, msg.message_id, msg.subject,
+            from_addr.name if from_addr else None, from_addr.email if from_addr else None,
+            reply_to.email if reply_to else None,
+            msg.date.isoformat(' ') if msg.date else None,
+            msg.message_date.isoformat(' ') if msg.message_date else None,
+            msg.references,
+            len(msg.body_text) if msg.body_text else 0,
+            len(msg.body_html) if msg.body_html else 0,
+            len(attachments), len(headers),
+            truncated['reason'] if truncated else None,
+            thread_id)],
+        'addresses': addresses,
+        'attachments': attachments,
+        'headers': headers,
+    }
+
+
+def error_rows(path, error):
+    """
+    The rows recorded for a file that couldn't be parsed.
+
+    :param str path: The file
+    :param str error: What went wrong
+    :return dict[str, list[tuple]] Rows by table name
+    """
+    row = [None] * (len(TABLE_COLUMNS['messages']) - 1)
+    row[0] = path
+    row[1] = error
+    return {'messages': [tuple(row)]}
+
+
+class ColumnarWriter(object):
+    """
+    Buffers rows column by column and writes a chunk per table every chunk_rows messages.
+    """
+
+    def __init__(self, fp, chunk_rows=1000):
+        """
+        :param file fp: Stream the file is written to
+        :param int chunk_rows: How many messages are buffered before the chunks are written
+        """
+        self.fp = fp
+        self.chunk_rows = chunk_rows
+        self.messages = 0
+        self._columns = dict((table, [[] for _ in columns]) for table, columns in TABLES)
+        self._buffered = 0
+        fp.write(MAGIC)
+
+    def add(self, msg, path=None, thread_id=None):
+        """
+        :param email_decoder.models.message.Message msg: The message to add
+        :param str path: Where the message was read from
+        :param int thread_id: Thread of the message
+        """
+        self.add_rows(message_rows(msg, path, thread_id))
+
+    def add_rows(self, rows):
+        """
+        Adds the rows of one message (see message_rows and error_rows).
+
+        :param dict[str, list[tuple]] rows: Rows by table name
+        """
+        key = self.messages
+        for table, table_rows in rows.iteritems():
+            if not table_rows:
+                continue
+            columns = self._columns[table]
+            columns[0].extend([key] * len(table_rows))
+            # Transpose the rows so every column is extended in one go
+            for column, values in zip(columns[1:], zip(*table_rows)):
+                column.extend(values)
+
+        self.messages += 1
+        self._buffered += 1
+        if self._buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out a chunk for every table that has buffered rows.
+        """
+        for table, names in TABLES:
+            columns = self._columns[table]
+            if not columns[0]:
+                continue
+            packed = [msgpack.packb(column) for column in columns]
+            header = msgpack.packb({
+                "table": table,
+                "rows": len(columns[0]),
+                "columns": [[name, len(data)] for name, data in zip(names, packed)],
+            })
+            self.fp.write(_LENGTH.pack(len(header)))
+            self.fp.write(header)
+            for data in packed:
+                self.fp.write(data)
+            self._columns[table] = [[] for _ in names]
+        self._buffered = 0
+
+    def close(self):
+        """
+        Writes out what is still buffered. Doesn't close the stream.
+        """
+        self.flush()
+        self.fp.flush()
+
+
+def iter_chunks(fp, tables=None, columns=None):
+    """
+    Reads a columnar file chunk by chunk.
+
+    :param file fp: The file, positioned at its start
+    :param list[str] tables: Only read chunks of these tables (default all)
+    :param list[str] columns: Only read these columns (default all)
+    :return generator[tuple[str, dict[str, list]]] (table, values by column name) for each chunk
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar message file")
+
+    while True:
+        prefix = fp.read(_LENGTH.size)
+        if not prefix:
+            return
+        if len(prefix) < _LENGTH.size:
+            raise ValueError("Truncated chunk header")
+        header = msgpack.unpackb(_read_exactly(fp, _LENGTH.unpack(prefix)[0]))
+        table = header["table"]
+        wanted = tables is None or table in tables
+
+        values = {}
+        for name, size in header["columns"]:
+            if wanted and (columns is None or name in columns):
+                values[name] = msgpack.unpackb(_read_exactly(fp, size))
+            else:
+                fp.seek(size, 1)
+
+        if wanted:
+            yield table, values
+
+
+def read_table(path, table, columns=None):
+    """
+    Reads a whole table of a columnar file.
+
+    :param str path: The file
+    :param str table: The table to read (see TABLES)
+    :param list[str] columns: Only read these columns (default all)
+    :return dict[str, list] Values by column name
+    """
+    names = [name for name in TABLE_COLUMNS[table] if columns is None or name in columns]
+    result = dict((name, []) for name in names)
+    with open(path, 'rb') as fp:
+        for _, values in iter_chunks(fp, [table], names):
+            for name in names:
+                result[name].extend(values[name])
+    return result
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated chunk")
+    return data
@@ -0,0 +1,362 @@
+"""
+A pre-forked decoder daemon, and the thin client email-decode.py uses to hand it messages.
+
+Starting email-decode.py takes a few hundred milliseconds, nearly all of it importing flanker,
+while decoding a typical message takes a few. Hooks that run it once per message (e.g. from an
+MTA) pay that every time. The daemon pays it once: it imports everything, decodes a sample
+message to warm up, and then forks its workers, which all accept connections on the same Unix
+socket. The client sends the path of a message and gets back exactly what email-decode.py would
+have printed. The client side of this module only uses the standard library, so it starts in
+milliseconds.
+
+    python -m email_decoder.daemon serve --listen /run/email-decode.sock [--workers N]
+    email-decode.py --daemon /run/email-decode.sock [--format json] FILE
+
+Protocol (frames as in email_decoder.framing): the client sends a JSON request
+{"path": ..., "format": ..., "compact": ..., "headers_only": ...} and the daemon answers with two
+frames, the output and then JSON {"exit": status, "stderr": text}. A connection can be used for
+any number of requests.
+
+The daemon reads the files itself, so it needs permission to read the paths clients send.
+"""
+import errno
+import json
+import os
+import os.path
+import signal
+import socket
+import sys
+import time
+from email_decoder.framing import ProtocolError
+from email_decoder.framing import read_frame
+from email_decoder.framing import write_frame
+
+FORMATS = ('json', 'msgpack', 'debug')
+
+# Decoded once before forking, so the workers start with everything loaded and initialised
+_WARM_UP_MESSAGE = '\r\n'.join([
+    'From: Alice Example <alice@example.com>',
+    'To: Bob Jones <bob@example.com>',
+    'Subject: Warm-up',
+    'Date: Tue, 3 Oct 2017 14:05:12 +0200',
+    'Message-ID: <warm-up@example.com>',
+    'MIME-Version: 1.0',
+    'Content-Type: multipart/mixed; boundary="b"',
+    '',
+    '--b',
+    'Content-Type: text/plain; charset=utf-8',
+    '',
+    'Hello',
+    '--b',
+    'Content-Type: application/pdf; name="a.pdf"',
+    'Content-Disposition: attachment; filename="a.pdf"',
+    'Content-Transfer-Encoding: base64',
+    '',
+    'JVBERi0xLjQK',
+    '--b--',
+    '',
+])
+
+
+class DaemonError(Exception):
+    pass
+
+
+def decode_via_daemon(address, path, fmt='debug', compact=False, headers_only=False, timeout=None):
+    """
+    Has a running daemon decode a message.
+
+    :param str address: Path of the daemon's Unix socket
+    :param str path: Path of the message (made absolute, the daemon runs elsewhere)
+    :param str fmt: 'json', 'msgpack' or 'debug'
+    :param bool compact: JSON without any whitespace
+    :param bool headers_only: Only parse the header block
+    :param float timeout: Socket timeout in seconds
+    :return tuple[str, str, int] What email-decode.py would write to stdout and stderr, and its exit status
+    :raise socket.error When the daemon can't be reached
+    :raise DaemonError When it doesn't answer properly
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        write_frame(sock, json.dumps({
+            "path": os.path.abspath(path), "format": fmt, "compact": compact, "headers_only": headers_only}))
+        try:
+            output = read_frame(sock)
+            status = read_frame(sock)
+        except ProtocolError as e:
+            raise DaemonError(str(e))
+        if output is None or status is None:
+            raise DaemonError("Connection closed by the daemon")
+        status = json.loads(status)
+        return output, status["stderr"].encode('utf-8'), status["exit"]
+    finally:
+        sock.close()
+
+
+class _Output(object):
+    """
+    Collects what print writes (unicode as UTF-8, as on a UTF-8 terminal).
+    """
+
+    softspace = 0
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+def render(msg, fmt, compact=False):
+    """
+    :return str What email-decode.py prints for the message
+    """
+    from email_decoder.output import message_to_json
+    from email_decoder.output import message_to_msgpack
+    from email_decoder.output import message_to_debug_out
+
+    if fmt == 'json':
+        return message_to_json(msg, compact=compact) + '\n'
+    if fmt == 'msgpack':
+        return message_to_msgpack(msg) + '\n'
+
+    out = _Output()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        message_to_debug_out(msg)
+    finally:
+        sys.stdout = stdout
+    return out.getvalue()
+
+
+class DecoderDaemon(object):
+    """
+    Binds a Unix socket and forks workers that accept connections on it, replacing any worker
+    that exits. Every worker has one Parser it reuses for all the messages it decodes.
+    """
+
+    def __init__(self, address, workers=None, engine='flanker', result_cache=None, max_requests=None, timeout=60, logger=None,
+                 html_text=None):
+        """
+        :param str address: Path of the Unix socket
+        :param int workers: Number of worker processes (defaults to the CPU count)
+        :param str engine: The parsers' engine (see Parser.engine)
+        :param email_decoder.resultcache.ResultCache result_cache: Result cache for the parsers
+        :param int max_requests: Replace a worker after it answered this many requests
+        :param float timeout: Drop connections that send nothing for this long, so they don't hold a worker
+        :param logger: structlog logger
+        :param str html_text: Derive body_text from HTML bodies (see Parser.html_text)
+        """
+        # Everything the workers need is imported by the parent, before forking
+        import multiprocessing
+        import structlog
+        from email_decoder import batch
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self.address = address
+        self.workers = workers
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.logger = logger or structlog.wrap_logger(structlog.PrintLogger(sys.stderr))
+
+        batch.init_worker(result_cache=result_cache, engine=engine, html_text=html_text)
+        self.parser = batch._worker_parser
+
+        self._sock = None
+        self._children = set()
+        self._stopping = False
+
+    def start(self):
+        """
+        Warms up, binds the socket and forks the workers. Call serve_forever() to supervise them.
+        """
+        self._decode_raw(_WARM_UP_MESSAGE, 'json')
+        self._decode_raw(_WARM_UP_MESSAGE, 'debug')
+
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.address)
+        self._sock.listen(128)
+
+        for _ in xrange(self.workers):
+            self._spawn()
+        return self
+
+    def serve_forever(self):
+        """
+        Waits for workers to exit and replaces them, until shutdown() was called and all of them are gone.
+        """
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            self._children.discard(pid)
+            if self._stopping:
+                continue
+            if status != 0:
+                self.logger.warning('Worker died', pid=pid, status=status)
+                # Don't fork in a tight loop when workers die right away
+                time.sleep(1)
+            self._spawn()
+
+        self._sock.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.logger.info('Stopped')
+
+    def shutdown(self):
+        """
+        Stops the workers once they have finished their current request.
+        """
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+
+        status = 0
+        try:
+            self._work()
+        except BaseException as e:
+            self.logger.error('Worker failed', error=e)
+            status = 1
+        finally:
+            # Never return into the parent's code
+            os._exit(status)
+
+    def _work(self):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(True))
+        # Ctrl-C reaches the whole process group; the parent stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        served = 0
+        while not stopping:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error as e:
+                # Interrupted by SIGTERM
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            try:
+                conn.settimeout(self.timeout)
+                served += self._serve_connection(conn, stopping)
+            except (socket.error, ProtocolError) as e:
+                self.logger.warning('Connection error', error=str(e))
+            finally:
+                conn.close()
+
+            if self.max_requests is not None and served >= self.max_requests:
+                break
+
+    def _serve_connection(self, conn, stopping):
+        served = 0
+        while not stopping:
+            frame = read_frame(conn, 64 * 1024)
+            if frame is None:
+                break
+            output, errors, status = self._handle(frame)
+            write_frame(conn, output)
+            write_frame(conn, json.dumps({"exit": status, "stderr": errors}))
+            served += 1
+        return served
+
+    def _handle(self, frame):
+        """
+        :return tuple[str, unicode, int] Output, error output and exit status
+        """
+        try:
+            request = json.loads(frame)
+            path = request["path"]
+            fmt = request.get("format", "debug")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return '', u'Invalid request\n', 2
+        if fmt not in FORMATS:
+            return '', u'Unsupported format: %s\n' % fmt, 2
+        if not os.path.isfile(path):
+            return 'The file specified does not exist\n', u'', 1
+
+        try:
+            if request.get("headers_only"):
+                with open(path, 'rb') as f:
+                    msg = self.parser.headers_from_file(f)
+            else:
+                msg = self.parser.message_from_path(path)
+            return render(msg, fmt, request.get("compact", False)), u'', 0
+        except Exception as e:
+            self.logger.error('Failed to decode file', path=path, error=e)
+            return '', u'%s: %s\n' % (type(e).__name__, e), 1
+
+    def _decode_raw(self, raw, fmt):
+        return render(self.parser.message_from_bytes(raw), fmt)
+
+
+def serve(address, **kwargs):
+    """
+    Runs a daemon until SIGTERM or SIGINT.
+    """
+    daemon = DecoderDaemon(address, **kwargs).start()
+
+    def on_signal(signum, frame):
+        daemon.shutdown()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    daemon.logger.info('Listening', address=address, workers=daemon.workers)
+    daemon.serve_forever()
+
+
+def main(argv=None):
+    import argparse
+    from email_decoder.parser import ENGINES
+    from email_decoder.parser import HTML_TEXT_MODES
+    from email_decoder.resultcache import ResultCache
+
+    opt_parser = argparse.ArgumentParser(description='Pre-forked email decoder daemon')
+    commands = opt_parser.add_subparsers(dest='command')
+
+    serve_cmd = commands.add_parser('serve', help='Run the daemon')
+    serve_cmd.add_argument('--listen', dest='listen', type=str, help='Path of the Unix socket', required=True)
+    serve_cmd.add_argument('--workers', dest='workers', type=int, help='Number of worker processes (default: CPU count)', default=None)
+    serve_cmd.add_argument('--engine', dest='engine', choices=ENGINES, help='How the parts of a message are found (see email-decode.py --engine)', default='flanker')
+    serve_cmd.add_argument('--result-cache', dest='result_cache', type=str, help='Keep parse results in a cache (SQLite) at this path', default=None)
+    serve_cmd.add_argument('--result-cache-size', dest='result_cache_size', type=int, help='Maximum size of the result cache in MB', default=1024)
+    serve_cmd.add_argument('--html-text', dest='html_text', choices=HTML_TEXT_MODES, help='Derive the text body from the HTML body of messages without one (see email-decode.py --html-text)', default=None)
+    serve_cmd.add_argument('--max-requests', dest='max_requests', type=int, help='Replace a worker after it answered this many requests', default=None)
+    args = opt_parser.parse_args(argv)
+
+    result_cache = ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024) if args.result_cache else None
+    if result_cache is not None:
+        result_cache.create().close()
+    serve(args.listen, workers=args.workers, engine=args.engine, result_cache=result_cache, max_requests=args.max_requests, html_text=args.html_text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Parsing of date header values (Date, Delivery-Date and the timestamps of Received headers).
+
+Nearly all dates in real mail are in the RFC 5322 format ("Tue, 3 Oct 2017 14:05:12 +0200"). Those
+are handled by a single precompiled regex; anything else goes through email.utils.parsedate_tz as
+before. Both paths give the same results: a naive datetime in UTC.
+"""
+import re
+from datetime import datetime
+from datetime import timedelta
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+
+_MONTHS = dict((name, i + 1) for i, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+
+# The named zones parsedate_tz knows, in seconds east of UTC
+_ZONES = {
+    'UT': 0, 'UTC': 0, 'GMT': 0, 'Z': 0,
+    'AST': -4 * 3600, 'ADT': -3 * 3600,
+    'EST': -5 * 3600, 'EDT': -4 * 3600,
+    'CST': -6 * 3600, 'CDT': -5 * 3600,
+    'MST': -7 * 3600, 'MDT': -6 * 3600,
+    'PST': -8 * 3600, 'PDT': -7 * 3600,
+}
+
+# [day-of-week ","] day month year hh:mm[:ss] zone [comment]
+# Dates without a zone are left to the slow path, which interprets them in local time.
+_RFC5322_DATE = re.compile(
+    r'^\s*(?:(?:mon|tue|wed|thu|fri|sat|sun)\s+|[a-z]+,\s*)?'
+    r'(\d{1,2})\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)\s+(\d{4}|\d{2})\s+'
+    r'(\d{1,2}):(\d{2})(?::(\d{2}))?\s+'
+    r'([+-]\d{4}|UTC?|GMT|Z|[ECMP][SD]T|A[SD]T)'
+    r'(?:\s*\([^()]*\))?\s*$',
+    re.I
+)
+
+# Midnight (UTC) of each (day, month, year) seen, and the offset of each zone seen. Mail from
+# the same period shares dates and zones, so this saves most of the string to int conversions.
+_MIDNIGHTS = {}
+_OFFSETS = {}
+_MAX_CACHED = 10000
+
+
+def parse_date(value):
+    """
+    Parses a date header value.
+
+    :param str value: The date and time string
+    :return datetime A naive datetime in UTC
+    :raise ValueError When the value isn't a date
+    """
+    match = _RFC5322_DATE.match(value)
+    if match is not None:
+        dt = _from_match(match)
+        if dt is not None:
+            return dt
+    return _parse_date_slow(value)
+
+
+def _from_match(match):
+    day, month, year, hour, minute, second, zone = match.groups()
+
+    key = (day, month, year)
+    midnight = _MIDNIGHTS.get(key)
+    if midnight is None:
+        midnight = _midnight(day, month, year)
+        if midnight is None:
+            return None
+        if len(_MIDNIGHTS) >= _MAX_CACHED:
+            _MIDNIGHTS.clear()
+        _MIDNIGHTS[key] = midnight
+
+    offset = _OFFSETS.get(zone)
+    if offset is None:
+        offset = _zone_offset(zone)
+        if len(_OFFSETS) >= _MAX_CACHED:
+            _OFFSETS.clear()
+        _OFFSETS[zone] = offset
+
+    hour = int(hour)
+    minute = int(minute)
+    second = int(second) if second else 0
+    if hour > 23 or minute > 59 or second > 59:
+        # e.g. a leap second: let the slow path decide what it means
+        return None
+
+    try:
+        return midnight + timedelta(seconds=hour * 3600 + minute * 60 + second - offset)
+    except OverflowError:
+        return None
+
+
+def _midnight(day, month, year):
+    year = int(year)
+    if year < 100:
+        # Two-digit years the way parsedate_tz (and POSIX) reads them
+        year += 1900 if year > 68 else 2000
+    try:
+        return datetime(year, _MONTHS[month.lower()], int(day))
+    except ValueError:
+        return None
+
+
+def _zone_offset(zone):
+    if zone[0] in '+-':
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        return -offset if zone[0] == '-' else offset
+    return _ZONES[zone.upper()]
+
+
+def _parse_date_slow(value):
+    date_tuple = parsedate_tz(value) if value.strip() else None
+    if not date_tuple:
+        raise ValueError("Not a date: %r" % value)
+
+    return datetime.utcfromtimestamp(mktime_tz(date_tuple))
+
+
+def received_date_string(received_hval):
+    """
+    The date of a Received header is everything after its last semicolon (the "from", "by",
+    "with" ... clauses before it can contain semicolons as well).
+
+    :param str received_hval: The value of a Received header
+    :return str
+    :raise ValueError When the header has no date
+    """
+    pos = received_hval.rfind(';')
+    if pos < 0:
+        raise ValueError("No date in Received header: %r" % received_hval)
+    return received_hval[pos + 1:]
+
+
+def parse_received_date(received_hval):
+    """
+    :param str received_hval: The value of a Received header
+    :return datetime A naive datetime in UTC
+    :raise ValueError When the header has no (valid) date
+    """
+    return parse_date(received_date_string(received_hval))
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import os.path
+import tempfile
+import uuid
+
+
+class FileStore(object):
+    """
+    Base class for streaming file stores. Attachments are written to a FileWriter chunk by chunk
+    as they are decoded, so an attachment never has to exist in memory as a whole.
+
+    A store can also be called with the complete data like the plain callable filestores
+    Parser has always accepted.
+    """
+
+    def open(self, content_type=None, filename=None):
+        """
+        Start storing a new file.
+
+        :param str content_type: The content type of the file
+        :param str filename: The filename if the message specifies one
+        :return FileWriter
+        """
+        raise NotImplementedError
+
+    def __call__(self, data):
+        writer = self.open()
+        writer.write(data)
+        return writer.close()
+
+
+class FileWriter(object):
+    """
+    Receives the chunks of a single file. The size and SHA-256 digest are computed as the chunks
+    arrive; subclasses implement _write() and _close() to actually store the data.
+    """
+
+    def __init__(self):
+        self.size = 0
+        """
+        Number of bytes written so far
+        :type int
+        """
+
+        self._hash = hashlib.sha256()
+
+    @property
+    def digest(self):
+        """
+        Hex SHA-256 digest of the bytes written so far
+        :type str
+        """
+        return self._hash.hexdigest()
+
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        self.size += len(chunk)
+        self._hash.update(chunk)
+        self._write(chunk)
+
+    def close(self):
+        """
+        Finish writing the file.
+
+        :return str A reference to where the file was stored
+        """
+        return self._close()
+
+    def abort(self):
+        """
+        Discard a partially written file (e.g. when decoding the part failed).
+        """
+        pass
+
+    def _write(self, chunk):
+        pass
+
+    def _close(self):
+        return None
+
+
+class NullFileStore(FileStore):
+    """
+    Discards file contents. Sizes and digests are still computed.
+    """
+
+    def open(self, content_type=None, filename=None):
+        return NullFileWriter()
+
+
+class NullFileWriter(FileWriter):
+    def _close(self):
+        return "<no store>"
+
+
+class DiskFileStore(FileStore):
+    """
+    Stores each file on disk under a generated key, sharded into sub-directories by the first
+    two characters of the key (the layout of a simple local object store).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        if not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+
+    def open(self, content_type=None, filename=None):
+        return DiskFileWriter(self)
+
+    def path_for_key(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _commit(self, writer):
+        """
+        Moves a completely written temporary file to its final location.
+
+        :param DiskFileWriter writer: The writer that has been closed
+        :return str The path of the stored file
+        """
+        path = self.path_for_key(uuid.uuid4().hex)
+        _move_into_place(writer.tmp_path, path)
+        return path
+
+
+class DedupFileStore(DiskFileStore):
+    """
+    Content-addressed store: files are keyed by their SHA-256 digest, so a file that has
+    already been stored (by this or any other process using the same root) is not written again.
+
+    Known digests are tracked in a SQLite index in the store root, along with how many times
+    each one has been seen.
+    """
+
+    INDEX_FILENAME = 'index.sqlite'
+
+    def __init__(self, root, index_path=None):
+        super(DedupFileStore, self).__init__(root)
+        self.index_path = index_path or os.path.join(root, self.INDEX_FILENAME)
+
+        self.hits = 0
+        """
+        Number of files that were already stored
+        :type int
+        """
+
+        self.misses = 0
+        """
+        Number of files that had to be written
+        :type int
+        """
+
+        self.bytes_saved = 0
+        """
+        Number of bytes not written because the file was already stored
+        :type int
+        """
+
+        self._db = None
+        self._db_pid = None
+
+    def stats(self):
+        """
+        :return dict Counters for this store instance
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "hit_rate": float(self.hits) / total if total else 0.0
+        }
+
+    def _connection(self):
+        # Connections can't be shared with forked children, so each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            # Only this store needs sqlite3, so it is only imported here
+            import sqlite3
+            self._db = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files '
+                '(digest TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)'
+            )
+            self._db_pid = os.getpid()
+        return self._db
+
+    def open(self, content_type=None, filename=None):
+        return DedupFileWriter(self)
+
+    def _commit(self, writer):
+        digest = writer.digest
+        path = self.path_for_key(digest)
+        db = self._connection()
+
+        known = db.execute('UPDATE files SET refs = refs + 1 WHERE digest = ?', (digest,)).rowcount
+        if known and os.path.exists(path):
+            writer.discard()
+            self.hits += 1
+            self.bytes_saved += writer.size
+            return path
+
+        _move_into_place(writer.spill(), path)
+        if not known:
+            db.execute('INSERT OR IGNORE INTO files (digest, size, refs) VALUES (?, ?, 1)', (digest, writer.size))
+        self.misses += 1
+        return path
+
+
+class DedupFileWriter(FileWriter):
+    """
+    Keeps small files in memory until the digest is known, so a file that is already stored
+    never touches the disk. Larger files are spilled to a temporary file as they are written.
+    """
+
+    # Files up to this size are held in memory
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, store):
+        super(DedupFileWriter, self).__init__()
+        self.store = store
+        self.tmp_path = None
+        self._fh = None
+        self._chunks = []
+
+    def _write(self, chunk):
+        if self._fh is None and self.size > self.SPOOL_SIZE:
+            self._open_tmp()
+        if self._fh is not None:
+            self._fh.write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def _close(self):
+        return self.store._commit(self)
+
+    def spill(self):
+        """
+        Makes sure everything written so far is in a temporary file.
+
+        :return str Path of the temporary file
+        """
+        if self._fh is None:
+            self._open_tmp()
+        self._fh.close()
+        return self.tmp_path
+
+    def _open_tmp(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=self.store.tmp_dir)
+        self._fh = os.fdopen(fd, 'wb')
+        for chunk in self._chunks:
+            self._fh.write(chunk)
+        self._chunks = []
+
+    def discard(self):
+        self._chunks = []
+        if self._fh is not None:
+            self._fh.close()
+            if os.path.exists(self.tmp_path):
+                os.unlink(self.tmp_path)
+
+    def abort(self):
+        self.discard()
+
+
+class DiskFileWriter(FileWriter):
+    def __init__(self, store):
+        super(DiskFileWriter, self).__init__()
+        self.store = store
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._fh = os.fdopen(fd, 'wb')
+
+    def _write(self, chunk):
+        self._fh.write(chunk)
+
+    def _close(self):
+        self._fh.close()
+        return self.store._commit(self)
+
+    def abort(self):
+        self._fh.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+def _move_into_place(tmp_path, path):
+    dir_name = os.path.dirname(path)
+    if not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            # Another process created it in the meantime
+            if not os.path.isdir(dir_name):
+                raise
+    os.rename(tmp_path, path)
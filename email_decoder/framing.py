@@ -0,0 +1,68 @@
+"""
+Length-prefixed frames, the wire format of the ingestion server and the decoder daemon: every
+frame is a 4-byte big-endian length followed by that many bytes. Only uses the standard library,
+so clients can import it without loading the parser.
+"""
+import select
+import struct
+
+# How often a connection waiting for the next frame checks whether it should stop (e.g. a draining server)
+POLL_INTERVAL = 0.5
+
+RECV_SIZE = 64 * 1024
+
+_LENGTH = struct.Struct('>I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def read_frame(sock, max_size=None, should_stop=None):
+    """
+    Reads one length-prefixed frame.
+
+    :param socket.socket sock: The connection
+    :param int max_size: Raise ProtocolError for frames larger than this
+    :param callable should_stop: Polled before every frame and every POLL_INTERVAL while waiting for one; when it returns True no more frames are read
+    :return str|None The frame, or None when the peer closed the connection (or should_stop) between frames
+    """
+    header = _recv_exactly(sock, _LENGTH.size, should_stop)
+    if header is None:
+        return None
+
+    size, = _LENGTH.unpack(header)
+    if max_size is not None and size > max_size:
+        raise ProtocolError("Frame of %d bytes exceeds the limit of %d bytes" % (size, max_size))
+
+    body = _recv_exactly(sock, size)
+    if body is None:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return body
+
+
+def write_frame(sock, data):
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size, should_stop=None):
+    chunks = []
+    remaining = size
+    while remaining:
+        if should_stop is not None and not chunks:
+            if should_stop():
+                return None
+            # Wait for the start of the next frame in short steps, so a drain is noticed
+            readable, _, _ = select.select([sock], [], [], POLL_INTERVAL)
+            if not readable:
+                continue
+
+        chunk = sock.recv(min(remaining, RECV_SIZE))
+        if not chunk:
+            if chunks:
+                raise ProtocolError("Connection closed in the middle of a frame")
+            return None
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
@@ -0,0 +1,383 @@
+"""
+Plain text from HTML bodies, for messages that don't have a text/plain part.
+
+Converting body_html with a DOM-based converter means building the whole document tree first,
+which is slow and takes many times the size of the HTML in memory on large newsletters. Here
+the HTML is tokenized in a single pass and text is written out as soon as it is found. Apart
+from the text itself, the only state kept is a few flags and counters (in a <pre>, in a
+skipped element, ...) and, between chunks, at most one incomplete tag (MAX_TAG_LENGTH). Every
+byte of the HTML is looked at a bounded number of times, so the time is linear in its size.
+
+The text follows what a reader sees:
+  * whitespace is collapsed as in a browser
+  * block elements start new lines and paragraphs, <br> breaks lines, list items get a "* "
+  * character references are decoded
+  * comments, <script>, <style>, <title> and elements hidden with display:none are dropped
+With strip_quotes, quoted replies (blockquotes, the quote containers of the common mail
+clients, "> " lines and their "On ... wrote:" line) are left out too, and the text ends at a
+signature ("-- ") or at an "Original Message" header.
+"""
+import htmlentitydefs
+import re
+
+# Longer "tags" (a '<' without a '>' in sight) are taken as text, so incomplete tags held
+# between chunks stay small
+MAX_TAG_LENGTH = 64 * 1024
+
+# Line breaks before and after block elements (2 leaves an empty line)
+_BLOCKS = {
+    'address': 1, 'article': 1, 'aside': 1, 'center': 1, 'dd': 1, 'div': 1, 'dt': 1, 'fieldset': 1,
+    'figure': 1, 'footer': 1, 'form': 1, 'header': 1, 'main': 1, 'nav': 1, 'section': 1, 'tr': 1,
+    'caption': 1, 'li': 1,
+    'blockquote': 2, 'dl': 2, 'h1': 2, 'h2': 2, 'h3': 2, 'h4': 2, 'h5': 2, 'h6': 2, 'hr': 2, 'ol': 2,
+    'p': 2, 'pre': 2, 'table': 2, 'ul': 2,
+}
+
+# Elements whose contents are never shown, skipped up to their end tag
+_RAW_TEXT = dict((name, re.compile(r'</%s[\s/>]' % name, re.IGNORECASE)) for name in (
+    'script', 'style', 'title', 'textarea', 'template', 'xml'))
+
+# How much of a chunk is held back when it might end in the middle of one of those end tags
+_RAW_TEXT_TAIL = 16
+
+# Elements that can be skipped (hidden, or quoted) as a whole. The end of a skipped element is
+# found by counting the start and end tags with its name, so it only works for elements that
+# are always closed (not <p>, <li> or <td>).
+_CONTAINERS = frozenset(['blockquote', 'center', 'div', 'font', 'section', 'span', 'table'])
+
+# Quoted text as the common mail clients mark it up (with strip_quotes)
+_QUOTE_CLASSES = frozenset(['gmail_quote', 'gmail_signature', 'yahoo_quoted', 'moz-cite-prefix', 'moz-signature'])
+_QUOTE_IDS = frozenset(['signature'])
+# Everything after these is the message being replied to (Outlook)
+_STOP_IDS = frozenset(['divrplyfwdmsg', 'appendonsend', 'stopspelling', 'olk_src_body_section'])
+
+_TAG_START = re.compile(r'<(/?)([a-zA-Z][^\s/<>]*)')
+_ATTRIBUTE = re.compile(r'''([a-zA-Z_:][-a-zA-Z0-9_:.]*)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+_HIDDEN = re.compile(r'display\s*:\s*none', re.IGNORECASE)
+_WHITESPACE = re.compile(r'[ \t\n\r\f]+')
+_ENTITY = re.compile(r'&(?:#([0-9]{1,8})|#[xX]([0-9a-fA-F]{1,8})|([a-zA-Z][a-zA-Z0-9]{1,31}));?')
+# An entity that may continue in the next chunk
+_PARTIAL_ENTITY = re.compile(r'&#?[a-zA-Z0-9]{0,32}$')
+_ENTITY_LENGTH = 40
+
+_ATTRIBUTION = re.compile(r'on\b.{0,300}\bwrote:$', re.IGNORECASE)
+_ORIGINAL_MESSAGE = re.compile(r'-{2,}\s*original message\s*-{2,}$', re.IGNORECASE)
+
+_NAMED_ENTITIES = dict(htmlentitydefs.name2codepoint, apos=39)
+
+
+def html_to_text(html, strip_quotes=False):
+    """
+    :param str|list[str] html: UTF-8 HTML, or several HTML bodies that are converted as one
+    :param bool strip_quotes: Leave out quoted replies and signatures
+    :return str The text (UTF-8), empty when there is none
+    """
+    extractor = HtmlTextExtractor(strip_quotes)
+    for chunk in ([html] if isinstance(html, str) else html):
+        extractor.feed(chunk)
+    return extractor.close()
+
+
+class HtmlTextExtractor(object):
+    """
+    Converts HTML to text incrementally: feed() it the HTML in chunks of any size, and close()
+    returns the text.
+    """
+
+    def __init__(self, strip_quotes=False):
+        """
+        :param bool strip_quotes: Leave out quoted replies and signatures
+        """
+        self.strip_quotes = strip_quotes
+
+        # Text so far: chunks, or with strip_quotes the lines that were kept (the current line
+        # is in self._line until it is complete and can be checked)
+        self._out = []
+        self._line = []
+        self._written = False
+
+        # What goes between the last text and the next: line breaks, or else a space
+        self._newlines = 0
+        self._space = False
+        self._bullet = False
+
+        self._tail = ''
+        self._in_comment = False
+        self._raw_text_end = None
+        self._pre = 0
+        self._skip_name = None
+        self._skip_depth = 0
+        self._stopped = False
+
+    def feed(self, data):
+        """
+        :param str data: The next chunk of HTML
+        """
+        if self._tail:
+            data = self._tail + data
+        self._tail = data[self._consume(data, False):]
+
+    def close(self):
+        """
+        :return str The text
+        """
+        if self._tail:
+            self._consume(self._tail, True)
+            self._tail = ''
+        if not self.strip_quotes:
+            return ''.join(self._out)
+
+        if not self._stopped:
+            self._end_line()
+        while self._out and not self._out[-1].strip():
+            self._out.pop()
+        return '\n'.join(self._out)
+
+    def _consume(self, buf, final):
+        """
+        :return int Where the data that has to wait for the next chunk starts
+        """
+        size = len(buf)
+        pos = 0
+        # The first '>' after the current '<' (size when there is none). Only ever moves forward,
+        # so finding the ends of tags takes one pass over the data.
+        next_gt = -1
+
+        while pos < size:
+            if self._stopped:
+                return size
+
+            if self._in_comment:
+                end = buf.find('-->', pos)
+                if end == -1:
+                    return size if final else max(pos, size - 2)
+                self._in_comment = False
+                pos = end + 3
+                continue
+
+            if self._raw_text_end is not None:
+                match = self._raw_text_end.search(buf, pos)
+                if match is None:
+                    return size if final else max(pos, size - _RAW_TEXT_TAIL)
+                self._raw_text_end = None
+                # Back to the end tag, so it is handled like any other
+                pos = match.start()
+                continue
+
+            lt = buf.find('<', pos)
+            if lt == -1:
+                end = size if final else self._text_end(buf, pos, size)
+                self._handle_text(buf[pos:end])
+                return end
+            if lt > pos:
+                self._handle_text(buf[pos:lt])
+                pos = lt
+
+            if buf.startswith('<!--', lt):
+                self._in_comment = True
+                pos = lt + 4
+                continue
+            if not final and size - lt < 4 and '<!--'.startswith(buf[lt:]):
+                return lt
+
+            if next_gt < lt:
+                next_gt = buf.find('>', lt)
+                if next_gt == -1:
+                    next_gt = size
+
+            match = _TAG_START.match(buf, lt, next_gt)
+            if match is None and buf[lt + 1:lt + 2] not in ('!', '?', '/'):
+                # "a < b"
+                self._handle_text('<')
+                pos = lt + 1
+                continue
+            if next_gt == size:
+                # No tag can end in this chunk. What is too far from its end to be the start of
+                # one (all of it for the last chunk) is text, up to any comment.
+                if final:
+                    end = size
+                elif size - lt <= MAX_TAG_LENGTH:
+                    return lt
+                else:
+                    end = buf.rfind('<', lt + 1, size - MAX_TAG_LENGTH + 1)
+                    if end == -1:
+                        end = lt + 1
+                comment = buf.find('<!--', lt, end)
+                if comment != -1:
+                    end = comment
+                self._handle_text(buf[lt:end])
+                pos = end
+                continue
+
+            if match is not None:
+                self._handle_tag(match.group(2).lower(), match.group(1) == '/', buf, match.end(), next_gt)
+            # Otherwise a doctype, processing instruction or some other declaration
+            pos = next_gt + 1
+
+        return size
+
+    def _text_end(self, buf, pos, size):
+        # Holds back an entity that may be cut off
+        amp = buf.rfind('&', max(pos, size - _ENTITY_LENGTH), size)
+        if amp != -1 and _PARTIAL_ENTITY.match(buf, amp):
+            return amp
+        return size
+
+    def _handle_tag(self, name, closing, buf, attributes_start, attributes_end):
+        if self._skip_name is not None:
+            if name == self._skip_name:
+                self._skip_depth += -1 if closing else 1
+                if self._skip_depth == 0:
+                    self._skip_name = None
+                    self._break(1)
+            elif not closing and name in _RAW_TEXT:
+                self._raw_text_end = _RAW_TEXT[name]
+            return
+
+        if closing:
+            if name == 'pre' and self._pre:
+                self._pre -= 1
+            if name in _BLOCKS:
+                self._break(_BLOCKS[name])
+            return
+
+        if name in _RAW_TEXT:
+            self._raw_text_end = _RAW_TEXT[name]
+            return
+
+        if (name in _CONTAINERS or name == 'hr') and buf.find('=', attributes_start, attributes_end) != -1:
+            attributes = _attributes(buf[attributes_start:attributes_end])
+            if self.strip_quotes and attributes.get('id', '').lower() in _STOP_IDS:
+                # The text so far is kept
+                self._end_line()
+                self._stopped = True
+                return
+            if name in _CONTAINERS and (_HIDDEN.search(attributes.get('style', '')) or (self.strip_quotes and (
+                    name == 'blockquote' or attributes.get('id', '').lower() in _QUOTE_IDS or
+                    not _QUOTE_CLASSES.isdisjoint(attributes.get('class', '').lower().split())))):
+                self._skip(name, buf, attributes_end)
+                return
+        elif name == 'blockquote' and self.strip_quotes:
+            self._skip(name, buf, attributes_end)
+            return
+
+        if name == 'br':
+            if self._written:
+                self._newlines = min(self._newlines + 1, 2)
+        elif name in _BLOCKS:
+            self._break(_BLOCKS[name])
+            if name == 'li':
+                self._bullet = True
+            elif name == 'pre':
+                self._pre += 1
+        elif name in ('td', 'th'):
+            self._space = True
+
+    def _skip(self, name, buf, tag_end):
+        # <div/> has no contents
+        if buf[tag_end - 1] != '/':
+            self._skip_name = name
+            self._skip_depth = 1
+        self._break(1)
+
+    def _break(self, newlines):
+        if self._written:
+            self._newlines = max(self._newlines, newlines)
+
+    def _handle_text(self, data):
+        if self._skip_name is not None or not data:
+            return
+        if self._pre:
+            self._emit(_decode_entities(data))
+            return
+
+        data = _WHITESPACE.sub(' ', data)
+        if data[0] == ' ':
+            self._space = True
+        trailing_space = data[-1] == ' '
+        data = data.strip(' ')
+        if data:
+            self._emit(_decode_entities(data))
+            self._space = trailing_space
+
+    def _emit(self, text):
+        if self._written:
+            if self._newlines:
+                text = '\n' * self._newlines + ('* ' if self._bullet else '') + text
+            elif self._space:
+                text = ' ' + text
+        elif self._bullet:
+            text = '* ' + text
+        self._newlines = 0
+        self._space = False
+        self._bullet = False
+        self._written = True
+
+        if not self.strip_quotes:
+            self._out.append(text)
+            return
+
+        lines = text.split('\n')
+        self._line.append(lines[0])
+        for line in lines[1:]:
+            self._end_line()
+            if self._stopped:
+                return
+            self._line.append(line)
+
+    def _end_line(self):
+        line = ''.join(self._line)
+        self._line = []
+        stripped = line.strip()
+        if stripped == '--' or _ORIGINAL_MESSAGE.match(stripped):
+            self._stopped = True
+            return
+        if stripped.startswith('>') or _ATTRIBUTION.match(stripped):
+            return
+        # Leaving lines out mustn't leave several empty ones in a row
+        if not stripped and (not self._out or not self._out[-1].strip()):
+            return
+        self._out.append(line)
+
+
+def _attributes(data):
+    """
+    :param str data: What is between the name and the end of a tag
+    :return dict[str, str] The attributes (names in lower case), without character references decoded
+    """
+    attributes = {}
+    for match in _ATTRIBUTE.finditer(data):
+        name = match.group(1).lower()
+        if name not in attributes:
+            value = match.group(2)
+            if value is None:
+                value = match.group(3) if match.group(3) is not None else match.group(4)
+            attributes[name] = value
+    return attributes
+
+
+def _decode_entities(text):
+    if '&' not in text:
+        return text
+    return _ENTITY.sub(_decode_entity, text)
+
+
+def _decode_entity(match):
+    decimal, hexadecimal, name = match.groups()
+    if name is not None:
+        codepoint = _NAMED_ENTITIES.get(name)
+        if codepoint is None:
+            return match.group(0)
+    else:
+        codepoint = int(decimal, 10) if decimal is not None else int(hexadecimal, 16)
+
+    if 0x80 <= codepoint <= 0x9f:
+        # As browsers do, these are read as windows-1252
+        try:
+            return chr(codepoint).decode('cp1252').encode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    if codepoint == 0 or codepoint > 0x10ffff or 0xd800 <= codepoint <= 0xdfff:
+        codepoint = 0xfffd
+    # Not unichr, which only goes up to 0xffff on narrow builds
+    return ('\\U%08x' % codepoint).decode('unicode-escape').encode('utf-8')
@@ -0,0 +1,112 @@
+"""
+Per-message budgets that keep a single pathological message (thousands of parts, multiparts nested
+hundreds of levels deep, a huge base64 blob, ...) from stalling a worker.
+
+When a budget runs out the Parser stops working on the message and returns what it has so far,
+with Message.truncated describing which limit was hit.
+"""
+import time
+
+
+class Limits(object):
+    """
+    Limits on the work done for a single message. None means unlimited.
+    """
+
+    def __init__(self, max_parts=1000, max_depth=50, max_decoded_bytes=100 * 1024 * 1024, max_headers=2000, max_seconds=30.0):
+        self.max_parts = max_parts
+        """
+        Maximum number of MIME parts walked (multipart containers included)
+        :type int | None
+        """
+
+        self.max_depth = max_depth
+        """
+        Maximum nesting level of a part (the top level part is at 0)
+        :type int | None
+        """
+
+        self.max_decoded_bytes = max_decoded_bytes
+        """
+        Maximum total size of the decoded part bodies. Sizes are estimated from the raw bodies
+        before they are decoded, so a part over the limit is never decoded at all.
+        :type int | None
+        """
+
+        self.max_headers = max_headers
+        """
+        Maximum number of top level headers; any further headers are dropped
+        :type int | None
+        """
+
+        self.max_seconds = max_seconds
+        """
+        Maximum wall-clock time spent walking and decoding the parts of a message
+        :type float | None
+        """
+
+    def budget(self):
+        """
+        :return Budget A fresh budget for one message, with its clock starting now
+        """
+        return Budget(self)
+
+
+class LimitExceeded(Exception):
+    """
+    Raised inside the Parser when a message goes over one of its limits.
+    """
+
+    def __init__(self, reason, limit, value):
+        super(LimitExceeded, self).__init__("%s exceeded: %s > %s" % (reason, value, limit))
+        self.reason = reason
+        self.limit = limit
+        self.value = value
+
+    def as_dict(self):
+        """
+        :return dict What Message.truncated is set to
+        """
+        return {"reason": self.reason, "limit": self.limit, "value": self.value}
+
+
+class Budget(object):
+    """
+    Tracks how much of its Limits a single message has used.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.parts = 0
+        self.decoded_bytes = 0
+        self.deadline = time.time() + limits.max_seconds if limits.max_seconds is not None else None
+
+    def add_part(self, depth):
+        """
+        Account for walking one more part.
+
+        :param int depth: Nesting level of the part
+        :raise LimitExceeded
+        """
+        limits = self.limits
+        self.parts += 1
+        if limits.max_parts is not None and self.parts > limits.max_parts:
+            raise LimitExceeded('max_parts', limits.max_parts, self.parts)
+        if limits.max_depth is not None and depth > limits.max_depth:
+            raise LimitExceeded('max_depth', limits.max_depth, depth)
+        if self.deadline is not None:
+            now = time.time()
+            if now > self.deadline:
+                raise LimitExceeded('max_seconds', limits.max_seconds, round(now - self.deadline + limits.max_seconds, 3))
+
+    def add_decoded_bytes(self, size):
+        """
+        Account for decoding a part body.
+
+        :param int size: The (estimated) decoded size of the body
+        :raise LimitExceeded
+        """
+        self.decoded_bytes += size
+        max_decoded_bytes = self.limits.max_decoded_bytes
+        if max_decoded_bytes is not None and self.decoded_bytes > max_decoded_bytes:
+            raise LimitExceeded('max_decoded_bytes', max_decoded_bytes, self.decoded_bytes)
@@ -0,0 +1,94 @@
+"""
+Parsing straight from a memory-mapped file.
+
+flanker's scanner only takes a str, so the whole message has to be in memory (and it is copied
+again into the StringIO the parts read from). Here the same scanner runs over an mmap instead: the
+tokenizer finds the headers and boundaries in the mapped buffer, and the parts read their headers
+and bodies from it when they are needed. Only the slices that are actually read become strings,
+so resident memory follows what is used rather than the size of the file.
+"""
+import mmap
+import os
+
+
+class MappedFile(object):
+    """
+    The file-like object the parts of a mapped message read from (what the StringIO is for
+    flanker's own scanner).
+    """
+
+    def __init__(self, buf):
+        """
+        :param mmap.mmap buf: The mapped message
+        """
+        self.buf = buf
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.buf.tell()
+        elif whence == 2:
+            pos += len(self.buf)
+        self.buf.seek(min(max(pos, 0), len(self.buf)))
+
+    def tell(self):
+        return self.buf.tell()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.buf) - self.buf.tell()
+        return self.buf.read(size)
+
+    def readline(self):
+        return self.buf.readline()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.buf.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+
+def map_file(path):
+    """
+    Maps a file read-only. The mapping stays valid after the file is closed, until nothing
+    refers to it anymore.
+
+    :param str path: Path of the file
+    :return mmap.mmap|str The mapping, or an empty string for an empty file (which can't be mapped)
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_buffer(buf):
+    """
+    Same as flanker's mime.from_string, but for a message in a buffer such as an mmap.
+
+    :param mmap.mmap|str buf: The raw message
+    :return flanker.mime.message.part.MimePart
+    """
+    # Imported here so map_file can be used (e.g. by the search index) without loading flanker
+    from flanker.mime.message import scanner
+    from flanker.mime.message.errors import DecodingError
+
+    if isinstance(buf, str):
+        return scanner.scan(buf)
+
+    tokens = scanner.tokenize(buf)
+    if not tokens:
+        tokens = [scanner.default_content_type()]
+
+    iterator = scanner.TokensIterator(tokens, '')
+    iterator.string = buf
+    iterator.stream = MappedFile(buf)
+    try:
+        return scanner.traverse(scanner.Start(), iterator)
+    except DecodingError:
+        raise
+    except Exception:
+        raise DecodingError("Malformed MIME message")
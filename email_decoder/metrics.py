@@ -0,0 +1,201 @@
+import threading
+import time
+import structlog
+
+
+class Metrics(object):
+    """
+    Receives instrumentation from a Parser: how long each stage took, how many parts and bytes
+    were processed and which errors were hit. Every method is a no-op here; implementations
+    override the ones they care about.
+
+    Stages reported by the parser:
+      * headers: parsing raw headers into the parsed Headers collection
+      * address: parsing and validating address headers
+      * date: parsing date headers
+      * scan: finding the parts of a message (Parser(engine='scanner') only)
+      * walk_parts: walking and decoding all MIME parts
+      * text: decoding and normalising text body parts
+      * html_text: extracting body_text from the HTML body (Parser(html_text=...) only)
+      * filestore: storing an attachment
+
+    Note that with Parser(lazy=True), stages run (and are reported) when the deferred
+    data is first accessed, which may be after end_message().
+    """
+
+    def start_message(self):
+        """
+        Called when the parser starts on a new message.
+        """
+        pass
+
+    def end_message(self, message_id=None):
+        """
+        Called when the parser is done with a message.
+
+        :param str message_id: The raw Message-ID header of the message, if it has one
+        """
+        pass
+
+    def timing(self, stage, seconds):
+        """
+        :param str stage: The stage that ran
+        :param float seconds: How long it took
+        """
+        pass
+
+    def count(self, name, value=1):
+        """
+        :param str name: What is being counted (e.g. parts, text_bytes)
+        :param int value: How many
+        """
+        pass
+
+    def observe(self, name, value):
+        """
+        Record a single observation of a value (e.g. the size of an attachment).
+
+        :param str name: What was observed
+        :param int|float value: The value
+        """
+        pass
+
+    def error(self, tag):
+        """
+        :param str tag: The same tag the error is logged with
+        """
+        pass
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Aggregates everything in memory and renders it in the Prometheus text exposition format,
+    e.g. to serve from a /metrics endpoint or write to a node_exporter textfile.
+    """
+
+    def __init__(self, prefix='email_decoder'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._messages = 0
+        self._stage_seconds = {}
+        self._stage_count = {}
+        self._counts = {}
+        self._observed_sum = {}
+        self._observed_count = {}
+        self._observed_max = {}
+        self._errors = {}
+
+    def end_message(self, message_id=None):
+        with self._lock:
+            self._messages += 1
+
+    def timing(self, stage, seconds):
+        with self._lock:
+            self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.0) + seconds
+            self._stage_count[stage] = self._stage_count.get(stage, 0) + 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            self._observed_sum[name] = self._observed_sum.get(name, 0) + value
+            self._observed_count[name] = self._observed_count.get(name, 0) + 1
+            if value > self._observed_max.get(name, value - 1):
+                self._observed_max[name] = value
+
+    def error(self, tag):
+        with self._lock:
+            self._errors[tag] = self._errors.get(tag, 0) + 1
+
+    def render(self):
+        """
+        :return str The metrics in the Prometheus text format
+        """
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append('# TYPE %s_messages_total counter' % p)
+            lines.append('%s_messages_total %d' % (p, self._messages))
+
+            lines.append('# TYPE %s_stage_seconds summary' % p)
+            for stage in sorted(self._stage_seconds):
+                lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (p, stage, self._stage_seconds[stage]))
+                lines.append('%s_stage_seconds_count{stage="%s"} %d' % (p, stage, self._stage_count[stage]))
+
+            lines.append('# TYPE %s_events_total counter' % p)
+            for name in sorted(self._counts):
+                lines.append('%s_events_total{name="%s"} %d' % (p, name, self._counts[name]))
+
+            lines.append('# TYPE %s_observed summary' % p)
+            for name in sorted(self._observed_sum):
+                lines.append('%s_observed_sum{name="%s"} %s' % (p, name, self._observed_sum[name]))
+                lines.append('%s_observed_count{name="%s"} %d' % (p, name, self._observed_count[name]))
+
+            lines.append('# TYPE %s_observed_max gauge' % p)
+            for name in sorted(self._observed_max):
+                lines.append('%s_observed_max{name="%s"} %s' % (p, name, self._observed_max[name]))
+
+            lines.append('# TYPE %s_errors_total counter' % p)
+            for tag in sorted(self._errors):
+                lines.append('%s_errors_total{tag="%s"} %d' % (p, tag, self._errors[tag]))
+
+        return '\n'.join(lines) + '\n'
+
+
+class StructlogMetrics(Metrics):
+    """
+    Collects the metrics of each message and logs them as a single structured event when the
+    message is done. With slow_threshold set, only messages that took at least that many seconds
+    from start to end are logged, which makes pathological messages easy to find in production logs.
+    """
+
+    def __init__(self, logger=None, slow_threshold=None):
+        if logger is None:
+            logger = structlog.get_logger()
+
+        self.logger = logger
+        self.slow_threshold = slow_threshold
+        self._current = None
+
+    def start_message(self):
+        self._current = {"start": time.time(), "stages": {}, "counts": {}, "observed": {}, "errors": []}
+
+    def end_message(self, message_id=None):
+        current = self._current
+        self._current = None
+        if current is None:
+            return
+
+        total = time.time() - current["start"]
+        if self.slow_threshold is not None and total < self.slow_threshold:
+            return
+
+        self.logger.info(
+            "Parsed message",
+            message_id=message_id,
+            seconds=total,
+            stages=current["stages"],
+            counts=current["counts"],
+            observed=current["observed"],
+            errors=current["errors"]
+        )
+
+    def timing(self, stage, seconds):
+        if self._current is not None:
+            stages = self._current["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def count(self, name, value=1):
+        if self._current is not None:
+            counts = self._current["counts"]
+            counts[name] = counts.get(name, 0) + value
+
+    def observe(self, name, value):
+        if self._current is not None:
+            self._current["observed"].setdefault(name, []).append(value)
+
+    def error(self, tag):
+        if self._current is not None:
+            self._current["errors"].append(tag)
@@ -5,6 +5,8 @@ class Addr(object):
     """
     Represents an email address.
     """
+    __slots__ = ('name', 'email')
+
     def __init__(self, email=None, name=None):
         self.name = name
         """
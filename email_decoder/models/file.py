@@ -1,4 +1,6 @@
-class File:
+class File(object):
+    __slots__ = ('content_id', 'filename', 'size', 'content_type', 'data', 'is_inline', 'digest')
+
     def __init__(self):
         self.content_id = None
         """
@@ -34,4 +36,10 @@ class File:
         """
         True if the file has inline disposition
         :type bool
+        """
+
+        self.digest = None
+        """
+        Hex SHA-256 digest of the file contents, when the filestore computed one.
+        :type str | None
         """
\ No newline at end of file
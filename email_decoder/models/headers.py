@@ -1,8 +1,13 @@
-class Headers:
+import string
+
+
+class Headers(object):
     """
     Collection of headers
     """
 
+    __slots__ = ('headers',)
+
     # Well-known headers and their proper names (case matters)
     KNOWN_HEADERS = [
         'Autoforwarded',
@@ -44,6 +49,12 @@ class Headers:
 
     NORMAL_TO_KNOWN = dict((h.lower(), h) for h in KNOWN_HEADERS)
 
+    # (raw name, proper name, normal name) by raw header name. Every Header with the same
+    # name shares these strings instead of holding its own copies. Pre-filled with the spellings
+    # of the known headers we usually see; other names are added as they come up, up to a limit.
+    NAME_TABLE = {}
+    NAME_TABLE_LIMIT = 10000
+
     ADDR_HEADERS = [
         'BCC', 'CC', 'Delivered-To', 'From', 'Original-Recipient', 'Reply-To', 'Return-Path', 'Sender', 'To'
     ]
@@ -58,6 +69,18 @@ class Headers:
         'Thread-Index', 'Subject'
     ]
 
+    SINGLE_PROPER_NAMES = frozenset(SINGLE_HEADERS)
+
+    # How parsed_headers_from_raw_headers treats a header, by normal name. Anything not
+    # listed is copied as-is.
+    KIND_ADDR = 'addr'
+    KIND_DATE = 'date'
+    KIND_PASSTHROUGH = 'passthrough'
+    HEADER_KINDS = dict(
+        [(h.lower(), KIND_ADDR) for h in ADDR_HEADERS] +
+        [(h.lower(), KIND_DATE) for h in DATE_HEADERS]
+    )
+
     """
     Collection of headers
     """
@@ -89,24 +112,38 @@ class Headers:
         if is_multiple:
             for v in value:
                 header = Header(name, v)
-                header.is_single = is_single
-                if header.proper_name in Headers.SINGLE_HEADERS:
-                    header.is_single = True
+                header.is_single = is_single or header.proper_name in Headers.SINGLE_PROPER_NAMES
                 self.add_header(header)
         else:
             header = Header(name, value)
-            header.is_single = is_single
-            if header.proper_name in Headers.SINGLE_HEADERS:
-                header.is_single = True
+            header.is_single = is_single or header.proper_name in Headers.SINGLE_PROPER_NAMES
             self.add_header(header)
 
+    """
+    Add a copy of each of the headers, all with the same name, to the collection
+    :param list[Header] headers: The headers to copy
+    """
+    def add_copies(self, headers):
+        copies = []
+        for h in headers:
+            header = Header()
+            header._raw_name = h._raw_name
+            header._proper_name = h._proper_name
+            header._normal_name = h._normal_name
+            header.value = h.value
+            header.is_single = h.is_single
+            copies.append(header)
+
+        if copies:
+            self.headers.setdefault(copies[0]._normal_name, []).extend(copies)
+
     """
     Get ALL header objects for a particular header.
     :param str name: The name of the header you want
     :return list[Header]
     """
     def get_headers(self, name):
-        name = name.lower()
+        name = normal_name(name)
         return self.headers[name] if name in self.headers else None
 
     """
@@ -115,7 +152,7 @@ class Headers:
     :return Header
     """
     def get_header(self, name):
-        name = name.lower()
+        name = normal_name(name)
         return self.headers[name][0] if name in self.headers else None
 
     """
@@ -124,7 +161,7 @@ class Headers:
     :return list[str]
     """
     def get_header_values(self, name):
-        name = name.lower()
+        name = normal_name(name)
         return [h.value for h in self.headers[name]] if name in self.headers else None
 
     """
@@ -133,7 +170,7 @@ class Headers:
     :return str
     """
     def get_header_value(self, name):
-        name = name.lower()
+        name = normal_name(name)
         return self.headers[name][0].value if name in self.headers else None
 
     """
@@ -142,7 +179,7 @@ class Headers:
     :return bool
     """
     def has_header(self, name):
-        name = name.lower()
+        name = normal_name(name)
         return True if name in self.headers else False
 
     @staticmethod
@@ -153,8 +190,47 @@ class Headers:
         else:
             return lower_name
 
+    @staticmethod
+    def intern_name(name):
+        """
+        Get the shared (raw name, proper name, normal name) strings for a header name.
+
+        :param str name: The header name as found in the message
+        :return tuple[str, str, str]
+        """
+        names = Headers.NAME_TABLE.get(name)
+        if names is None:
+            normal_name = name.lower()
+            known = Headers.NAME_TABLE.get(normal_name)
+            if known is not None:
+                # Another spelling of a name we have already seen
+                normal_name = known[2]
+            names = (name, Headers.get_proper_name(normal_name), normal_name)
+            if len(Headers.NAME_TABLE) < Headers.NAME_TABLE_LIMIT:
+                Headers.NAME_TABLE[name] = names
+        return names
+
+
+def normal_name(name):
+    """
+    The normal (lowercase) version of a header name, without lowercasing names we've seen before.
+
+    :param str name: The header name
+    :return str
+    """
+    names = Headers.NAME_TABLE.get(name)
+    return names[2] if names is not None else name.lower()
+
+
+for _name in Headers.KNOWN_HEADERS + Headers.ADDR_HEADERS + Headers.DATE_HEADERS + Headers.SINGLE_HEADERS:
+    _normal_name = _name.lower()
+    for _spelling in (_name, _normal_name, string.capwords(_normal_name, '-')):
+        Headers.NAME_TABLE[_spelling] = (_spelling, Headers.get_proper_name(_normal_name), _normal_name)
+
 
 class Header(object):
+    __slots__ = ('_raw_name', '_proper_name', '_normal_name', 'value', 'is_single')
+
     def __init__(self, name=None, value=None):
         self._raw_name = ""
         """
@@ -210,6 +286,4 @@ class Header(object):
 
     @name.setter
     def name(self, name):
-        self._raw_name = name
-        self._proper_name = Headers.get_proper_name(name)
-        self._normal_name = name.lower()
+        self._raw_name, self._proper_name, self._normal_name = Headers.intern_name(name)
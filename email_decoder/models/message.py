@@ -1,8 +1,35 @@
 class Message:
     """
     Represents an email message parsed into useful values.
+
+    Groups of fields can be deferred: they are computed by a loader the first time any of
+    them is read, so consumers only pay for the parts of the message they look at.
     """
+
+    # Fields that are computed together when deferred
+    LAZY_GROUPS = {
+        'headers': (
+            'headers', 'message_id', 'from_addr', 'to_addrs', 'cc_addrs', 'bcc_addrs', 'reply_to_addr',
+            'references', 'message_date'
+        ),
+        'body': ('body_text', 'body_html', 'files', 'truncated')
+    }
+
+    LAZY_FIELDS = dict((field, group) for group, fields in LAZY_GROUPS.items() for field in fields)
+
     def __init__(self):
+        self._loaders = {}
+        """
+        Loaders for deferred field groups that have not been loaded yet
+        :type dict[str, callable]
+        """
+
+        self._defaults = {}
+        """
+        Default values of the deferred fields, restored right before their loader runs
+        :type dict[str, mixed]
+        """
+
         self.subject = ""
         """
         Subject of the email
@@ -66,7 +93,8 @@ class Message:
 
         self.body_text = None
         """
-        Text body, if available.
+        Text body, if available. When the message has no text part, a Parser created with
+        html_text extracts it from the HTML body (see email_decoder.htmltext).
         :type str | None
         """
 
@@ -92,4 +120,66 @@ class Message:
         Headers on the message with their raw string values. Note this differs
         from message.headers in that these are raw string values, whereas headers will be
         parsed into useful values where it makes sense (e.g. email addresses will be Addr lists). 
-        """
\ No newline at end of file
+        """
+
+        self.truncated = None
+        """
+        Set when the message went over one of the parser's limits (see email_decoder.limits) and
+        parsing stopped early, so some of its headers or parts are missing. The limit that was hit:
+        {"reason": "max_parts" | "max_depth" | "max_decoded_bytes" | "max_headers" | "max_seconds",
+        "limit": the limit, "value": what the message got to}
+        :type dict | None
+        """
+
+        self.source_offset = None
+        """
+        When read from a mailbox, where the message starts (a byte offset for mbox files,
+        the unique name of the message for Maildirs).
+        :type int | str | None
+        """
+
+        self.source_end_offset = None
+        """
+        When read from a mailbox, where the next message starts. Pass this to Parser.iter_messages
+        to resume reading after this message.
+        :type int | str | None
+        """
+
+    def defer(self, group, loader):
+        """
+        Defer a group of fields: loader(message) will be called to set them the first time
+        one of them is read. Until then the fields keep their default values.
+
+        :param str group: The group of fields (see LAZY_GROUPS)
+        :param callable loader: Sets the fields on the message it is passed
+        """
+        self._loaders[group] = loader
+        for field in Message.LAZY_GROUPS[group]:
+            self._defaults[field] = self.__dict__.pop(field)
+
+    def load(self):
+        """
+        Run all pending loaders, so no field of the message is deferred anymore.
+        """
+        for group in list(self._loaders):
+            self._load_group(group)
+
+    @property
+    def is_loaded(self):
+        return not self._loaders
+
+    def _load_group(self, group):
+        loader = self._loaders.pop(group, None)
+        for field in Message.LAZY_GROUPS[group]:
+            if field in self._defaults:
+                self.__dict__[field] = self._defaults.pop(field)
+        if loader is not None:
+            loader(self)
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, which is the case for deferred fields
+        group = Message.LAZY_FIELDS.get(name)
+        if group is None or group not in self.__dict__.get('_loaders', ()):
+            raise AttributeError(name)
+        self._load_group(group)
+        return self.__dict__[name]
@@ -1,6 +1,6 @@
 import json
-import msgpack
 from datetime import datetime
+from json.encoder import encode_basestring_ascii
 from email_decoder.models.message import Message
 from email_decoder.models.headers import Headers
 from email_decoder.models.addr import Addr
@@ -8,35 +8,16 @@ from email_decoder.models.file import File
 from flanker.mime.message.headers.wrappers import ContentType
 from flanker.mime.message.headers.wrappers import WithParams
 
+# Fields of a serialized File, in output order
+FILE_FIELDS = ('content_id', 'filename', 'size', 'content_type', 'data', 'is_inline', 'digest')
+
 
 def object_to_dict(obj):
     if isinstance(obj, Message):
-        res = dict()
-        res['subject'] = obj.subject
-        res['message_id'] = obj.message_id
-        res['references'] = obj.references
-        res['from_addr'] = object_to_dict(obj.from_addr) if obj.from_addr else None
-        res['to_addrs'] = object_to_dict(obj.to_addrs) if obj.to_addrs else None
-        res['cc_addrs'] = object_to_dict(obj.cc_addrs) if obj.cc_addrs else None
-        res['bcc_addrs'] = object_to_dict(obj.bcc_addrs) if obj.bcc_addrs else None
-        res['date'] = obj.date.isoformat(' ') if obj.date else None
-        res['message_date'] = obj.message_date.isoformat(' ') if obj.message_date else None
-        res['body_html'] = object_to_dict(obj.body_html)
-        res['body_text'] = object_to_dict(obj.body_text)
-        res['headers'] = object_to_dict(obj.headers)
-        res['raw_headers'] = object_to_dict(obj.raw_headers)
-        res['files'] = object_to_dict(obj.files)
-        return res
+        return dict((k, object_to_dict(v)) for k, v in _message_items(obj))
 
     if isinstance(obj, Headers):
-        res = dict()
-        for (hname, hs) in obj.headers.iteritems():
-            if len(hs) and hs[0].is_single:
-                res[hname] = object_to_dict(hs[0].value)
-            else:
-                res[hname] = [object_to_dict(h.value) for h in hs]
-
-        return res
+        return dict((k, object_to_dict(v)) for k, v in _headers_items(obj))
 
     if isinstance(obj, datetime):
         return obj.isoformat(' ')
@@ -45,7 +26,7 @@ def object_to_dict(obj):
         return {"name": obj.name, "email": obj.email}
 
     if isinstance(obj, File):
-        return obj.__dict__
+        return dict((k, getattr(obj, k)) for k in FILE_FIELDS)
 
     if isinstance(obj, ContentType):
         return {"content_type": obj.__str__(), "main_type": obj.main, "sub_type": obj.sub, "params": obj.params}
@@ -59,12 +40,225 @@ def object_to_dict(obj):
     return obj
 
 
-def message_to_json(message):
-    return json.dumps(object_to_dict(message), indent=4)
+def _message_items(obj):
+    """
+    The (key, value) pairs a Message is serialized as. Values still need converting.
+    """
+    return [
+        ('subject', obj.subject),
+        ('message_id', obj.message_id),
+        ('references', obj.references),
+        ('from_addr', obj.from_addr or None),
+        ('to_addrs', obj.to_addrs or None),
+        ('cc_addrs', obj.cc_addrs or None),
+        ('bcc_addrs', obj.bcc_addrs or None),
+        ('date', obj.date.isoformat(' ') if obj.date else None),
+        ('message_date', obj.message_date.isoformat(' ') if obj.message_date else None),
+        ('body_html', obj.body_html),
+        ('body_text', obj.body_text),
+        ('headers', obj.headers),
+        ('raw_headers', obj.raw_headers),
+        ('files', obj.files),
+        ('truncated', obj.truncated),
+    ]
+
+
+def _headers_items(obj):
+    """
+    The (key, value) pairs a Headers collection is serialized as: single headers map to their
+    value, others to the list of their values. Values still need converting.
+    """
+    items = []
+    for (hname, hs) in obj.headers.iteritems():
+        if len(hs) and hs[0].is_single:
+            items.append((hname, hs[0].value))
+        else:
+            items.append((hname, [h.value for h in hs]))
+    return items
+
+
+class MsgpackEncoder(object):
+    """
+    Packs messages straight into a msgpack Packer, without building the intermediate dict
+    tree object_to_dict does. The output decodes to the same structure.
+    """
+
+    def __init__(self, packer=None):
+        if packer is None:
+            # Only needed for this format, so only imported here
+            import msgpack
+            packer = msgpack.Packer(autoreset=False)
+        self.packer = packer
+
+    def encode(self, obj):
+        packer = self.packer
+        t = type(obj)
+
+        if t in _SCALAR_TYPES:
+            packer.pack(obj)
+        elif t is list or t is tuple:
+            packer.pack_array_header(len(obj))
+            for x in obj:
+                self.encode(x)
+        elif t is dict:
+            packer.pack_map_header(len(obj))
+            for k, v in obj.iteritems():
+                packer.pack(k)
+                self.encode(v)
+        elif isinstance(obj, Message):
+            self._encode_items(_message_items(obj))
+        elif isinstance(obj, Headers):
+            self._encode_items(_headers_items(obj))
+        elif isinstance(obj, Addr):
+            packer.pack_map_header(2)
+            packer.pack("name")
+            packer.pack(obj.name)
+            packer.pack("email")
+            packer.pack(obj.email)
+        elif isinstance(obj, File):
+            packer.pack_map_header(len(FILE_FIELDS))
+            for k in FILE_FIELDS:
+                packer.pack(k)
+                packer.pack(getattr(obj, k))
+        else:
+            obj = object_to_dict(obj)
+            if type(obj) is dict:
+                self.encode(obj)
+            else:
+                packer.pack(obj)
+
+    def _encode_items(self, items):
+        self.packer.pack_map_header(len(items))
+        for k, v in items:
+            self.packer.pack(k)
+            self.encode(v)
+
+    def getvalue(self):
+        """
+        :return str Everything packed so far (and resets the packer)
+        """
+        data = self.packer.bytes()
+        self.packer.reset()
+        return data
+
+
+class JsonEncoder(object):
+    """
+    Writes messages as JSON straight to a write function, without building the intermediate
+    dict tree object_to_dict does. The output decodes to the same structure.
+
+    With indent=None the output is compact (no whitespace at all); otherwise it matches
+    json.dumps(..., indent=indent).
+    """
+
+    def __init__(self, write, indent=None):
+        self.write = write
+        self.indent = indent
+        self.level = 0
+        if indent is None:
+            self.item_separator = ','
+            self.key_separator = ':'
+        else:
+            self.item_separator = ', '
+            self.key_separator = ': '
+
+    def encode(self, obj):
+        write = self.write
+        t = type(obj)
+
+        if t is str or t is unicode:
+            write(encode_basestring_ascii(obj))
+        elif obj is None:
+            write('null')
+        elif obj is True:
+            write('true')
+        elif obj is False:
+            write('false')
+        elif t is int or t is long:
+            write(str(obj))
+        elif t is float:
+            write(json.dumps(obj))
+        elif t is list or t is tuple:
+            self._encode_list(obj)
+        elif t is dict:
+            self._encode_items(obj.items())
+        elif isinstance(obj, Message):
+            self._encode_items(_message_items(obj))
+        elif isinstance(obj, Headers):
+            self._encode_items(_headers_items(obj))
+        elif isinstance(obj, Addr):
+            self._encode_items([("name", obj.name), ("email", obj.email)])
+        elif isinstance(obj, File):
+            self._encode_items([(k, getattr(obj, k)) for k in FILE_FIELDS])
+        else:
+            converted = object_to_dict(obj)
+            if converted is obj:
+                write(json.dumps(obj))
+            else:
+                self.encode(converted)
+
+    def _newline(self):
+        if self.indent is not None:
+            self.write('\n' + ' ' * (self.indent * self.level))
+
+    def _encode_list(self, values):
+        if not values:
+            self.write('[]')
+            return
+
+        self.write('[')
+        self.level += 1
+        first = True
+        for v in values:
+            if not first:
+                self.write(self.item_separator)
+            first = False
+            self._newline()
+            self.encode(v)
+        self.level -= 1
+        self._newline()
+        self.write(']')
+
+    def _encode_items(self, items):
+        if not items:
+            self.write('{}')
+            return
+
+        write = self.write
+        write('{')
+        self.level += 1
+        first = True
+        for k, v in items:
+            if not first:
+                write(self.item_separator)
+            first = False
+            self._newline()
+            write(encode_basestring_ascii(k))
+            write(self.key_separator)
+            self.encode(v)
+        self.level -= 1
+        self._newline()
+        write('}')
+
+
+_SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+def message_to_json(message, compact=False):
+    """
+    :param email_decoder.models.message.Message message: The message to serialize
+    :param bool compact: Leave out all whitespace instead of indenting with 4 spaces
+    :return str
+    """
+    out = []
+    JsonEncoder(out.append, indent=None if compact else 4).encode(message)
+    return ''.join(out)
 
 
 def message_to_msgpack(message):
-    return msgpack.packb(object_to_dict(message))
+    encoder = MsgpackEncoder()
+    encoder.encode(message)
+    return encoder.getvalue()
 
 
 def addr_to_str(addr):
@@ -100,3 +294,7 @@ def message_to_debug_out(message):
         print("Attachments:")
         for f in message.files:
             print("  * %s (%s bytes) -- %s" % (f.filename, f.size, f.content_type))
+
+    if message.truncated:
+        print('\n')
+        print("Truncated: %(reason)s (%(value)s over the limit of %(limit)s)" % message.truncated)
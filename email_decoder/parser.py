@@ -1,80 +1,392 @@
 import mimetypes
 import binascii
+import hashlib
 import rfc822
 import uuid
+import quopri
+import time
+from itertools import islice
 from datetime import datetime
 from email_decoder.models.message import Message
 from email_decoder.models.addr import Addr
+from email_decoder.models.addr import validate_email_address
 from email_decoder.models.file import File
 from flanker.mime.message.headers.encodedword import decode
 from flanker import mime
+from flanker.mime.message.headers import MimeHeaders
+from flanker.mime.message.charsets import convert_to_unicode
+from cStringIO import StringIO
 from ordered_set import OrderedSet
-import itertools
 from email_decoder.models.headers import Headers
-from email.utils import parsedate_tz
-from email.utils import mktime_tz
-import structlog
+from email_decoder.sources import iter_raw_messages
+from email_decoder.filestore import FileStore
+from email_decoder.filestore import NullFileStore
+from email_decoder.cache import LRUCache
+from email_decoder.dates import parse_date
+from email_decoder.dates import parse_received_date
+from email_decoder.dates import received_date_string
+from email_decoder.limits import LimitExceeded
+from email_decoder.mapped import map_file
+from email_decoder.mapped import scan_buffer
+from email_decoder.scanner import scan_parts
+from email_decoder.scanner import PartTable
+from email_decoder.scanner import ScannedPart
+from email_decoder.htmltext import html_to_text
+
+# Bump whenever a change makes the parser produce a different Message for the same input, so
+# results cached by an older version are not used (see email_decoder.resultcache)
+PARSER_VERSION = 1
+
+# How the structure of a message can be found (see Parser.engine)
+ENGINES = ('flanker', 'scanner')
+
+# How body_text can be derived from the HTML body of messages without a text/plain part (see
+# Parser.html_text): all of the text, or only the reply (without quotes and signature)
+HTML_TEXT_MODES = ('full', 'reply')
+
+# Errors flanker (and the decoding it does) can raise for a malformed message or part
+PARSE_ERRORS = (mime.DecodingError, AttributeError, RuntimeError, TypeError, binascii.Error, UnicodeDecodeError)
+
+# Cached in place of a date for values that aren't dates
+_INVALID_DATE = object()
+
+# How much of a raw body is read at a time when streaming attachments into a FileStore
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# Charsets in which pure ASCII bytes mean the same as in UTF-8
+ASCII_COMPATIBLE_CHARSETS = frozenset([
+    'ascii', 'us-ascii', 'utf-8', 'utf8',
+    'iso-8859-1', 'iso-8859-2', 'iso-8859-15', 'latin1', 'latin-1',
+    'windows-1250', 'windows-1251', 'windows-1252', 'cp1252',
+])
+
+# Deleting these with str.translate leaves only the non-ASCII bytes (much faster than a regex search)
+_ASCII_BYTES = ''.join(chr(i) for i in xrange(128))
+
+# Everything but the base64 alphabet and its padding, which binascii skips anyway
+_BASE64_SKIPPED = ''.join(
+    chr(i) for i in xrange(256)
+    if not (chr(i).isalnum() and i < 128) and chr(i) not in '+/=')
+
+
+class _DefaultLogger(object):
+    """
+    structlog's default logger, only created once something is logged: importing structlog takes
+    longer than parsing most messages, and most runs never log anything.
+    """
+
+    def __init__(self):
+        self._logger = None
+
+    def __getattr__(self, name):
+        if self._logger is None:
+            import structlog
+            self._logger = structlog.get_logger()
+        return getattr(self._logger, name)
 
 
 class Parser:
-    def __init__(self, logger=None, filestore=None):
+    def __init__(self, logger=None, filestore=None, lazy=False, address_cache_size=10000, metrics=None, date_cache_size=10000, limits=None,
+                 result_cache=None, engine='flanker', html_text=None):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine: %s" % engine)
+        if html_text is not None and html_text not in HTML_TEXT_MODES:
+            raise ValueError("Unknown HTML text mode: %s" % html_text)
+
         if logger is None:
-            logger = structlog.get_logger()
+            logger = _DefaultLogger()
 
         self.logger = logger
 
         if filestore is None:
-            def filestore(f):
-                return "<no store>"
+            filestore = NullFileStore()
 
         self.filestore = filestore
 
+        # When lazy, the parsed headers (and the fields derived from them) and the body
+        # are only parsed when they are first accessed on the Message
+        self.lazy = lazy
+
+        # Caches for address header values (raw value -> list of (name, email)) and address
+        # validity (email -> bool). The same senders and recipients show up over and over.
+        self.address_cache = LRUCache(address_cache_size)
+        self.address_validity_cache = LRUCache(address_cache_size)
+
+        # Cache for date strings (value -> datetime, or _INVALID_DATE). Received headers of
+        # messages that went through the same relays around the same time repeat a lot.
+        self.date_cache = LRUCache(date_cache_size)
+
+        # Optional email_decoder.metrics.Metrics receiving per-stage timings, counts and errors.
+        # Every instrumentation point checks for None first, so leaving it off costs next to nothing.
+        self.metrics = metrics
+
+        # Optional email_decoder.limits.Limits: per-message budgets after which parsing stops
+        # and a partial Message is returned (with Message.truncated set)
+        self.limits = limits
+
+        # Optional email_decoder.resultcache.ResultCache: message_from_bytes reads results back from it
+        # instead of parsing messages it has seen before
+        self.result_cache = result_cache
+        self._result_cache_prefix = None
+
+        # How message_from_bytes and message_from_path find the parts of a message: 'flanker' (its
+        # scanner builds a tree of MimeParts) or 'scanner' (email_decoder.scanner only looks for the
+        # declared boundaries and builds a flat part table; it leaves what it can't handle to flanker)
+        self.engine = engine
+
+        # Optional, one of HTML_TEXT_MODES: when a message has HTML but no text/plain part, its
+        # body_text is extracted from the HTML (see email_decoder.htmltext)
+        self.html_text = html_text
+
     def message_from_mimepart(self, mimepart):
+        if self.metrics is not None:
+            self.metrics.start_message()
+        return self._message_from_mimepart(mimepart)
+
+    def _message_from_mimepart(self, mimepart):
+        msg = self._message_from_mime_headers(mimepart.headers)
+
+        if self.lazy:
+            msg.defer('body', lambda m: self._load_body(m, mimepart))
+        else:
+            self._load_body(msg, mimepart)
+
+        if self.metrics is not None:
+            self.metrics.end_message(msg.raw_headers.get_header_value('Message-ID'))
+
+        return msg
+
+    def message_from_bytes(self, raw):
+        """
+        Parses a complete raw message. The input should be the bytes of the message exactly as
+        they were received (e.g. read from a file opened in binary mode); text bodies are decoded
+        straight from them to the UTF-8 bytes of the output.
+
+        :param str raw: The raw message
+        :return email_decoder.models.message.Message
+        """
+        return self._message_from_buffer(raw, mime.from_string)
+
+    def message_from_path(self, path):
+        """
+        Parses the raw message in a file without reading the file into memory: the file is mapped,
+        and only the headers and bodies that are needed are read from it (when lazy, not before they
+        are first accessed). Meant for very large messages.
+
+        :param str path: Path of the raw message
+        :return email_decoder.models.message.Message
+        """
+        return self._message_from_buffer(map_file(path), scan_buffer)
+
+    def _message_from_buffer(self, raw, scan_raw):
+        if self.result_cache is None:
+            return self._message_from_mimepart(self._scan(raw, scan_raw))
+
+        # Only imported when there is a cache (it needs msgpack and sqlite3)
+        from email_decoder.resultcache import pack_message
+        from email_decoder.resultcache import unpack_message
+
+        key = self.result_cache_key(raw)
+        data = self.result_cache.get(key)
+        if data is not None:
+            if self.metrics is not None:
+                self.metrics.count('result_cache_hits')
+            return unpack_message(data)
+
+        mimepart = self._scan(raw, scan_raw)
+        msg = self._message_from_mimepart(mimepart)
+        # Whether a message runs out of time depends on the machine, not the message
+        if msg.truncated is None or msg.truncated['reason'] != 'max_seconds':
+            msg.load()
+            self.result_cache.put(key, pack_message(msg, mimepart.headers.keys()))
+        return msg
+
+    def _scan(self, raw, scan_raw):
+        # Finding the parts is the first stage of the message
+        if self.metrics is not None:
+            self.metrics.start_message()
+        try:
+            return self._scan_structure(raw, scan_raw)
+        except mime.DecodingError as e:
+            # flanker gives up on messages with thousands of parts before any Limits apply. The
+            # scanner can still find the first parts, so a partial Message is returned.
+            if not str(e).startswith('Too many parts'):
+                raise
+            table = scan_parts(raw, truncate=True)
+            if table is None:
+                raise
+            return table
+
+    def _scan_structure(self, raw, scan_raw):
+        if self.engine == 'scanner':
+            start = time.time() if self.metrics is not None else 0
+            table = scan_parts(raw)
+            if self.metrics is not None:
+                self.metrics.timing('scan', time.time() - start)
+            if table is not None:
+                return table
+            if self.metrics is not None:
+                self.metrics.count('scanner_fallbacks')
+        return scan_raw(raw)
+
+    def result_cache_key(self, raw):
+        """
+        The key of a message in the result cache: a hash of the raw message and everything about the
+        parser that changes the result (its version, limits, filestore and HTML text mode).
+
+        :param str|mmap.mmap raw: The raw message
+        :return str
+        """
+        if self._result_cache_prefix is None:
+            limits = self.limits
+            self._result_cache_prefix = repr((
+                PARSER_VERSION,
+                sorted(vars(limits).items()) if limits is not None else None,
+                type(self.filestore).__name__, getattr(self.filestore, 'root', None),
+                self.html_text
+            ))
+        # Not md5: messages come from anyone, and colliding ones could poison the cache
+        key = hashlib.sha256(self._result_cache_prefix)
+        key.update(raw)
+        return key.digest()
+
+    def headers_from_bytes(self, raw):
+        """
+        Header-only fast path: builds a Message from just the header block of a raw message. Parsing
+        stops at the blank line that ends the headers; the body is never read or decoded, so the body
+        fields and files of the returned Message are left empty.
+
+        :param str raw: The raw message (or just its headers)
+        :return email_decoder.models.message.Message
+        """
+        return self.headers_from_file(StringIO(raw))
+
+    def headers_from_file(self, fp):
+        """
+        Like headers_from_bytes, but reads from a file object. Nothing past the end of the header
+        block is read (beyond what the file object buffers).
+
+        :param file fp: The raw message, positioned at its first header
+        :return email_decoder.models.message.Message
+        """
+        if self.metrics is not None:
+            self.metrics.start_message()
+
+        msg = self._message_from_mime_headers(MimeHeaders.from_stream(fp))
+
+        if self.metrics is not None:
+            self.metrics.end_message(msg.raw_headers.get_header_value('Message-ID'))
+
+        return msg
+
+    def _message_from_mime_headers(self, mime_headers):
         msg = Message()
-        msg.raw_headers = headers_from_mimepart(mimepart)
-        msg.headers = self.parsed_headers_from_raw_headers(msg.raw_headers)
-        msg.subject = mimepart.subject
+        max_headers = self.limits.max_headers if self.limits is not None else None
+        if max_headers is not None and len(mime_headers) > max_headers:
+            self._truncate(msg, LimitExceeded('max_headers', max_headers, len(mime_headers)))
+            msg.raw_headers = headers_from_mime_headers(mime_headers, max_headers)
+        else:
+            msg.raw_headers = headers_from_mime_headers(mime_headers)
+        msg.subject = mime_headers.get('Subject', '')
         msg.date = datetime.utcnow()
-        msg.message_id = msg.headers.get_header_value('Message-ID') or None
-        msg.from_addr = msg.headers.get_header_value('From') or None
-        msg.to_addrs = msg.headers.get_header_values('To') or None
-        msg.cc_addrs = msg.headers.get_header_values('CC') or None
-        msg.bcc_addrs = msg.headers.get_header_values('BCC') or None
-        msg.reply_to_addr = msg.headers.get_header_value('Reply-To') or None
+
+        if self.lazy:
+            msg.defer('headers', self._load_headers)
+        else:
+            self._load_headers(msg)
+
+        return msg
+
+    def _load_headers(self, msg):
+        start = time.time() if self.metrics is not None else 0
+        msg.headers = self.parsed_headers_from_raw_headers(msg.raw_headers)
+        if self.metrics is not None:
+            self.metrics.timing('headers', time.time() - start)
+
+        # Read straight from the collection's index (normal name -> headers) instead of going
+        # through the name-normalising accessors for every field
+        index = msg.headers.headers
+        msg.message_id = _first_value(index, 'message-id') or None
+        msg.from_addr = _first_value(index, 'from') or None
+        msg.to_addrs = _values(index, 'to') or None
+        msg.cc_addrs = _values(index, 'cc') or None
+        msg.bcc_addrs = _values(index, 'bcc') or None
+        msg.reply_to_addr = _first_value(index, 'reply-to') or None
 
         # Read references
-        msg.references = parse_references_hval_list(list(itertools.chain.from_iterable([
-            msg.headers.get_header_values('In-Reply-To') or [],
-            msg.headers.get_header_values('References') or []
-        ])))
-
-        if msg.headers.has_header('Date'):
-            msg.message_date = msg.headers.get_header_value('Date') or None
-        elif msg.headers.has_header('Received'):
-            received_hval = msg.headers.get_header_value('Received')
-            try:
-                msg.message_date = parse_date_from_received_hval(received_hval)
-            except ValueError:
-                msg.message_date = None
-                self.logger.warning("Failed to parse date", tag="invalid_date_header", hname="Received", date_string=received_hval)
+        msg.references = parse_references_hval_list(_values(index, 'in-reply-to') + _values(index, 'references'))
+
+        if 'date' in index:
+            msg.message_date = _first_value(index, 'date') or None
+        elif 'received' in index:
+            # Use the most recent hop that has a valid date
+            received_hvals = _values(index, 'received')
+            start = time.time() if self.metrics is not None else 0
+            msg.message_date = None
+            for received_hval in received_hvals:
+                try:
+                    msg.message_date = self._parse_date_hval(received_date_string(received_hval))
+                    break
+                except ValueError:
+                    pass
+            else:
+                self.logger.warning("Failed to parse date", tag="invalid_date_header", hname="Received", date_string=received_hvals[0])
+                self._metrics_error("invalid_date_header")
+            if self.metrics is not None:
+                self.metrics.timing('date', time.time() - start)
 
-        if msg.headers.has_header('MIME-Version'):
-            mime_version = msg.headers.get_header('MIME-Version').value.lower()
+        if 'mime-version' in index:
+            mime_version = _first_value(index, 'mime-version').lower()
             if not mime_version.startswith('1.0'):
-                self.logger.warning("Unexpected MIME-Version", tag=unexpected_mime_version, hname="MIME-Version", mime_version=mime_version)
+                self.logger.warning("Unexpected MIME-Version", tag="unexpected_mime_version", hname="MIME-Version", mime_version=mime_version)
+                self._metrics_error("unexpected_mime_version")
 
+    def _load_body(self, msg, mimepart):
+        start = time.time() if self.metrics is not None else 0
         state = ParserState()
         self._walk_parts(state, mimepart)
+        if self.metrics is not None:
+            self.metrics.timing('walk_parts', time.time() - start)
+
+        if state.limit_exceeded is not None:
+            self._truncate(msg, state.limit_exceeded)
 
         if state.html_parts:
             msg.body_html = ''.join(state.html_parts)
         if state.text_parts:
             msg.body_text = '\n'.join(state.text_parts)
+        elif state.html_parts and self.html_text is not None:
+            start = time.time() if self.metrics is not None else 0
+            msg.body_text = html_to_text(state.html_parts, strip_quotes=self.html_text == 'reply') or None
+            if self.metrics is not None:
+                self.metrics.timing('html_text', time.time() - start)
         if state.attachments:
             for f in state.attachments:
                 msg.files.append(f)
 
-        return msg
+    def iter_messages(self, source, offset=0):
+        """
+        Reads a mailbox incrementally, yielding one parsed Message at a time. Only the message
+        currently being parsed is held in memory. Messages that fail to parse are logged and skipped.
+
+        Each message has source_offset and source_end_offset set. To resume a run that stopped,
+        pass the source_end_offset of the last message that was completely handled.
+
+        :param str source: Path to an mbox file or a Maildir directory
+        :param int|str offset: Where to start reading (see email_decoder.sources)
+        :return generator[email_decoder.models.message.Message]
+        """
+        for start, end, raw in iter_raw_messages(source, offset):
+            try:
+                msg = self.message_from_bytes(raw)
+            except PARSE_ERRORS as e:
+                self.logger.error('Error parsing message from mailbox', source=source, offset=start, error=e)
+                self._metrics_error("invalid_message")
+                continue
+
+            msg.source_offset = start
+            msg.source_end_offset = end
+            yield msg
 
     def parsed_headers_from_raw_headers(self, raw_headers):
         """
@@ -82,57 +394,153 @@ class Parser:
         and copies them into a collection where the headers are parsed into more
         meaningful values (e.g. email addresses are split).
 
+        Each header name is looked up once in Headers.HEADER_KINDS and handled accordingly.
+
         :param email_decoder.models.headers.Headers raw_headers: Collection of raw headers
         :return email_decoder.models.headers.Headers
         """
         headers = Headers()
-        done_headers = set()
-
-        for hname in Headers.ADDR_HEADERS:
-            done_headers.add(hname.lower())
-            hs = raw_headers.get_headers(hname)
-            if hs:
-                addresses = parse_address_hval_list([h.value for h in hs])
-                for name, email in addresses:
-                    addr = Addr(email, name)
-                    if addr.is_valid:
-                        headers.add_header_value(hname, addr)
-                    else:
-                        self.logger.warning("Invalid email address", tag=invalid_email_address, hname=hname, email_address=addr.email)
-
-        for hname in Headers.DATE_HEADERS:
-            done_headers.add(hname.lower())
-            hs = raw_headers.get_headers(hname)
-            if hs:
-                for h in hs:
-                    try:
-                        date = parse_date_hval(h.value)
-                        headers.add_header_value(hname, date, is_single=True)
-                        break  # we only want a single date value
-                    except ValueError:
-                        self.logger.warning("Could not parse date", tag="invalid_date_header", hname=hname, date_string=h.value)
+        kinds = Headers.HEADER_KINDS
+        metrics = self.metrics
+        addr_seconds = 0.0
+        date_seconds = 0.0
 
         for hname, hs in raw_headers.headers.iteritems():
-            if hname.lower() not in done_headers:
-                for h in hs:
-                    headers.add_header_value(hname, h.value)
+            kind = kinds.get(hname, Headers.KIND_PASSTHROUGH)
+
+            if kind is Headers.KIND_PASSTHROUGH:
+                headers.add_copies(hs)
+            elif kind is Headers.KIND_ADDR:
+                start = time.time() if metrics is not None else 0
+                self._add_addr_headers(headers, Headers.get_proper_name(hname), hs)
+                if metrics is not None:
+                    addr_seconds += time.time() - start
+            else:
+                start = time.time() if metrics is not None else 0
+                self._add_date_header(headers, Headers.get_proper_name(hname), hs)
+                if metrics is not None:
+                    date_seconds += time.time() - start
 
-        # From header is a single value
-        from_header = headers.get_header('From')
-        if from_header:
-            from_header.is_single = True
+        if metrics is not None:
+            metrics.timing('address', addr_seconds)
+            metrics.timing('date', date_seconds)
 
         return headers
 
-    def _walk_parts(self, state, mimepart):
-        for part in mimepart.walk(with_self=mimepart.content_type.is_singlepart()):
+    def _add_addr_headers(self, headers, hname, hs):
+        addresses = self._parse_address_hval_list([h.value for h in hs])
+        for name, email in addresses:
+            addr = Addr(email, name)
+            if self._is_valid_email_address(addr.email):
+                # From header is a single value
+                headers.add_header_value(hname, addr, is_single=hname == 'From')
+            else:
+                self.logger.warning("Invalid email address", tag="invalid_email_address", hname=hname, email_address=addr.email)
+                self._metrics_error("invalid_email_address")
+
+    def _add_date_header(self, headers, hname, hs):
+        for h in hs:
             try:
-                if part.content_type.is_multipart():
-                    continue
-                self._parse_parts(state, part)
-            except (mime.DecodingError, AttributeError, RuntimeError, TypeError, binascii.Error, UnicodeDecodeError) as e:
-                self.logger.error('Error parsing message MIME parts', error=e)
-                state.mark_error()
+                date = self._parse_date_hval(h.value)
+                headers.add_header_value(hname, date, is_single=True)
+                break  # we only want a single date value
+            except ValueError:
+                self.logger.warning("Could not parse date", tag="invalid_date_header", hname=hname, date_string=h.value)
+                self._metrics_error("invalid_date_header")
+
+    def _parse_date_hval(self, hval):
+        """
+        Same as parse_date_hval, but each value is only parsed once per cache lifetime.
+        """
+        date = self.date_cache.get(hval)
+        if date is None:
+            try:
+                date = parse_date(hval)
+            except ValueError:
+                date = _INVALID_DATE
+            self.date_cache.put(hval, date)
+
+        if date is _INVALID_DATE:
+            raise ValueError("Not a date: %r" % hval)
+        return date
+
+    def _parse_address_hval_list(self, addr_hvals):
+        """
+        Same as parse_address_hval_list, but each header value is only parsed once per cache lifetime.
+        """
+        addresses = set()
+        for hval in addr_hvals:
+            parsed = self.address_cache.get(hval)
+            if parsed is None:
+                parsed = tuple(parse_address_hval(hval))
+                self.address_cache.put(hval, parsed)
+            addresses.update(parsed)
+
+        return sorted(elem for elem in addresses)
+
+    def _is_valid_email_address(self, email_address):
+        is_valid = self.address_validity_cache.get(email_address)
+        if is_valid is None:
+            is_valid = validate_email_address(email_address)
+            self.address_validity_cache.put(email_address, is_valid)
+        return is_valid
+
+    def cache_stats(self):
+        """
+        :return dict Stats of the parser's caches, by cache name
+        """
+        stats = {
+            "address": self.address_cache.stats(),
+            "address_validity": self.address_validity_cache.stats(),
+            "date": self.date_cache.stats()
+        }
+        if self.result_cache is not None:
+            stats["result"] = self.result_cache.stats()
+        return stats
+
+    def _metrics_error(self, tag):
+        if self.metrics is not None:
+            self.metrics.error(tag)
+
+    def _truncate(self, msg, limit_exceeded):
+        # Only the first limit that was hit is reported
+        if msg.truncated is None:
+            msg.truncated = limit_exceeded.as_dict()
+        self.logger.warning("Message truncated", tag="limit_exceeded", reason=limit_exceeded.reason,
+                            limit=limit_exceeded.limit, value=limit_exceeded.value)
+        self._metrics_error("limit_exceeded")
+
+    def _walk_parts(self, state, mimepart):
+        budget = self.limits.budget() if self.limits is not None else None
+        if isinstance(mimepart, PartTable):
+            parts = mimepart.walk()
+        else:
+            parts = walk_with_depth(mimepart, with_self=mimepart.content_type.is_singlepart())
+        try:
+            for part, depth in parts:
+                if budget is not None:
+                    budget.add_part(depth)
+                try:
+                    if part.content_type.is_multipart():
+                        continue
+                    if part.content_type.is_message_container():
+                        # Its enclosed parts come next in the walk; it isn't stored as a file of its own
+                        continue
+                    if budget is not None:
+                        budget.add_decoded_bytes(estimated_decoded_size(part))
+                    if self.metrics is not None:
+                        self.metrics.count('parts')
+                    self._parse_parts(state, part)
+                except PARSE_ERRORS as e:
+                    self.logger.error('Error parsing message MIME parts', error=e)
+                    self._metrics_error("invalid_mime_part")
+                    state.mark_error()
+        except LimitExceeded as e:
+            # Keep what was parsed so far
+            state.limit_exceeded = e
+        else:
+            if isinstance(mimepart, PartTable) and mimepart.truncated is not None:
+                state.limit_exceeded = mimepart.truncated
 
     def _parse_parts(self, state, mimepart):
         disposition, _ = mimepart.content_disposition
@@ -143,73 +551,351 @@ class Parser:
         if filename == '':
             filename = None
 
-        data = mimepart.body
-
         is_text = content_type.startswith('text')
         if disposition not in (None, 'inline', 'attachment'):
             self.logger.error('Unknown Content-Disposition',  bad_content_disposition=mimepart.content_disposition)
+            self._metrics_error("bad_content_disposition")
             state.mark_error()
             return
 
         if disposition == 'attachment':
-            self._save_attachment(state, data, disposition, content_type, filename, content_id)
+            self._save_attachment(state, mimepart, disposition, content_type, filename, content_id)
             return
 
         if disposition == 'inline' and not (is_text and filename is None and content_id is None):
             # the extra logic above is to catch edge-cases where the mailer
             # sets Content-Disposition: on text body parts. These arent attachments, they're body parts
-            self._save_attachment(state, data, disposition, content_type, filename, content_id)
+            self._save_attachment(state, mimepart, disposition, content_type, filename, content_id)
             return
 
         if is_text:
+            if content_type not in ('text/html', 'text/plain'):
+                self.logger.info('Saving other text MIME part as attachment', content_type=content_type)
+                self._save_attachment(state, mimepart, 'attachment', content_type, filename, content_id)
+                return
+            start = time.time() if self.metrics is not None else 0
+            data = text_body_bytes(mimepart)
             if data is None:
                 return
-            normalized_data = data.encode('utf-8', 'strict')
-            normalized_data = normalized_data.replace('\r\n', '\n').replace('\r', '\n')
+            normalized_data = normalize_newlines(data)
+            if self.metrics is not None:
+                self.metrics.timing('text', time.time() - start)
+                self.metrics.count('text_bytes', len(normalized_data))
             if content_type == 'text/html':
                 state.html_parts.append(normalized_data)
-            elif content_type == 'text/plain':
-                state.text_parts.append(normalized_data)
             else:
-                self.logger.info('Saving other text MIME part as attachment', content_type=content_type)
-                self._save_attachment(state, data, 'attachment', content_type, filename, content_id)
+                state.text_parts.append(normalized_data)
             return
 
         # Finally, if we get a non-text MIME part without Content-Disposition,
         # treat it as an attachment.
-        self._save_attachment(state, data, 'attachment', content_type, filename, content_id)
-
-    def _save_attachment(self, state, data, disposition, content_type, filename, content_id):
-        if filename is None:
-            mimetypes.init()
-            ext = mimetypes.guess_extension(content_type) or ""
-            filename = str(uuid.uuid4()) + ext
+        self._save_attachment(state, mimepart, 'attachment', content_type, filename, content_id)
 
+    def _save_attachment(self, state, mimepart, disposition, content_type, filename, content_id):
         f = File()
         f.content_id = content_id
         f.filename = filename
-        f.size = len(data)
         f.content_type = content_type
         f.is_inline = disposition == "inline"
-        f.data = self.filestore(data)
+
+        start = time.time() if self.metrics is not None else 0
+        if isinstance(self.filestore, FileStore):
+            # Stream the part into the store as it is decoded
+            writer = self.filestore.open(content_type, filename)
+            try:
+                for chunk in iter_decoded_body(mimepart):
+                    writer.write(chunk)
+            except Exception:
+                writer.abort()
+                raise
+            f.data = writer.close()
+            f.size = writer.size
+            f.digest = writer.digest
+        else:
+            data = mimepart.body
+            f.size = len(data)
+            f.data = self.filestore(data)
+
+        if self.metrics is not None:
+            self.metrics.timing('filestore', time.time() - start)
+            self.metrics.count('attachments')
+            self.metrics.observe('attachment_size', f.size)
+
+        if f.filename is None:
+            # Name unnamed files after their contents when we can, so the same file
+            # always gets the same name
+            mimetypes.init()
+            ext = mimetypes.guess_extension(content_type) or ""
+            f.filename = (f.digest[:32] if f.digest else str(uuid.uuid4())) + ext
 
         state.attachments.append(f)
 
 
+def _first_value(index, normal_name):
+    hs = index.get(normal_name)
+    return hs[0].value if hs else None
+
+
+def _values(index, normal_name):
+    hs = index.get(normal_name)
+    return [h.value for h in hs] if hs else []
+
+
 class ParserState:
     def __init__(self):
         self.html_parts = []
         self.text_parts = []
         self.attachments = []
         self.is_error = False
+        self.limit_exceeded = None
 
     def mark_error(self):
         self.is_error = True
 
 
+def walk_with_depth(mimepart, with_self=False):
+    """
+    Walks the parts in the same order as flanker's MimePart.walk, along with how deeply each part
+    is nested (the parts of the top level part are at 1). Doesn't recurse, so it copes with any depth,
+    and the children of a part are only looked at once the walk moves on from it.
+
+    :param flanker.mime.message.part.MimePart mimepart: The part to walk
+    :param bool with_self: Include the top level part itself (at 0)
+    :return generator[tuple[flanker.mime.message.part.MimePart, int]]
+    """
+    if with_self:
+        yield mimepart, 0
+
+    stack = [(iter(_child_parts(mimepart)), 1)]
+    while stack:
+        children, depth = stack[-1]
+        part = next(children, None)
+        if part is None:
+            stack.pop()
+            continue
+        yield part, depth
+        stack.append((iter(_child_parts(part)), depth + 1))
+
+
+def _child_parts(mimepart):
+    content_type = mimepart.content_type
+    if content_type.is_multipart():
+        return mimepart.parts
+    if content_type.is_message_container():
+        return [mimepart.enclosed]
+    return []
+
+
+def estimated_decoded_size(mimepart):
+    """
+    Estimates the size of a part's decoded body from its raw body, without decoding it.
+
+    :param flanker.mime.message.part.MimePart mimepart: A singlepart mime part
+    :return int
+    """
+    body_range = raw_body_range(mimepart)
+    if body_range is None:
+        body = mimepart.body
+        return len(body) if body is not None else 0
+
+    _, body_start, end = body_range
+    size = end - body_start + 1
+    if mimepart.content_encoding.value.lower() == 'base64':
+        return size * 3 // 4
+    return size
+
+
+def raw_body_range(mimepart):
+    """
+    Where a part's raw body is in the message it was scanned from.
+
+    :param flanker.mime.message.part.MimePart|email_decoder.scanner.ScannedPart mimepart: A singlepart mime part
+    :return tuple[file, int, int]|None The message's stream and the offsets of the first and last byte of
+        the body, or None when the part isn't backed by a message (e.g. a part built in code)
+    """
+    if isinstance(mimepart, ScannedPart):
+        return mimepart.stream, mimepart.body_start, mimepart.end
+
+    container = mimepart._container
+    stream = getattr(container, 'stream', None)
+    if stream is None:
+        return None
+    container.headers  # makes sure the headers are parsed, so we know where the body starts
+    return stream, container._body_start, container.end
+
+
+def text_body_bytes(mimepart):
+    """
+    Decodes a text part's body to UTF-8 bytes, giving the same result as encoding flanker's
+    unicode mimepart.body. Bodies that are pure ASCII in an ASCII-compatible charset already are
+    valid UTF-8, so they skip the round trip through unicode. The decoded body is not cached on
+    the part either, so it doesn't stay in memory for as long as the message does.
+
+    :param flanker.mime.message.part.MimePart mimepart: A singlepart text mime part
+    :return str|None
+    """
+    body_range = raw_body_range(mimepart)
+    if body_range is None:
+        data = mimepart.body
+        return data.encode('utf-8', 'strict') if data is not None else None
+
+    # With a single chunk covering the whole body, the join doesn't copy
+    data = ''.join(iter_decoded_body(mimepart, body_range[2] + 1))
+
+    content_type = mimepart.content_type
+    charset = content_type.get_charset()
+    if charset in ASCII_COMPATIBLE_CHARSETS and not data.translate(None, _ASCII_BYTES):
+        return data
+
+    text = convert_to_unicode(charset, data)
+    if content_type.sub == 'html' and charset == 'utf-8':
+        # flanker works around an Outlook bug with non-breaking spaces in HTML
+        text = text.replace(u'\xa0', u'&nbsp;')
+    return text.encode('utf-8', 'strict')
+
+
+def normalize_newlines(data):
+    """
+    Converts CRLF and bare CR line endings to LF. Only copies the data when there is something
+    to convert, and only once when all line endings are CRLF (bare CRs are rare).
+
+    :param str data:
+    :return str
+    """
+    if '\r' not in data:
+        return data
+    data = data.replace('\r\n', '\n')
+    if '\r' in data:
+        data = data.replace('\r', '\n')
+    return data
+
+
+def iter_decoded_body(mimepart, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Decodes the transfer encoding of a single part's body incrementally, reading the raw body from
+    the message in chunks of about chunk_size bytes. Bodies are not charset-decoded: the chunks are
+    the bytes of the file as they were sent.
+
+    :param flanker.mime.message.part.MimePart mimepart: The (singlepart) mime part
+    :param int chunk_size: How many raw bytes to read at a time
+    :return generator[str]
+    """
+    body_range = raw_body_range(mimepart)
+    if body_range is None:
+        # Not backed by the original message (e.g. a part built in code); the body is
+        # already in memory so hand it over in chunks
+        data = mimepart.body or ''
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        for i in xrange(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+        return
+
+    encoding = mimepart.content_encoding.value.lower()
+    stream, body_start, end = body_range
+    remaining = end - body_start + 1
+    position = body_start
+
+    base64 = _Base64Decoder() if encoding == 'base64' else None
+    pending = ''
+    while remaining > 0:
+        # The stream is shared with the rest of the message, so seek before every read
+        stream.seek(position)
+        raw = stream.read(min(chunk_size, remaining))
+        if not raw:
+            break
+        position += len(raw)
+        remaining -= len(raw)
+
+        if base64 is not None:
+            data = base64.decode(raw)
+            if data:
+                yield data
+            if base64.done:
+                return
+        elif encoding == 'quoted-printable':
+            # Only decode complete lines so soft line breaks are never split
+            pending += raw
+            line_end = pending.rfind('\n') + 1
+            if line_end:
+                yield quopri.decodestring(pending[:line_end])
+                pending = pending[line_end:]
+        else:
+            yield raw
+
+    if base64 is not None:
+        data = base64.flush()
+        if data:
+            yield data
+    elif pending:
+        yield quopri.decodestring(pending)
+
+
+class _Base64Decoder(object):
+    """
+    Decodes base64 incrementally, with the same result flanker gets from the whole body: it first
+    tries binascii.a2b_base64, which skips anything outside the alphabet, ignores padding that
+    can't end a group and stops at the first that can. When that fails for lack of padding, it
+    decodes all the characters of the alphabet, ignoring all padding and dropping a single
+    dangling character. Both agree up to the first padding that ends the data, so chunks can be
+    decoded as they come.
+    """
+
+    def __init__(self):
+        # Characters of the alphabet not decoded yet (less than a group of 4 between chunks)
+        self.pending = ''
+        # The last chunk ended with padding after two characters of a group, which ends the data
+        # only when the next character is padding too
+        self.pad_waiting = False
+        self.done = False
+
+    def decode(self, raw):
+        """
+        :param str raw: The next chunk of the encoded body
+        :return str The bytes decoded so far
+        """
+        pieces = raw.translate(None, _BASE64_SKIPPED).split('=')
+        kept = [self.pending]
+        group = len(self.pending) % 4
+        if self.pad_waiting and len(pieces) > 1 and not pieces[0]:
+            return self._end(kept)
+
+        for i, piece in enumerate(pieces):
+            # Every piece after the first follows padding
+            if i and (group == 3 or (group == 2 and not piece and i + 1 < len(pieces))):
+                return self._end(kept)
+            if piece:
+                self.pad_waiting = False
+            elif i and group == 2:
+                self.pad_waiting = True
+            kept.append(piece)
+            group = (group + len(piece)) % 4
+
+        data = ''.join(kept)
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else ''
+
+    def flush(self):
+        """
+        :return str The bytes of the last, incomplete group
+        """
+        data = self.pending
+        self.pending = ''
+        if len(data) % 4 == 1:
+            # A single dangling character can't be decoded; flanker drops it
+            data = data[:-1]
+        return binascii.a2b_base64(data + '=' * (-len(data) % 4)) if data else ''
+
+    def _end(self, kept):
+        data = ''.join(kept)
+        self.pending = ''
+        self.done = True
+        return binascii.a2b_base64(data + '=' * (-len(data) % 4)) if data else ''
+
+
 def parse_date_from_received_hval(received_hval):
-    dontcare, date_str = received_hval.split(';')
-    return parse_date_hval(date_str)
+    return parse_received_date(received_hval)
 
 
 def headers_from_mimepart(mimepart):
@@ -219,9 +905,20 @@ def headers_from_mimepart(mimepart):
     :param flanker.mime.message.part.MimePart mimepart: The mime part to look in
     :return email_decoder.models.headers.Headers
     """
+    return headers_from_mime_headers(mimepart.headers)
+
+
+def headers_from_mime_headers(mime_headers, limit=None):
+    """
+    Copies flanker's parsed headers into a Headers collection
+
+    :param flanker.mime.message.headers.MimeHeaders mime_headers: The headers
+    :param int limit: Only copy this many headers (the first ones)
+    :return email_decoder.models.headers.Headers
+    """
     headers = Headers()
 
-    for name, value in mimepart.headers.iteritems():
+    for name, value in islice(mime_headers.iteritems(), limit):
         headers.add_header_value(name, value)
 
     return headers
@@ -263,14 +960,7 @@ def parse_date_hval(hval):
     :param string hval: The date and time string
     :return datetime
     """
-    date_tuple = parsedate_tz(hval)
-    if not date_tuple:
-        raise ValueError
-
-    timestamp = mktime_tz(date_tuple)
-    dt = datetime.utcfromtimestamp(timestamp)
-    dt.replace(microsecond=0)
-    return dt
+    return parse_date(hval)
 
 
 def parse_references_hval(hval):
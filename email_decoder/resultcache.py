@@ -0,0 +1,305 @@
+"""
+Persistent cache of parse results.
+
+A parsed Message only depends on the raw bytes of the message and on the parser (its version
+and settings), so when the same messages are decoded again the result can be read back instead
+of running flanker and the whole parser over them again. Results are stored in SQLite as msgpack
+blobs, keyed by a hash of the raw message and the parser settings (see Parser.result_cache_key).
+The least recently used results are evicted once the cache gets over its size limit.
+"""
+import os
+import sqlite3
+import time
+import msgpack
+from datetime import datetime
+from flanker.mime.message.headers.wrappers import ContentType
+from flanker.mime.message.headers.wrappers import WithParams
+from email_decoder.models.message import Message
+from email_decoder.models.headers import Headers
+from email_decoder.models.headers import Header
+from email_decoder.models.headers import normal_name
+from email_decoder.models.addr import Addr
+from email_decoder.models.file import File
+from email_decoder.output import FILE_FIELDS
+
+# msgpack extension type codes of the non-plain values a Message holds
+_EXT_ADDR = 1
+_EXT_DATETIME = 2
+_EXT_CONTENT_TYPE = 3
+_EXT_WITH_PARAMS = 4
+
+# Message fields that are cached. The read date (Message.date) is set when the result is read
+# back, and the source offsets are set by whoever read the message.
+_MESSAGE_FIELDS = (
+    'subject', 'message_id', 'from_addr', 'to_addrs', 'cc_addrs', 'bcc_addrs', 'reply_to_addr', 'message_date',
+    'references', 'body_text', 'body_html', 'truncated'
+)
+
+
+class ResultCache(object):
+    """
+    SQLite store of packed Messages with size-based LRU eviction. Can be shared by several
+    processes (each opens its own connection).
+    """
+
+    # last_used is only updated when it is older than this (in seconds), so reading a result
+    # back doesn't always cost a write
+    TOUCH_INTERVAL = 600
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        """
+        :param str path: Path of the SQLite database (created if it doesn't exist)
+        :param int max_bytes: Evict results once the packed results take more than this
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        """
+        Number of lookups that found a result (in this process)
+        :type int
+        """
+
+        self.misses = 0
+        """
+        Number of lookups that didn't (in this process)
+        :type int
+        """
+
+        self.evictions = 0
+        """
+        Number of results evicted (by this process)
+        :type int
+        """
+
+        self._db = None
+        self._db_pid = None
+
+    def _connection(self):
+        # Connections can't be shared with forked children, so each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(
+                'CREATE TABLE IF NOT EXISTS results ('
+                '  key BLOB PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);'
+                'CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL);'
+                "INSERT OR IGNORE INTO totals (name, value) VALUES ('bytes', 0);"
+            )
+            self._db_pid = os.getpid()
+        return self._db
+
+    def create(self):
+        """
+        Creates the database if it doesn't exist yet. Call this once before starting several
+        processes that will use the same new cache.
+        """
+        self._connection()
+        return self
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, key):
+        """
+        :param str key: The key of the result
+        :return str|None The packed result
+        """
+        db = self._connection()
+        row = db.execute('SELECT data, last_used FROM results WHERE key = ?', (buffer(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        now = time.time()
+        if now - row[1] > self.TOUCH_INTERVAL:
+            db.execute('UPDATE results SET last_used = ? WHERE key = ?', (now, buffer(key)))
+        return str(row[0])
+
+    def put(self, key, data):
+        """
+        :param str key: The key of the result
+        :param str data: The packed result
+        """
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            inserted = db.execute(
+                'INSERT OR IGNORE INTO results (key, data, size, last_used) VALUES (?, ?, ?, ?)',
+                (buffer(key), buffer(data), len(data), time.time())).rowcount
+            if inserted:
+                db.execute("UPDATE totals SET value = value + ? WHERE name = 'bytes'", (len(data),))
+                self._evict(db)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _evict(self, db):
+        total = db.execute("SELECT value FROM totals WHERE name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Make some room, so we don't have to evict again on the very next put
+        target = self.max_bytes * 0.9
+        freed = 0
+        keys = []
+        for key, size in db.execute('SELECT key, size FROM results ORDER BY last_used'):
+            if total - freed <= target:
+                break
+            keys.append(key)
+            freed += size
+
+        db.executemany('DELETE FROM results WHERE key = ?', [(key,) for key in keys])
+        db.execute("UPDATE totals SET value = value - ? WHERE name = 'bytes'", (freed,))
+        self.evictions += len(keys)
+
+    def stats(self):
+        """
+        :return dict Lookup counters for this process, and the size of the whole cache
+        """
+        db = self._connection()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": db.execute('SELECT COUNT(*) FROM results').fetchone()[0],
+            "bytes": db.execute("SELECT value FROM totals WHERE name = 'bytes'").fetchone()[0],
+        }
+
+
+def pack_message(msg, header_names=None):
+    """
+    Packs a (completely loaded) Message, keeping the types of its values, so that unpack_message
+    gives a Message that serializes exactly like the original.
+
+    The order in which a Headers collection lists its headers depends on the order they were added
+    in, which it doesn't keep. Pass the header names in the order they appear in the message to have
+    the unpacked collections list them in the same order as the original ones.
+
+    :param email_decoder.models.message.Message msg: The message
+    :param list[str] header_names: Names of the message's headers, in order (e.g. from flanker's MimeHeaders.keys())
+    :return str
+    """
+    fields = [getattr(msg, name) for name in _MESSAGE_FIELDS]
+    files = [[getattr(f, name) for name in FILE_FIELDS] for f in msg.files]
+    return msgpack.packb(
+        [fields, files, _pack_headers(msg.headers), _pack_headers(msg.raw_headers, header_names)],
+        use_bin_type=True, default=_pack_value)
+
+
+def unpack_message(data):
+    """
+    :param str data: A message packed by pack_message
+    :return email_decoder.models.message.Message
+    """
+    fields, files, headers, raw_headers = msgpack.unpackb(data, encoding='utf-8', ext_hook=_unpack_value)
+    raw_headers = _unpack_headers(raw_headers)
+
+    msg = Message()
+    for name, value in zip(_MESSAGE_FIELDS, fields):
+        setattr(msg, name, value)
+    for values in files:
+        f = File()
+        for name, value in zip(FILE_FIELDS, values):
+            setattr(f, name, value)
+        msg.files.append(f)
+    msg.raw_headers = raw_headers
+    # The parsed headers were added in the order of the raw ones
+    msg.headers = _unpack_headers(headers, list(raw_headers.headers) if raw_headers is not None else None)
+    msg.date = datetime.utcnow()
+    return msg
+
+
+def _pack_headers(headers, names=None):
+    if headers is None:
+        return None
+
+    ordered = None
+    if names is not None:
+        # Take the headers of each name in turn (the headers with the same name are in order)
+        remaining = dict((name, iter(hs)) for name, hs in headers.headers.iteritems())
+        count = sum(len(hs) for hs in headers.headers.itervalues())
+        ordered = []
+        try:
+            for name in names:
+                if len(ordered) == count:
+                    # The rest were left out (see Limits.max_headers)
+                    break
+                ordered.append(next(remaining[normal_name(name)]))
+        except (KeyError, StopIteration):
+            ordered = None
+        if ordered is not None and len(ordered) != count:
+            ordered = None
+
+    if ordered is None:
+        ordered = [h for hs in headers.headers.itervalues() for h in hs]
+    return [[h.raw_name, _pack_header_value(h.value), h.is_single] for h in ordered]
+
+
+def _pack_header_value(value):
+    # These are tuples, which msgpack would pack as plain arrays without asking _pack_value
+    if isinstance(value, ContentType):
+        return msgpack.ExtType(_EXT_CONTENT_TYPE, msgpack.packb([value.main, value.sub, value.params], use_bin_type=True))
+    if isinstance(value, WithParams):
+        return msgpack.ExtType(_EXT_WITH_PARAMS, msgpack.packb([value.value, value.params], use_bin_type=True))
+    return value
+
+
+def _unpack_headers(values, names=None):
+    """
+    Adds the headers in the order they were packed in, or when names are given, grouped by name
+    in that order.
+    """
+    if values is None:
+        return None
+
+    headers = Headers()
+    unpacked = []
+    for raw_name, value, is_single in values:
+        header = Header(raw_name)
+        header.value = value
+        header.is_single = is_single
+        unpacked.append(header)
+
+    if names is not None:
+        by_name = {}
+        for header in unpacked:
+            by_name.setdefault(header.name, []).append(header)
+        for name in names:
+            if name in by_name:
+                headers.headers[name] = by_name.pop(name)
+        unpacked = [header for hs in by_name.itervalues() for header in hs]
+
+    for header in unpacked:
+        headers.add_header(header)
+    return headers
+
+
+def _pack_value(obj):
+    if isinstance(obj, Addr):
+        return msgpack.ExtType(_EXT_ADDR, msgpack.packb([obj.name, obj.email], use_bin_type=True))
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, msgpack.packb(
+            [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, obj.microsecond]))
+    raise TypeError("Can't pack %r" % obj)
+
+
+def _unpack_value(code, data):
+    values = msgpack.unpackb(data, encoding='utf-8')
+    if code == _EXT_ADDR:
+        return Addr(values[1], values[0])
+    if code == _EXT_DATETIME:
+        return datetime(*values)
+    if code == _EXT_CONTENT_TYPE:
+        return ContentType(values[0], values[1], values[2])
+    if code == _EXT_WITH_PARAMS:
+        return WithParams(values[0], values[1])
+    return msgpack.ExtType(code, data)
@@ -0,0 +1,343 @@
+"""
+Finds the structure of a message (where its parts are) without flanker's scanner.
+
+flanker runs a regex over every line of the message looking for Content-Type headers, empty
+lines and anything that starts with "--", and then builds a tree of MimeParts out of what it
+found. Here only the header blocks are looked at, and multipart boundaries are located with
+str.find for the boundaries that were actually declared, so the bodies in between (base64
+attachments, mostly) are skipped rather than scanned line by line. The result is a flat table
+of parts in the order flanker's walk would visit them.
+
+The table describes exactly the parts flanker would find. Messages where that can't be
+guaranteed cheaply (message/rfc822 and other containers, boundaries declared on parts that
+aren't multiparts, boundaries that overlap or show up where flanker would take them for
+something else, very deeply nested parts) are not scanned at all: scan_parts returns None and
+the message is left to flanker. Messages with very many parts, which flanker rejects, are
+truncated instead.
+"""
+import re
+from cStringIO import StringIO
+from flanker.mime.message import scanner
+from flanker.mime.message.headers import parsing
+from flanker.mime.message.headers import MimeHeaders
+from flanker.mime.message.headers import ContentType
+from flanker.mime.message.headers import WithParams
+from flanker.mime.message.part import RichPartMixin
+from flanker.mime.message.part import _decode_body
+from email_decoder.mapped import MappedFile
+from email_decoder.limits import LimitExceeded
+
+# The Content-Type header as flanker's tokenizer matches it (only the printable ASCII part
+# of the value counts)
+_CONTENT_TYPE = re.compile(r'^content-type:[\x21-\x7e \t]+(?:(?:\r\n|\n)[ \t]+[\x20-\x7e \t]+)*', re.IGNORECASE | re.MULTILINE)
+
+# flanker gives up on a message after 5000 scanner operations (about two per part), and its
+# scanner recurses for every level of nesting. Messages with deeper nesting than this are left
+# to flanker, so they fail (or not) exactly like they would there; only the first MAX_PARTS
+# parts of messages with more are kept (see PartTable.truncated).
+MAX_PARTS = 2000
+MAX_DEPTH = 200
+
+# How far into a part to look for the end of its headers at first
+_HEADER_WINDOW = 16 * 1024
+
+# A boundary line can only have some tabs and CRs (and "--" for the final one) after the boundary
+_MAX_BOUNDARY_LINE_REST = 64
+
+
+class _LeaveToFlanker(Exception):
+    pass
+
+
+class _TooManyParts(Exception):
+    pass
+
+
+class ScannedPart(RichPartMixin):
+    """
+    One row of the part table: where a part is in the message and its content type, disposition
+    and transfer encoding. Has the attributes of flanker's MimePart that the Parser reads, so rows
+    can be parsed like MimeParts. The part's headers are only parsed when first needed.
+    """
+
+    def __init__(self, stream, start, end, depth, content_type):
+        """
+        :param file stream: The message
+        :param int start: Offset of the part's first header
+        :param int end: Offset of the part's last byte
+        :param int depth: Nesting level (the top level part is at 0)
+        :param flanker.mime.message.headers.ContentType content_type: The content type
+        """
+        RichPartMixin.__init__(self, is_root=depth == 0)
+        self.stream = stream
+        self.start = start
+        self.end = end
+        self.depth = depth
+        self.content_type = content_type
+        self._headers = None
+        self._body_start = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self.stream.seek(self.start)
+            self._headers = MimeHeaders.from_stream(self.stream)
+            self._body_start = self.stream.tell()
+        return self._headers
+
+    @property
+    def body_start(self):
+        """
+        Offset of the first byte of the body
+        :type int
+        """
+        self.headers
+        return self._body_start
+
+    @property
+    def content_disposition(self):
+        return self.headers.get('Content-Disposition', WithParams(None))
+
+    @property
+    def content_encoding(self):
+        return self.headers.get('Content-Transfer-Encoding', WithParams('7bit'))
+
+    @property
+    def body(self):
+        if not self.content_type.is_singlepart():
+            return None
+        body_start = self.body_start
+        self.stream.seek(body_start)
+        return _decode_body(self.content_type, self.content_encoding.value, self.stream.read(self.end - body_start + 1))
+
+
+class PartTable(object):
+    """
+    The parts of a message, in the order flanker's MimePart.walk visits them, starting with the
+    message itself.
+    """
+
+    def __init__(self, parts, truncated=None):
+        """
+        :param list[ScannedPart] parts: The parts
+        :param email_decoder.limits.LimitExceeded truncated: Set when these are only the first parts of the message
+        """
+        self.parts = parts
+        self.truncated = truncated
+
+    @property
+    def headers(self):
+        """
+        The message's headers
+        :type flanker.mime.message.headers.MimeHeaders
+        """
+        return self.parts[0].headers
+
+    @property
+    def content_type(self):
+        return self.parts[0].content_type
+
+    def walk(self):
+        """
+        Same as email_decoder.parser.walk_with_depth, with the message itself only included when it
+        is a singlepart.
+
+        :return generator[tuple[ScannedPart, int]]
+        """
+        parts = self.parts if self.content_type.is_singlepart() else self.parts[1:]
+        for part in parts:
+            yield part, part.depth
+
+
+def scan_parts(buf, truncate=False):
+    """
+    :param str|mmap.mmap buf: The raw message
+    :param bool truncate: For messages flanker gave up on: rather than leaving the message to
+        flanker, return the parts before the first one that can't be scanned (with
+        PartTable.truncated set), or None when not even the message itself can be. Messages
+        with more than MAX_PARTS parts are truncated either way.
+    :return PartTable|None The parts, or None when the message has to be left to flanker
+    """
+    parts = []
+    try:
+        _scan(buf, parts)
+    except _LeaveToFlanker:
+        if not truncate or not parts:
+            return None
+        return _truncated(parts)
+    except _TooManyParts:
+        return _truncated(parts)
+    return PartTable(parts)
+
+
+def _truncated(parts):
+    # Counted like Limits.max_parts, which doesn't include the message itself when it is a multipart
+    walked = len(parts) - 1
+    return PartTable(parts, LimitExceeded('max_parts', walked, walked + 1))
+
+
+def _scan(buf, parts):
+    """
+    Adds the parts of the message to parts, in order.
+    """
+    size = len(buf)
+    stream = StringIO(buf) if isinstance(buf, str) else MappedFile(buf)
+    boundaries = []
+
+    # Parts still to be looked at, (start, end, depth); children are pushed in reverse so they
+    # come off in order
+    pending = [(0, size - 1, 0)]
+    while pending:
+        start, end, depth = pending.pop()
+        if depth > MAX_DEPTH:
+            raise _LeaveToFlanker()
+        if len(parts) >= MAX_PARTS:
+            raise _TooManyParts()
+
+        content_type, declared_at = _part_content_type(buf, start, end)
+        part = ScannedPart(stream, start, end, depth, content_type)
+        parts.append(part)
+        if content_type.is_singlepart():
+            if content_type.get_boundary() is not None:
+                # flanker splits at the boundaries of any Content-Type that declares one
+                raise _LeaveToFlanker()
+            continue
+        if not content_type.is_multipart():
+            # message/rfc822, message/delivery-status, text/rfc822-headers, ...
+            raise _LeaveToFlanker()
+
+        boundary = _checked_boundary(content_type, boundaries)
+        children, part.end = _split_multipart(buf, boundary, declared_at, end)
+        for child_start, child_end in reversed(children):
+            pending.append((child_start, child_end, depth + 1))
+
+
+def _part_content_type(buf, start, end):
+    """
+    :return tuple[ContentType, int] The content type of the part and where its header ends (the
+        default content type and the part's start when it has none)
+    """
+    # The header block ends at the first empty line (or the end of the part). Headers are short,
+    # so look close to the start first rather than through the whole body for the kind of line
+    # ending the message doesn't use.
+    if buf[start:start + 1] == '\n' or buf[start:start + 2] == '\r\n':
+        header_end = start
+    else:
+        window = _HEADER_WINDOW
+        while True:
+            limit = min(start + window, end + 1)
+            header_end = limit
+            for empty_line in ('\n\n', '\n\r\n'):
+                found = buf.find(empty_line, start, header_end)
+                if found != -1:
+                    header_end = found + 1
+            if header_end < limit or limit == end + 1:
+                break
+            window *= 16
+
+    match = _CONTENT_TYPE.search(buf[start:header_end])
+    if match is None:
+        return scanner.default_content_type(), start
+
+    try:
+        _, content_type = parsing.parse_header(match.group(0))
+    except Exception:
+        raise _LeaveToFlanker()
+    if not isinstance(content_type, ContentType):
+        raise _LeaveToFlanker()
+    return content_type, start + match.end()
+
+
+def _checked_boundary(content_type, boundaries):
+    boundary = content_type.get_boundary()
+    if not boundary or boundary != boundary.strip():
+        raise _LeaveToFlanker()
+    try:
+        boundary = str(boundary)
+    except UnicodeError:
+        raise _LeaveToFlanker()
+
+    # flanker takes a line for a boundary when it is any of the boundaries declared so far, so
+    # one boundary line must never be able to pass for another ("--b--" is also "--b" + "--")
+    for other in boundaries:
+        if boundary in (other, other + '--') or other == boundary + '--':
+            raise _LeaveToFlanker()
+    boundaries.append(boundary)
+    return boundary
+
+
+def _split_multipart(buf, boundary, declared_at, end):
+    """
+    Finds the parts of a multipart between its boundary lines.
+
+    :param str boundary: The multipart's boundary
+    :param int declared_at: Where its Content-Type header ends
+    :param int end: The last byte of the multipart
+    :return tuple[list[tuple[int, int]], int] (start, end) of each part, and the real end of the multipart
+    """
+    size = len(buf)
+    parts = []
+    part_start = None
+    final = False
+
+    # Every line with this boundary from where it was declared to the end of the message is a
+    # boundary for flanker, so they all have to be in the right places
+    for line_start, line_end, is_final in _boundary_lines(buf, boundary, declared_at):
+        if final or line_start > end:
+            raise _LeaveToFlanker()
+        if part_start is None:
+            if is_final:
+                raise _LeaveToFlanker()
+        else:
+            parts.append((part_start, _newline_before(buf, line_start) - 1))
+        part_start = line_end + 1
+        if is_final:
+            final = True
+            end = line_end
+
+    if part_start is None:
+        # flanker can't parse a multipart without a first boundary
+        raise _LeaveToFlanker()
+    if not final:
+        if end != size - 1:
+            # The next boundary of an enclosing multipart would end up as one of this one's parts
+            raise _LeaveToFlanker()
+        parts.append((part_start, size - 1))
+
+    return parts, end
+
+
+def _boundary_lines(buf, boundary, start):
+    """
+    :return generator[tuple[int, int, bool]] For each boundary line from start on: where the line
+        starts, where it ends (its newline, or the end of the message), and whether it is the final one
+    """
+    size = len(buf)
+    marker = '\n--' + boundary
+    position = buf.find(marker, start)
+    while position != -1:
+        line_start = position + 1
+        rest_start = position + len(marker)
+        line_end = buf.find('\n', rest_start)
+        if line_end == -1:
+            line_end = size
+
+        if line_end - rest_start > _MAX_BOUNDARY_LINE_REST:
+            if buf[rest_start:rest_start + _MAX_BOUNDARY_LINE_REST].strip('\t\r') in ('', '--'):
+                raise _LeaveToFlanker()
+        else:
+            rest = buf[rest_start:line_end].rstrip('\t\r')
+            if rest == '' or rest == '--':
+                yield line_start, line_end, rest == '--'
+
+        position = buf.find(marker, rest_start)
+
+
+def _newline_before(buf, line_start):
+    """
+    Where flanker considers a boundary line to start: at the CRLF or LF before it.
+    """
+    newline = line_start - 1
+    if newline - 1 > 0 and buf[newline - 1] == '\r':
+        return newline - 1
+    return newline
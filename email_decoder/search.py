@@ -0,0 +1,1168 @@
+"""
+Embedded full-text and address search over parsed messages.
+
+Messages are added to an index directory as they come out of the Parser. Their subject, text
+body and attachment filenames are split into words, and their addresses into the whole address,
+its domain and the words of the local part and display name. Each word becomes a term (prefixed
+with the field it was found in) that maps to the sorted list of documents containing it, with the
+positions of the word for phrase queries.
+
+Layout of an index directory:
+
+    MANIFEST        JSON: the segments that make up the index, in document order
+    LOCK            held by the (single) IndexWriter
+    seg-<n>.idx     a segment: an immutable inverted index of a contiguous range of documents
+
+The writer buffers postings in memory and writes them out as a new segment when the buffer is
+full. Segments of similar size are merged in the background (merge_factor of them at a time), so
+an index of n documents has O(log n) segments and a query looks up each term in a handful of
+files whatever the size of the archive.
+
+Segment file layout: the MAGIC bytes, then for every term in sorted order its postings followed
+(every TERMS_PER_BLOCK terms) by a zlib-compressed msgpack block of the term dictionary, then the
+stored documents (key and date) in zlib-compressed msgpack blocks of DOCS_PER_BLOCK documents,
+then a msgpack footer and its length as an 8-byte big-endian int and the MAGIC bytes again.
+
+Postings are split in blocks of POSTING_BLOCK documents, each stored as varint-encoded document
+deltas followed (for text terms) by the varint-encoded position deltas of each document. The
+dictionary keeps the last document and location of each block, so intersecting a common term with
+a rare one only decodes the blocks that can hold the rare term's documents. The footer keeps the
+first term of each dictionary block and the date range of each document block, which is all that
+is held in memory per segment.
+"""
+import bisect
+import calendar
+import errno
+import fcntl
+import heapq
+import json
+import math
+import os
+import os.path
+import re
+import struct
+import sys
+import threading
+import zlib
+from datetime import datetime
+import msgpack
+from email_decoder.mapped import map_file
+
+MAGIC = 'EDIDX001'
+
+_TRAILER = struct.Struct('>Q')
+
+POSTING_BLOCK = 128
+TERMS_PER_BLOCK = 128
+DOCS_PER_BLOCK = 4096
+
+# Field -> term prefix
+TEXT_FIELDS = {'subject': 's', 'body': 'b', 'filename': 'n'}
+ADDRESS_FIELDS = {'from': 'F', 'to': 'T', 'cc': 'C', 'bcc': 'B', 'reply_to': 'R'}
+
+# Message attribute of each address field
+_ADDRESS_ATTRS = [
+    ('from', 'from_addr'), ('reply_to', 'reply_to_addr'), ('to', 'to_addrs'), ('cc', 'cc_addrs'), ('bcc', 'bcc_addrs')
+]
+
+_TEXT_PREFIXES = frozenset(TEXT_FIELDS.values())
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+# Longer "words" are encoded data, URLs and the like, nobody searches for them
+MAX_WORD_LENGTH = 64
+
+# Only this many words of each field are indexed (the start of a huge body is enough to find it)
+MAX_FIELD_WORDS = 100000
+
+# Query syntax: field:value, field:"a phrase", "a phrase", word, OR
+_QUERY_TOKEN = re.compile(r'(?:(\w+):)?(?:"([^"]*)"?|(\S+))', re.UNICODE)
+
+_SEGMENT_NAME = re.compile(r'^seg-\d+\.idx$')
+
+# Number of decompressed dictionary and document blocks kept per segment
+_BLOCK_CACHE_SIZE = 64
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase words, the way fields are indexed.
+
+    :param str|unicode text: The text
+    :return list[unicode]
+    """
+    if not text:
+        return []
+    return [w for w in _WORD.findall(_text(text).lower()) if len(w) <= MAX_WORD_LENGTH]
+
+
+def document_terms(message):
+    """
+    The terms a message is indexed under. Only holds plain values, so it can be computed in a
+    worker process and added to the index by the one holding the IndexWriter.
+
+    :param email_decoder.models.message.Message message: The message
+    :return tuple[dict[str, list[int]|None], int|None] Positions of each term (None for address terms), and
+        the message's date as a Unix timestamp
+    """
+    terms = {}
+    for field, values in (
+            ('subject', [message.subject]),
+            ('body', [message.body_text]),
+            ('filename', [f.filename for f in message.files])):
+        position = 0
+        prefix = TEXT_FIELDS[field] + ':'
+        for value in values:
+            for word in tokenize(value):
+                if position == MAX_FIELD_WORDS:
+                    break
+                terms.setdefault(prefix + word.encode('utf-8'), []).append(position)
+                position += 1
+            # Words of different filenames never make a phrase
+            position += 1
+
+    for field, attr in _ADDRESS_ATTRS:
+        value = getattr(message, attr)
+        if not value:
+            continue
+        prefix = ADDRESS_FIELDS[field] + ':'
+        for addr in (value if type(value) is list else [value]):
+            for word in _address_words(getattr(addr, 'email', None), getattr(addr, 'name', None)):
+                terms[prefix + word.encode('utf-8')] = None
+
+    return terms, _timestamp(message.message_date)
+
+
+def _address_words(email, name):
+    words = set()
+    if email:
+        email = _text(email).strip().lower()
+        words.add(email)
+        local, _, domain = email.rpartition('@')
+        if domain and local:
+            words.add('@' + domain)
+            words.update(tokenize(local))
+    words.update(tokenize(name))
+    return words
+
+
+class IndexWriter(object):
+    """
+    Adds documents to an index directory. Only one writer can have an index open at a time (others
+    wait for it to be closed); any number of Searchers can read it meanwhile, in any process.
+    """
+
+    def __init__(self, path, buffer_postings=1000000, merge_factor=10, background_merge=True):
+        """
+        :param str path: The index directory (created if it doesn't exist)
+        :param int buffer_postings: Write a segment once this many (term, document) pairs are buffered
+        :param int merge_factor: Merge this many segments of similar size into one
+        :param bool background_merge: Merge segments in a background thread rather than in flush()
+        """
+        self.path = path
+        self.buffer_postings = buffer_postings
+        self.merge_factor = merge_factor
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock_file = open(os.path.join(path, 'LOCK'), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+        self._manifest = _read_manifest(path)
+        self._remove_unused_files()
+
+        # Protects the manifest (flush() and the merge thread both change it)
+        self._lock = threading.Lock()
+        # Only one merge at a time
+        self._merge_lock = threading.Lock()
+        self._reset_buffer()
+
+        self._closing = False
+        # A merge that failed in the background thread, raised from the next add, flush or close
+        self._merge_error = None
+        self._wake = threading.Event()
+        self._merge_thread = None
+        if background_merge:
+            self._merge_thread = threading.Thread(target=self._merge_loop)
+            self._merge_thread.daemon = True
+            self._merge_thread.start()
+
+    @property
+    def doc_count(self):
+        """
+        Number of documents in the index, including the buffered ones
+        :type int
+        """
+        return self._manifest['next_doc'] + len(self._keys)
+
+    def add(self, message, key=None):
+        """
+        :param email_decoder.models.message.Message message: The message
+        :param str key: Stored with the document and returned with the search results (e.g. the path
+            of the message; defaults to its Message-ID)
+        :return int The document id
+        """
+        terms, date = document_terms(message)
+        return self.add_terms(key if key is not None else message.message_id, terms, date)
+
+    def add_terms(self, key, terms, date=None):
+        """
+        Adds a document by its terms (see document_terms).
+
+        :param str key: Stored with the document
+        :param dict[str, list[int]|None] terms: Positions of each term
+        :param int date: Unix timestamp of the document
+        :return int The document id
+        """
+        self._raise_merge_error()
+        ordinal = len(self._keys)
+        postings = self._postings
+        for term, positions in terms.iteritems():
+            entry = postings.get(term)
+            if entry is None:
+                postings[term] = entry = ([], [] if positions is not None else None)
+            entry[0].append(ordinal)
+            if positions is not None:
+                entry[1].append(positions)
+        self._keys.append(key)
+        self._dates.append(date)
+        self._buffered += len(terms)
+
+        doc_id = self._manifest['next_doc'] + ordinal
+        if self._buffered >= self.buffer_postings:
+            self.flush()
+        return doc_id
+
+    def flush(self):
+        """
+        Writes the buffered documents out as a new segment, making them visible to searches.
+        """
+        self._raise_merge_error()
+        if not self._keys:
+            return
+
+        with self._lock:
+            name = self._new_segment_name()
+        writer = _SegmentWriter(os.path.join(self.path, name))
+        try:
+            for term in sorted(self._postings):
+                docs, positions = self._postings[term]
+                writer.add_term(term, zip(docs, positions) if positions is not None else ((doc, None) for doc in docs))
+            writer.add_docs(zip(self._keys, self._dates))
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+        with self._lock:
+            base = self._manifest['next_doc']
+            self._manifest['segments'].append({"name": name, "base": base, "docs": len(self._keys)})
+            self._manifest['next_doc'] = base + len(self._keys)
+            _write_manifest(self.path, self._manifest)
+        self._reset_buffer()
+
+        if self._merge_thread is not None:
+            self._wake.set()
+        else:
+            self._merge_pending()
+
+    def optimize(self):
+        """
+        Flushes and merges the whole index into a single segment (the fastest to search).
+        """
+        self.flush()
+        with self._merge_lock:
+            with self._lock:
+                segments = list(self._manifest['segments'])
+            if len(segments) > 1:
+                self._merge(segments)
+
+    def close(self):
+        """
+        Flushes, waits for the merges that are due and releases the index.
+        """
+        try:
+            self.flush()
+        finally:
+            if self._merge_thread is not None:
+                self._closing = True
+                self._wake.set()
+                self._merge_thread.join()
+                self._merge_thread = None
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+        self._raise_merge_error()
+
+    def _reset_buffer(self):
+        # term -> (ordinals, positions of each ordinal or None)
+        self._postings = {}
+        self._keys = []
+        self._dates = []
+        self._buffered = 0
+
+    def _new_segment_name(self):
+        number = self._manifest['next_segment']
+        self._manifest['next_segment'] = number + 1
+        return 'seg-%08d.idx' % number
+
+    def _remove_unused_files(self):
+        # Left behind by a writer that crashed while writing or merging
+        used = set(segment['name'] for segment in self._manifest['segments'])
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp') or (_SEGMENT_NAME.match(name) and name not in used):
+                _unlink(os.path.join(self.path, name))
+
+    def _merge_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self._merge_pending()
+            except Exception:
+                # Keep merging after later flushes; the index is still consistent, only the
+                # merge that failed is missing
+                if self._merge_error is None:
+                    self._merge_error = sys.exc_info()
+            if self._closing:
+                return
+
+    def _raise_merge_error(self):
+        error, self._merge_error = self._merge_error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _merge_pending(self):
+        with self._merge_lock:
+            while True:
+                with self._lock:
+                    segments = self._pick_merge()
+                if segments is None:
+                    return
+                self._merge(segments)
+
+    def _pick_merge(self):
+        """
+        :return list[dict]|None The first run of merge_factor adjacent segments of the same size level
+        """
+        segments = self._manifest['segments']
+        run = []
+        for segment in segments:
+            level = int(math.log(max(segment['docs'], 1), self.merge_factor))
+            if run and run[-1][0] != level:
+                run = []
+            run.append((level, segment))
+            if len(run) == self.merge_factor:
+                return [s for _, s in run]
+        return None
+
+    def _merge(self, segments):
+        """
+        Merges adjacent segments into one and puts it in their place.
+        """
+        with self._lock:
+            name = self._new_segment_name()
+        readers = [_Segment(os.path.join(self.path, s['name']), s['base'], s['docs']) for s in segments]
+        writer = _SegmentWriter(os.path.join(self.path, name))
+        try:
+            offsets = []
+            offset = 0
+            for reader in readers:
+                offsets.append(offset)
+                offset += reader.docs
+
+            sources = [_numbered_terms(reader, i) for i, reader in enumerate(readers)]
+            pending = []
+            for term, i, skips in heapq.merge(*sources):
+                if pending and pending[0][0] != term:
+                    writer.add_term(pending[0][0], _merged_postings(readers, offsets, pending))
+                    pending = []
+                pending.append((term, i, skips))
+            if pending:
+                writer.add_term(pending[0][0], _merged_postings(readers, offsets, pending))
+
+            writer.add_docs(doc for reader in readers for doc in reader.iter_docs())
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            for reader in readers:
+                reader.close()
+
+        with self._lock:
+            current = self._manifest['segments']
+            start = current.index(segments[0])
+            current[start:start + len(segments)] = [
+                {"name": name, "base": segments[0]['base'], "docs": sum(s['docs'] for s in segments)}]
+            _write_manifest(self.path, self._manifest)
+        # Searchers that still have them open keep reading them until they refresh
+        for segment in segments:
+            _unlink(os.path.join(self.path, segment['name']))
+
+
+def _numbered_terms(reader, number):
+    for term, _, skips in reader.iter_terms():
+        yield term, number, skips
+
+
+def _merged_postings(readers, offsets, entries):
+    for _, i, skips in entries:
+        reader = readers[i]
+        offset = offsets[i]
+        for index in xrange(len(skips)):
+            docs, positions = reader.read_block(skips, index, True)
+            for j, doc in enumerate(docs):
+                yield doc + offset, positions[j] if positions is not None else None
+
+
+class _SegmentWriter(object):
+    """
+    Writes a segment file; terms have to be added in sorted order, then the documents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path + '.tmp', 'wb')
+        self.fp.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.terms = 0
+        self.docs = 0
+        self._term_entries = []
+        self._term_blocks = []
+        self._doc_blocks = []
+
+    def add_term(self, term, postings):
+        """
+        :param str term: The term
+        :param iterable[tuple[int, list[int]|None]] postings: Ordinal and positions of each document, in order
+        """
+        skips = []
+        count = 0
+        previous = -1
+        docs = bytearray()
+        positions = bytearray()
+        with_positions = term[0] in _TEXT_PREFIXES
+        for doc, doc_positions in postings:
+            _append_varint(docs, doc - previous)
+            previous = doc
+            if with_positions:
+                _append_varint(positions, len(doc_positions))
+                last = 0
+                for position in doc_positions:
+                    _append_varint(positions, position - last)
+                    last = position
+            count += 1
+            if count % POSTING_BLOCK == 0:
+                skips.append(self._write_block(previous, docs, positions))
+                docs = bytearray()
+                positions = bytearray()
+        if count % POSTING_BLOCK:
+            skips.append(self._write_block(previous, docs, positions))
+
+        self._term_entries.append([term, count, skips])
+        self.terms += 1
+        if len(self._term_entries) == TERMS_PER_BLOCK:
+            self._flush_terms()
+
+    def _write_block(self, last_doc, docs, positions):
+        self.fp.write(docs)
+        self.fp.write(positions)
+        skip = [last_doc, self.offset, len(docs), len(positions)]
+        self.offset += len(docs) + len(positions)
+        return skip
+
+    def _flush_terms(self):
+        if self._term_entries:
+            first = self._term_entries[0][0]
+            self._term_blocks.append([first, self.offset, self._write(msgpack.packb(self._term_entries))])
+            self._term_entries = []
+
+    def add_docs(self, docs):
+        """
+        :param iterable[tuple[str, int|None]] docs: Key and date of each document, in order
+        """
+        self._flush_terms()
+        keys = []
+        dates = []
+        for key, date in docs:
+            keys.append(key)
+            dates.append(date)
+            if len(keys) == DOCS_PER_BLOCK:
+                self._write_docs(keys, dates)
+                keys = []
+                dates = []
+        if keys:
+            self._write_docs(keys, dates)
+
+    def _write_docs(self, keys, dates):
+        known = [date for date in dates if date is not None]
+        offset = self.offset
+        length = self._write(msgpack.packb([keys, dates]))
+        self._doc_blocks.append([offset, length, min(known) if known else None, max(known) if known else None])
+        self.docs += len(keys)
+
+    def _write(self, data):
+        data = zlib.compress(data)
+        self.fp.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def close(self):
+        footer = msgpack.packb({
+            "docs": self.docs,
+            "terms": self.terms,
+            "term_blocks": self._term_blocks,
+            "doc_blocks": self._doc_blocks,
+        })
+        self.fp.write(footer)
+        self.fp.write(_TRAILER.pack(len(footer)))
+        self.fp.write(MAGIC)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def abort(self):
+        self.fp.close()
+        _unlink(self.path + '.tmp')
+
+
+class _Segment(object):
+    """
+    Reads a segment file (through a read-only mmap).
+    """
+
+    def __init__(self, path, base, docs):
+        """
+        :param str path: The segment file
+        :param int base: Document id of its first document
+        :param int docs: Number of documents (as recorded in the manifest)
+        """
+        self.path = path
+        self.base = base
+        self.buf = map_file(path)
+        trailer = len(MAGIC) + _TRAILER.size
+        if self.buf[:len(MAGIC)] != MAGIC or self.buf[-len(MAGIC):] != MAGIC:
+            raise ValueError("Not an index segment: %s" % path)
+        footer_size = _TRAILER.unpack(self.buf[-trailer:-len(MAGIC)])[0]
+        footer = msgpack.unpackb(self.buf[-trailer - footer_size:-trailer])
+        self.docs = footer['docs']
+        if self.docs != docs:
+            raise ValueError("Segment %s has %d documents, not %d" % (path, self.docs, docs))
+        self.term_count = footer['terms']
+        self.term_blocks = footer['term_blocks']
+        self.first_terms = [block[0] for block in self.term_blocks]
+        self.doc_blocks = footer['doc_blocks']
+        self._term_cache = {}
+        self._doc_cache = {}
+
+    def close(self):
+        if not isinstance(self.buf, str):
+            self.buf.close()
+
+    def lookup(self, term):
+        """
+        :param str term: The term
+        :return tuple[int, list]|None Number of documents and skip entries of the term
+        """
+        index = bisect.bisect_right(self.first_terms, term) - 1
+        if index < 0:
+            return None
+        entries = self._term_block(index)
+        position = bisect.bisect_left(entries, [term])
+        if position < len(entries) and entries[position][0] == term:
+            return entries[position][1], entries[position][2]
+        return None
+
+    def _term_block(self, index):
+        entries = self._term_cache.get(index)
+        if entries is None:
+            _, offset, length = self.term_blocks[index]
+            entries = msgpack.unpackb(zlib.decompress(self.buf[offset:offset + length]))
+            if len(self._term_cache) >= _BLOCK_CACHE_SIZE:
+                self._term_cache.clear()
+            self._term_cache[index] = entries
+        return entries
+
+    def iter_terms(self):
+        """
+        :return generator[tuple[str, int, list]] Every term, in order, with its document count and skip entries
+        """
+        for index in xrange(len(self.term_blocks)):
+            _, offset, length = self.term_blocks[index]
+            for term, count, skips in msgpack.unpackb(zlib.decompress(self.buf[offset:offset + length])):
+                yield term, count, skips
+
+    def read_block(self, skips, index, with_positions=False):
+        """
+        :param list skips: The term's skip entries
+        :param int index: The block to read
+        :param bool with_positions: Also decode the positions (for text terms)
+        :return tuple[list[int], list[list[int]]|None] The ordinals of the block, and their positions
+        """
+        _, offset, docs_length, positions_length = skips[index]
+        previous = skips[index - 1][0] if index else -1
+        docs = []
+        for delta in _read_varints(self.buf[offset:offset + docs_length]):
+            previous += delta
+            docs.append(previous)
+        if not with_positions or not positions_length:
+            return docs, None
+
+        values = _read_varints(self.buf[offset + docs_length:offset + docs_length + positions_length])
+        positions = []
+        i = 0
+        for _ in docs:
+            count = values[i]
+            doc_positions = []
+            position = 0
+            for delta in values[i + 1:i + 1 + count]:
+                position += delta
+                doc_positions.append(position)
+            positions.append(doc_positions)
+            i += 1 + count
+        return docs, positions
+
+    def doc_block(self, index):
+        """
+        :return tuple[list[str], list[int|None]] Keys and dates of a block of documents
+        """
+        block = self._doc_cache.get(index)
+        if block is None:
+            offset, length = self.doc_blocks[index][:2]
+            block = msgpack.unpackb(zlib.decompress(self.buf[offset:offset + length]))
+            if len(self._doc_cache) >= _BLOCK_CACHE_SIZE:
+                self._doc_cache.clear()
+            self._doc_cache[index] = block
+        return block
+
+    def iter_docs(self):
+        for index in xrange(len(self.doc_blocks)):
+            keys, dates = self.doc_block(index)
+            for doc in zip(keys, dates):
+                yield doc
+
+
+class Searcher(object):
+    """
+    Searches a snapshot of an index. Call refresh() to see documents added since it was opened.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: The index directory
+        """
+        self.path = path
+        self.segments = []
+        self.refresh()
+
+    def refresh(self):
+        """
+        Opens the segments the index consists of now.
+        """
+        old = dict((segment.path, segment) for segment in self.segments)
+        while True:
+            manifest = _read_manifest(self.path)
+            segments = []
+            try:
+                for entry in manifest['segments']:
+                    path = os.path.join(self.path, entry['name'])
+                    segments.append(old.pop(path, None) or _Segment(path, entry['base'], entry['docs']))
+            except (IOError, OSError) as e:
+                # A merge replaced some of them after we read the manifest
+                if e.errno != errno.ENOENT:
+                    raise
+                old.update((segment.path, segment) for segment in segments)
+                continue
+            break
+
+        for segment in old.itervalues():
+            segment.close()
+        self.segments = segments
+        return self
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def search(self, query, limit=None, newest_first=False):
+        """
+        :param Query|str query: The query (a string is parsed with parse_query)
+        :param int limit: Return at most this many documents
+        :param bool newest_first: Return the last documents added first (and the last ones when there is a limit)
+        :return list[dict] The id, key and date of the matching documents, by id
+        """
+        if isinstance(query, basestring):
+            query = parse_query(query)
+
+        hits = []
+        segments = reversed(self.segments) if newest_first else self.segments
+        for segment in segments:
+            ordinals = query.docs(segment)
+            if newest_first:
+                ordinals = ordinals[::-1]
+            if limit is not None:
+                ordinals = ordinals[:limit - len(hits)]
+            for ordinal in ordinals:
+                keys, dates = segment.doc_block(ordinal // DOCS_PER_BLOCK)
+                i = ordinal % DOCS_PER_BLOCK
+                hits.append({"doc_id": segment.base + ordinal, "key": keys[i], "date": dates[i]})
+            if limit is not None and len(hits) >= limit:
+                break
+        return hits
+
+    def count(self, query):
+        """
+        :param Query|str query: The query
+        :return int Number of matching documents
+        """
+        if isinstance(query, basestring):
+            query = parse_query(query)
+        return sum(len(query.docs(segment)) for segment in self.segments)
+
+    def stats(self):
+        return {
+            "segments": len(self.segments),
+            "docs": sum(segment.docs for segment in self.segments),
+            "terms": sum(segment.term_count for segment in self.segments),
+            "bytes": sum(os.path.getsize(segment.path) for segment in self.segments if os.path.exists(segment.path)),
+        }
+
+
+class Query(object):
+    """
+    Base of the queries. Each one finds the ordinals of its documents within a segment.
+    """
+
+    def cost(self, segment):
+        """
+        :return int An upper bound of the number of matches in the segment
+        """
+        raise NotImplementedError()
+
+    def docs(self, segment):
+        """
+        :return list[int] The matching ordinals, in order
+        """
+        raise NotImplementedError()
+
+    def filter(self, segment, candidates):
+        """
+        :param list[int] candidates: Ordinals, in order
+        :return list[int] The candidates that match
+        """
+        docs = set(self.docs(segment))
+        return [doc for doc in candidates if doc in docs]
+
+
+class Term(Query):
+    """
+    Documents with a word in a text field (subject, body or filename; any of them when field is None).
+    """
+
+    def __init__(self, field, word):
+        if field is not None and field not in TEXT_FIELDS:
+            raise ValueError("Unknown text field: %s" % field)
+        self.field = field
+        self.word = _text(word).lower()
+        self._any = _any_field(field, lambda f: Term(f, word), TEXT_FIELDS)
+
+    def term(self):
+        return TEXT_FIELDS[self.field] + ':' + self.word.encode('utf-8')
+
+    def cost(self, segment):
+        if self._any is not None:
+            return self._any.cost(segment)
+        found = segment.lookup(self.term())
+        return found[0] if found else 0
+
+    def docs(self, segment):
+        if self._any is not None:
+            return self._any.docs(segment)
+        return _term_docs(segment, self.term())
+
+    def filter(self, segment, candidates):
+        if self._any is not None:
+            return self._any.filter(segment, candidates)
+        return _filter_term(segment, self.term(), candidates)
+
+
+class Phrase(Query):
+    """
+    Documents with words next to each other, in this order, in a text field.
+    """
+
+    def __init__(self, field, text):
+        if field is not None and field not in TEXT_FIELDS:
+            raise ValueError("Unknown text field: %s" % field)
+        self.field = field
+        self.words = tokenize(text)
+        self._any = _any_field(field, lambda f: Phrase(f, text), TEXT_FIELDS)
+        if self._any is None:
+            self._terms = And(*[Term(field, word) for word in self.words])
+
+    def cost(self, segment):
+        if self._any is not None:
+            return self._any.cost(segment)
+        return self._terms.cost(segment) if self.words else 0
+
+    def docs(self, segment):
+        if self._any is not None:
+            return self._any.docs(segment)
+        if not self.words:
+            return []
+        return self._adjacent(segment, self._terms.docs(segment))
+
+    def filter(self, segment, candidates):
+        if self._any is not None:
+            return self._any.filter(segment, candidates)
+        if not self.words:
+            return []
+        return self._adjacent(segment, self._terms.filter(segment, candidates))
+
+    def _adjacent(self, segment, candidates):
+        if len(self.words) == 1 or not candidates:
+            return candidates
+        positions = [_term_positions(segment, term.term(), candidates) for term in self._terms.queries]
+        matches = []
+        for doc in candidates:
+            # Where the phrase would start, according to each word
+            starts = set(positions[0][doc])
+            for i, word_positions in enumerate(positions[1:], 1):
+                starts.intersection_update([position - i for position in word_positions[doc]])
+                if not starts:
+                    break
+            else:
+                matches.append(doc)
+        return matches
+
+
+class Address(Query):
+    """
+    Documents with an address in an address field (from, to, cc, bcc or reply_to; any of them when
+    field is None). The value is a whole address, a domain ("@example.com") or a word of the local
+    part or display name.
+    """
+
+    def __init__(self, value, field=None):
+        if field is not None and field not in ADDRESS_FIELDS:
+            raise ValueError("Unknown address field: %s" % field)
+        self.field = field
+        self.value = _text(value).strip().lower()
+        self._any = _any_field(field, lambda f: Address(value, f), ADDRESS_FIELDS)
+
+    def term(self):
+        return ADDRESS_FIELDS[self.field] + ':' + self.value.encode('utf-8')
+
+    def cost(self, segment):
+        if self._any is not None:
+            return self._any.cost(segment)
+        found = segment.lookup(self.term())
+        return found[0] if found else 0
+
+    def docs(self, segment):
+        if self._any is not None:
+            return self._any.docs(segment)
+        return _term_docs(segment, self.term())
+
+    def filter(self, segment, candidates):
+        if self._any is not None:
+            return self._any.filter(segment, candidates)
+        return _filter_term(segment, self.term(), candidates)
+
+
+class DateRange(Query):
+    """
+    Documents dated from start (inclusive) to end (exclusive). Documents without a date never match.
+    """
+
+    def __init__(self, start=None, end=None):
+        """
+        :param datetime|int start: A naive datetime in UTC or a Unix timestamp (None for no lower bound)
+        :param datetime|int end: Same, None for no upper bound
+        """
+        self.start = _timestamp(start)
+        self.end = _timestamp(end)
+
+    def _matches(self, date):
+        return date is not None and (self.start is None or date >= self.start) and (self.end is None or date < self.end)
+
+    def _blocks(self, segment):
+        # Documents are mostly added in date order, so the date range of a block usually rules it out
+        for index, (_, _, low, high) in enumerate(segment.doc_blocks):
+            if low is None:
+                continue
+            if (self.start is None or high >= self.start) and (self.end is None or low < self.end):
+                yield index
+
+    def cost(self, segment):
+        return sum(min(DOCS_PER_BLOCK, segment.docs - index * DOCS_PER_BLOCK) for index in self._blocks(segment))
+
+    def docs(self, segment):
+        docs = []
+        for index in self._blocks(segment):
+            _, dates = segment.doc_block(index)
+            base = index * DOCS_PER_BLOCK
+            docs.extend(base + i for i, date in enumerate(dates) if self._matches(date))
+        return docs
+
+    def filter(self, segment, candidates):
+        blocks = set(self._blocks(segment))
+        matches = []
+        for doc in candidates:
+            index = doc // DOCS_PER_BLOCK
+            if index in blocks and self._matches(segment.doc_block(index)[1][doc % DOCS_PER_BLOCK]):
+                matches.append(doc)
+        return matches
+
+
+class And(Query):
+    """
+    Documents that match all the queries. The cheapest query is run, and the others only look at
+    its matches.
+    """
+
+    def __init__(self, *queries):
+        self.queries = list(queries)
+
+    def cost(self, segment):
+        return min(query.cost(segment) for query in self.queries) if self.queries else 0
+
+    def docs(self, segment):
+        if not self.queries:
+            return []
+        ordered = sorted(self.queries, key=lambda query: query.cost(segment))
+        docs = ordered[0].docs(segment)
+        for query in ordered[1:]:
+            if not docs:
+                break
+            docs = query.filter(segment, docs)
+        return docs
+
+    def filter(self, segment, candidates):
+        for query in sorted(self.queries, key=lambda query: query.cost(segment)):
+            if not candidates:
+                break
+            candidates = query.filter(segment, candidates)
+        return candidates
+
+
+class Or(Query):
+    """
+    Documents that match any of the queries.
+    """
+
+    def __init__(self, *queries):
+        self.queries = list(queries)
+
+    def cost(self, segment):
+        return sum(query.cost(segment) for query in self.queries)
+
+    def docs(self, segment):
+        docs = set()
+        for query in self.queries:
+            docs.update(query.docs(segment))
+        return sorted(docs)
+
+    def filter(self, segment, candidates):
+        matches = set()
+        remaining = candidates
+        for query in self.queries:
+            matches.update(query.filter(segment, remaining))
+            remaining = [doc for doc in remaining if doc not in matches]
+        return sorted(matches)
+
+
+def parse_query(text):
+    """
+    Parses a query string. Its parts are ANDed, and OR separates alternatives:
+
+        word                 the word in the subject, body or a filename
+        "some words"         the phrase in the subject, body or a filename
+        subject:word         also body:, filename: (with a word or a "phrase")
+        from:alice@example.com, to:@example.com, cc:alice
+                             an address, a domain or a word of an address (also bcc:, reply_to:,
+                             and address: for any of them)
+        after:2017-10-03     dated on or after (UTC; also with a time: 2017-10-03T14:05:12)
+        before:2017-11-01    dated before
+
+    :param str|unicode text: The query
+    :return Query
+    :raise ValueError When the query is malformed
+    """
+    alternatives = [[]]
+    for match in _QUERY_TOKEN.finditer(_text(text)):
+        field, phrase, word = match.groups()
+        if field is None and phrase is None and word == 'OR':
+            alternatives.append([])
+            continue
+        part = _query_part(field, phrase, word, match.group(0))
+        if part is not None:
+            alternatives[-1].append(part)
+
+    alternatives = [parts for parts in alternatives if parts]
+    if not alternatives:
+        raise ValueError("Empty query")
+    queries = [parts[0] if len(parts) == 1 else And(*parts) for parts in alternatives]
+    return queries[0] if len(queries) == 1 else Or(*queries)
+
+
+def _query_part(field, phrase, word, raw):
+    value = phrase if phrase is not None else word
+    if field is not None:
+        field = field.lower()
+        if field not in TEXT_FIELDS and field not in ADDRESS_FIELDS and field not in ('address', 'after', 'before'):
+            # Not a field, just text with a colon in it (e.g. a URL)
+            field = None
+            value = raw
+    if field in ('after', 'before'):
+        date = _parse_query_date(value)
+        return DateRange(start=date) if field == 'after' else DateRange(end=date)
+    if field == 'address':
+        return Address(value)
+    if field in ADDRESS_FIELDS:
+        return Address(value, field)
+
+    words = tokenize(value)
+    if not words:
+        # Nothing to search for (e.g. a lone "-"), rather than a phrase nothing matches
+        return None
+    if phrase is None and len(words) == 1:
+        return Term(field, words[0])
+    return Phrase(field, value)
+
+
+def _parse_query_date(value):
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %s (expected YYYY-MM-DD)" % value)
+
+
+def _any_field(field, make, fields):
+    if field is not None:
+        return None
+    return Or(*[make(f) for f in sorted(fields)])
+
+
+def _term_docs(segment, term):
+    found = segment.lookup(term)
+    if found is None:
+        return []
+    skips = found[1]
+    docs = []
+    for index in xrange(len(skips)):
+        docs.extend(segment.read_block(skips, index)[0])
+    return docs
+
+
+def _filter_term(segment, term, candidates):
+    found = segment.lookup(term)
+    if found is None:
+        return []
+    skips = found[1]
+    last_docs = [skip[0] for skip in skips]
+    matches = []
+    loaded = None
+    block_docs = None
+    index = 0
+    for doc in candidates:
+        # Skip the blocks that end before the candidate
+        index = bisect.bisect_left(last_docs, doc, index)
+        if index == len(skips):
+            break
+        if index != loaded:
+            block_docs = set(segment.read_block(skips, index)[0])
+            loaded = index
+        if doc in block_docs:
+            matches.append(doc)
+    return matches
+
+
+def _term_positions(segment, term, candidates):
+    """
+    :return dict[int, list[int]] The positions of the term in each candidate (which all contain it)
+    """
+    skips = segment.lookup(term)[1]
+    last_docs = [skip[0] for skip in skips]
+    wanted = set(candidates)
+    positions = {}
+    index = 0
+    for doc in candidates:
+        if doc in positions:
+            continue
+        index = bisect.bisect_left(last_docs, doc, index)
+        docs, block_positions = segment.read_block(skips, index, True)
+        for i, block_doc in enumerate(docs):
+            if block_doc in wanted:
+                positions[block_doc] = block_positions[i]
+    return positions
+
+
+def _append_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varints(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in bytearray(data):
+        if byte < 0x80:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    return values
+
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, 'MANIFEST'), 'rb') as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {"next_doc": 0, "next_segment": 0, "segments": []}
+
+
+def _write_manifest(path, manifest):
+    # Replaced in one go, so readers always see a complete manifest
+    tmp = os.path.join(path, 'MANIFEST.tmp')
+    with open(tmp, 'wb') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(path, 'MANIFEST'))
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple())
+    return int(value)
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
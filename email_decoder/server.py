@@ -0,0 +1,459 @@
+"""
+A long-running ingestion service: raw messages are sent over a TCP or Unix socket, parsed in a
+bounded pool of worker processes and the results are streamed back on the same connection.
+
+    python -m email_decoder.server serve --listen 127.0.0.1:8025 [--workers N] [--max-in-flight N]
+    python -m email_decoder.server load --connect 127.0.0.1:8025 [--connections N] FILE...
+
+Wire protocol: every frame, in both directions, is a 4-byte big-endian length followed by that
+many bytes (see email_decoder.framing). A request frame holds one raw message. Each response frame holds a msgpack record,
+{"message": {...}} or {"error": "..."}, the same records `email-decode.py --batch --format msgpack`
+writes. Responses come back in the order the requests were sent on that connection, so a client
+can pipeline requests without waiting for each response.
+
+Backpressure: at most max_in_flight messages are being parsed or waiting to be written back
+across all connections, and at most max_pending per connection. When either limit is hit the
+connection is simply not read from, so a client that sends faster than the pool can keep up
+with blocks on its socket instead of growing the server's memory.
+"""
+import argparse
+import os
+import os.path
+import Queue
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import multiprocessing
+import msgpack
+import structlog
+from email_decoder import batch
+from email_decoder.framing import POLL_INTERVAL
+from email_decoder.framing import ProtocolError
+from email_decoder.framing import read_frame
+from email_decoder.framing import write_frame
+
+
+def _init_worker():
+    # Ctrl-C reaches the whole process group; the workers must keep going so the server can drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.init_worker()
+
+
+def _decode_frame(raw):
+    """
+    Runs in a pool worker: parses one raw message into an encoded response record.
+    """
+    parser = batch._worker_parser or batch.make_parser()
+    try:
+        record = {"message": parser.message_from_bytes(raw)}
+    except Exception as e:
+        parser.logger.error('Failed to decode message', size=len(raw), error=e)
+        record = {"error": "%s: %s" % (type(e).__name__, e)}
+    return batch.encode_record(record, 'msgpack'), 'error' not in record
+
+
+class _Ready(object):
+    """
+    An already available response, queued like a pool result (e.g. a protocol error).
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class IngestServer(object):
+    """
+    Accepts connections on a TCP or Unix socket and parses the messages sent on them in a pool
+    of worker processes (flanker is CPU-bound, so threads would not help). Each connection is
+    served by a reader thread, which submits frames to the pool, and a writer thread, which
+    sends the results back in order.
+    """
+
+    def __init__(self, address, workers=None, max_in_flight=None, max_pending=32, max_frame_size=64 * 1024 * 1024, maxtasksperchild=None, logger=None):
+        """
+        :param tuple|str address: (host, port) to listen on TCP, or a path for a Unix socket
+        :param int workers: Number of worker processes (defaults to the CPU count)
+        :param int max_in_flight: Messages accepted but not yet answered, across all connections (defaults to 4 per worker)
+        :param int max_pending: Messages accepted but not yet answered on a single connection
+        :param int max_frame_size: Largest message accepted, in bytes
+        :param int maxtasksperchild: Recycle workers after this many messages
+        :param logger: structlog logger
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = workers * 4
+
+        self.address = address
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.max_frame_size = max_frame_size
+        self.maxtasksperchild = maxtasksperchild
+        self.logger = logger or structlog.wrap_logger(structlog.PrintLogger(sys.stderr))
+
+        self.draining = False
+        """
+        Set once shutdown() was called: no new connections or frames are accepted
+        :type bool
+        """
+
+        self.accepted = 0
+        self.completed = 0
+        self.failed = 0
+        self.connections = 0
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight = 0
+        self._lock = threading.Condition()
+        self._pool = None
+        self._server = None
+
+    def start(self):
+        """
+        Creates the worker pool and binds the socket. Call serve_forever() to start accepting.
+        """
+        self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, maxtasksperchild=self.maxtasksperchild)
+
+        if isinstance(self.address, tuple):
+            server = _TCPServer(self.address, _ConnectionHandler)
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            server = _UnixServer(self.address, _ConnectionHandler)
+        server.ingest = self
+        self._server = server
+        return self
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def serve_forever(self):
+        self._server.serve_forever(poll_interval=POLL_INTERVAL)
+
+    def shutdown(self, timeout=30):
+        """
+        Drains the server: stops accepting connections and frames, waits for every accepted
+        message to be answered and then stops the pool. Must not be called from the thread
+        running serve_forever().
+
+        :param float timeout: Seconds to wait for in-flight messages before giving up on them
+        :return bool Whether everything was drained in time
+        """
+        self.draining = True
+        self.logger.info('Draining', in_flight=self._in_flight, connections=self.connections)
+        self._server.shutdown()
+
+        deadline = time.time() + timeout
+        with self._lock:
+            while self.connections and time.time() < deadline:
+                self._lock.wait(min(POLL_INTERVAL, max(0, deadline - time.time())))
+            drained = not self.connections
+
+        if drained:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+        self._server.server_close()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+        self.logger.info('Stopped', drained=drained, **self.stats())
+        return drained
+
+    def stats(self):
+        """
+        :return dict Counters since the server started
+        """
+        return {
+            "accepted": self.accepted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": self._in_flight,
+            "connections": self.connections,
+        }
+
+    def _submit(self, raw):
+        # Blocks while max_in_flight messages are outstanding, which stops the connection being read
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+            self.accepted += 1
+        return self._pool.apply_async(_decode_frame, (raw,))
+
+    def _done(self, ok):
+        with self._lock:
+            self._in_flight -= 1
+            self.completed += 1
+            if not ok:
+                self.failed += 1
+        self._slots.release()
+
+    def _connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def _connection_closed(self):
+        with self._lock:
+            self.connections -= 1
+            self._lock.notify_all()
+
+
+class _ConnectionHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        ingest = self.server.ingest
+        sock = self.request
+
+        # (result, holds_slot) in request order; its size is the per-connection queue depth
+        pending = Queue.Queue(ingest.max_pending)
+        writer = threading.Thread(target=self._write_responses, args=(ingest, sock, pending))
+        writer.daemon = True
+
+        ingest._connection_opened()
+        writer.start()
+        try:
+            while True:
+                try:
+                    raw = read_frame(sock, ingest.max_frame_size, lambda: ingest.draining)
+                except ProtocolError as e:
+                    ingest.logger.warning('Protocol error', error=str(e))
+                    record = {"error": "%s: %s" % (type(e).__name__, e)}
+                    pending.put((_Ready((batch.encode_record(record, 'msgpack'), False)), False))
+                    break
+                except socket.error as e:
+                    ingest.logger.warning('Connection error', error=str(e))
+                    break
+
+                if raw is None:
+                    break
+                pending.put((ingest._submit(raw), True))
+        finally:
+            pending.put(None)
+            writer.join()
+            ingest._connection_closed()
+
+    def _write_responses(self, ingest, sock, pending):
+        broken = False
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+
+            result, holds_slot = item
+            encoded, ok = result.get()
+            if not broken:
+                try:
+                    sock.sendall(encoded)
+                except socket.error:
+                    # Keep collecting the results so their slots are released
+                    broken = True
+            if holds_slot:
+                ingest._done(ok)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Client(object):
+    """
+    A minimal client for the ingestion server, mainly for tests and load testing.
+    """
+
+    def __init__(self, address, timeout=None):
+        """
+        :param tuple|str address: (host, port) or the path of a Unix socket
+        :param float timeout: Socket timeout in seconds
+        """
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address, timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+
+    def send(self, raw):
+        """
+        Sends a message without waiting for the response (see receive()).
+        """
+        write_frame(self.sock, raw)
+
+    def receive(self):
+        """
+        :return dict The next response record
+        """
+        frame = read_frame(self.sock)
+        if frame is None:
+            raise ProtocolError("Connection closed by the server")
+        return msgpack.unpackb(frame)
+
+    def parse(self, raw):
+        """
+        Sends a message and waits for its response.
+
+        :param str raw: The raw message
+        :return dict {"message": {...}} or {"error": "..."}
+        """
+        self.send(raw)
+        return self.receive()
+
+    def close(self):
+        self.sock.close()
+
+
+def load_test(address, raws, connections=4, total=None):
+    """
+    Sends the messages over several connections at once, each connection pipelining its
+    requests, and measures throughput and latency.
+
+    :param tuple|str address: The server address
+    :param list[str] raws: Raw messages to send (cycled through until total is reached)
+    :param int connections: Number of concurrent connections
+    :param int total: Number of messages to send (defaults to len(raws))
+    :return dict
+    """
+    total = total or len(raws)
+    per_connection = [range(i, total, connections) for i in xrange(connections)]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run(indexes):
+        client = Client(address)
+        sent_at = Queue.Queue()
+
+        def sender():
+            try:
+                for i in indexes:
+                    sent_at.put(time.time())
+                    client.send(raws[i % len(raws)])
+            except socket.error:
+                pass
+
+        thread = threading.Thread(target=sender)
+        thread.daemon = True
+        thread.start()
+        for _ in indexes:
+            try:
+                record = client.receive()
+            except (ProtocolError, socket.error):
+                # The server is draining; the remaining requests go unanswered
+                break
+            elapsed = time.time() - sent_at.get()
+            with lock:
+                latencies.append(elapsed)
+                if 'error' in record:
+                    errors[0] += 1
+        client.close()
+
+    start = time.time()
+    threads = [threading.Thread(target=run, args=(indexes,)) for indexes in per_connection if indexes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies.sort()
+    return {
+        "messages": len(latencies),
+        "unanswered": total - len(latencies),
+        "errors": errors[0],
+        "connections": connections,
+        "seconds": seconds,
+        "messages_per_sec": len(latencies) / seconds if seconds else None,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    }
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(pct / 100.0 * (len(sorted_values) - 1)))]
+
+
+def parse_address(value):
+    """
+    :param str value: host:port, or the path of a Unix socket
+    :return tuple|str
+    """
+    if os.sep not in value and ':' in value:
+        host, port = value.rsplit(':', 1)
+        return host, int(port)
+    return value
+
+
+def serve(address, **kwargs):
+    """
+    Runs a server until SIGTERM or SIGINT, then drains it.
+    """
+    server = IngestServer(address, **kwargs).start()
+
+    def on_signal(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on this thread
+        stopper = threading.Thread(target=server.shutdown)
+        stopper.start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    server.logger.info('Listening', address=server.server_address, workers=server.workers,
+                       max_in_flight=server.max_in_flight, max_pending=server.max_pending)
+    # Returns as soon as the drain starts; the interpreter then waits for the (non-daemon) drain thread
+    server.serve_forever()
+
+
+def main(argv=None):
+    opt_parser = argparse.ArgumentParser(description='Email ingestion server')
+    commands = opt_parser.add_subparsers(dest='command')
+
+    serve_cmd = commands.add_parser('serve', help='Run the server')
+    serve_cmd.add_argument('--listen', dest='listen', type=str, help='host:port or the path of a Unix socket', default='127.0.0.1:8025')
+    serve_cmd.add_argument('--workers', dest='workers', type=int, help='Number of worker processes (default: CPU count)', default=None)
+    serve_cmd.add_argument('--max-in-flight', dest='max_in_flight', type=int, help='Messages accepted but not yet answered, across all connections (default: 4 per worker)', default=None)
+    serve_cmd.add_argument('--max-pending', dest='max_pending', type=int, help='Messages accepted but not yet answered, per connection', default=32)
+    serve_cmd.add_argument('--max-frame-size', dest='max_frame_size', type=int, help='Largest message accepted, in bytes', default=64 * 1024 * 1024)
+    serve_cmd.add_argument('--maxtasksperchild', dest='maxtasksperchild', type=int, help='Recycle workers after this many messages', default=None)
+
+    load_cmd = commands.add_parser('load', help='Load test a running server')
+    load_cmd.add_argument('file', metavar='file', type=str, nargs='+', help='Email files, directories or glob patterns to send')
+    load_cmd.add_argument('--connect', dest='connect', type=str, help='host:port or the path of a Unix socket', default='127.0.0.1:8025')
+    load_cmd.add_argument('--connections', dest='connections', type=int, help='Concurrent connections', default=4)
+    load_cmd.add_argument('--total', dest='total', type=int, help='Messages to send, cycling through the files', default=None)
+
+    args = opt_parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(parse_address(args.listen), workers=args.workers, max_in_flight=args.max_in_flight,
+              max_pending=args.max_pending, max_frame_size=args.max_frame_size,
+              maxtasksperchild=args.maxtasksperchild)
+    else:
+        raws = []
+        for path in batch.iter_paths(args.file):
+            with open(path, 'rb') as f:
+                raws.append(f.read())
+        if not raws:
+            sys.stderr.write("No files to send\n")
+            sys.exit(1)
+        result = load_test(parse_address(args.connect), raws, args.connections, args.total)
+        sys.stdout.write("%(messages)d messages (%(errors)d errors, %(unanswered)d unanswered) over %(connections)d connections in %(seconds).2fs: "
+                         "%(messages_per_sec).1f msg/s, p50 %(p50_ms).2fms, p99 %(p99_ms).2fms\n" % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import errno
+import os
+import os.path
+import re
+
+MBOX_FROM_ESCAPE = re.compile(r'^>+From ')
+
+MAILDIR_SUBDIRS = ('new', 'cur')
+
+
+def iter_raw_messages(source, offset=0):
+    """
+    Reads raw messages one at a time from a mailbox. A directory is read as a Maildir,
+    anything else as an mbox file.
+
+    :param str source: Path to an mbox file or a Maildir directory
+    :param int|str offset: Where to resume reading (see iter_mbox and iter_maildir)
+    :return generator[tuple[int|str, int|str, str]] (start offset, end offset, raw message)
+    """
+    if os.path.isdir(source):
+        return iter_maildir(source, offset or None)
+    return iter_mbox(source, offset)
+
+
+def iter_mbox(path, offset=0):
+    """
+    Reads an mbox file incrementally, one From_-line delimited message at a time. Only the
+    current message is held in memory.
+
+    The offsets are byte offsets into the file: start is where the From_ line of the message
+    begins and end is where the next message begins. Passing a message's end offset back in
+    resumes reading right after that message.
+
+    :param str path: Path to the mbox file
+    :param int offset: Byte offset of the From_ line to start reading from
+    :return generator[tuple[int, int, str]] (start offset, end offset, raw message)
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        pos = offset
+        start = None
+        lines = []
+
+        while True:
+            line = f.readline()
+            if not line:
+                break
+
+            line_start = pos
+            pos += len(line)
+
+            if line.startswith('From '):
+                if start is not None:
+                    yield start, line_start, _mbox_message_from_lines(lines)
+                start = line_start
+                lines = []
+            elif start is not None:
+                if line.startswith('>') and MBOX_FROM_ESCAPE.match(line):
+                    line = line[1:]
+                lines.append(line)
+
+        if start is not None:
+            yield start, pos, _mbox_message_from_lines(lines)
+
+
+def _mbox_message_from_lines(lines):
+    # The blank line before the next From_ line is a separator, not part of the message
+    if lines and lines[-1] in ('\n', '\r\n'):
+        lines.pop()
+    return ''.join(lines)
+
+
+def iter_maildir(path, offset=None):
+    """
+    Reads the messages in a Maildir, one file at a time, in the order of their unique names
+    (the filenames without the ':2,' info suffix, which start with the delivery time).
+
+    The offsets are those unique names, which stay the same when a message moves from 'new' to
+    'cur' or its flags change: both start and end are the name of the message. Passing a
+    message's end offset back in resumes reading right after that message, with the messages
+    that arrived since.
+
+    :param str path: Path to the Maildir (the directory containing cur/new/tmp)
+    :param str offset: Unique name of the last message already read, or None to read them all
+    :return generator[tuple[str, str, str]] (start offset, end offset, raw message)
+    """
+    subdirs = [os.path.join(path, d) for d in MAILDIR_SUBDIRS if os.path.isdir(os.path.join(path, d))]
+    if not subdirs:
+        raise ValueError("Not a Maildir (no cur or new directory): %s" % path)
+    if offset is not None and not isinstance(offset, basestring):
+        raise ValueError("Not a Maildir offset (expected the unique name of a message): %r" % (offset,))
+
+    files = _maildir_files(subdirs)
+    for name in sorted(files):
+        if offset is not None and name <= offset:
+            continue
+        raw = _read_maildir_message(subdirs, name, files[name])
+        if raw is not None:
+            yield name, name, raw
+
+
+def _maildir_files(subdirs):
+    """
+    :return dict[str, str] Path of each message by its unique name
+    """
+    files = {}
+    for subdir in subdirs:
+        for filename in os.listdir(subdir):
+            if not filename.startswith('.'):
+                files.setdefault(_maildir_name(filename), os.path.join(subdir, filename))
+    return files
+
+
+def _maildir_name(filename):
+    return filename.split(':', 1)[0]
+
+
+def _read_maildir_message(subdirs, name, path):
+    """
+    Reads a message by its unique name, from the path it was listed at or, when it has moved
+    since (to 'cur', or its flags changed), from where it is now.
+
+    :return str|None The raw message, or None when it is gone or can't be opened
+    """
+    raw = _read_if_exists(path)
+    if raw is None:
+        # Listed again only once: an entry that still can't be opened (e.g. a dangling symlink)
+        # is skipped
+        path = _maildir_files(subdirs).get(name)
+        if path is not None:
+            raw = _read_if_exists(path)
+    return raw
+
+
+def _read_if_exists(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
@@ -0,0 +1,402 @@
+"""
+Coordinated decoding of a spool directory shared by several hosts (e.g. over NFS).
+
+Any number of workers, on any number of hosts, can work through the same spool at the same time.
+A worker claims a message by creating its lease file with O_EXCL, which only one worker can do.
+While it works it keeps touching its leases, so a lease that hasn't been touched for
+lease_seconds belongs to a dead worker, and any other worker may break it and take the message
+over. Once the record of a message is safely in the worker's output file, the message is marked
+done and nobody claims it again. Workers simply claim whatever isn't done or leased, so faster
+hosts end up doing more of the work.
+
+Layout of the spool:
+
+    <spool>/...               the messages: every file in it and its sub-directories, except
+                              files and directories starting with a dot (so producers can write
+                              ".name.tmp" and rename it when it is complete)
+    <spool>/.leases/<key>     lease of a message that is being decoded
+    <spool>/.done/<key>       marker of a message whose record has been written
+
+Each worker writes its records to a file of its own in the output directory, in the same
+formats as batch mode (see email_decoder.batch).
+
+The spool's file system has to support exclusive creates (NFSv3 and later do), and the clocks of
+the hosts should agree to well within lease_seconds. A worker that dies after writing records
+but before marking them done leaves those records in its output file, and the messages are
+decoded again by another worker, so readers of the output should key records by path.
+"""
+import errno
+import multiprocessing
+import os
+import os.path
+import socket
+import threading
+import time
+import urllib
+import uuid
+import zlib
+from email_decoder import batch
+from email_decoder.columnar import ColumnarWriter
+
+EXTENSIONS = {'json': 'ndjson', 'msgpack': 'msgpack', 'columnar': 'cols'}
+
+
+class Spool(object):
+    """
+    The messages of a spool directory and their leases and done markers.
+    """
+
+    LEASES = '.leases'
+    DONE = '.done'
+
+    def __init__(self, path, lease_seconds=600):
+        """
+        :param str path: The spool directory
+        :param int lease_seconds: A lease that hasn't been renewed for this long is considered abandoned
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.lease_dir = os.path.join(path, self.LEASES)
+        self.done_dir = os.path.join(path, self.DONE)
+
+    def create(self):
+        """
+        Creates the lease and done directories if they don't exist yet.
+        """
+        for directory in (self.lease_dir, self.done_dir):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return self
+
+    def pending(self):
+        """
+        :return list[tuple[str, str]] (key, path) of the messages that aren't done yet, ordered by key
+        """
+        done = set(os.listdir(self.done_dir))
+        pending = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = message_key(os.path.relpath(path, self.path))
+                if key not in done:
+                    pending.append((key, path))
+        pending.sort()
+        return pending
+
+    def claim(self, key, token):
+        """
+        Takes the lease of a message, breaking it first when it was abandoned.
+
+        :param str key: The message's key
+        :param str token: Identifies the lease holder
+        :return bool Whether the lease was taken (False when someone else holds it or the message is done)
+        """
+        lease = os.path.join(self.lease_dir, key)
+        try:
+            fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not self._break_abandoned(lease):
+                return False
+            try:
+                fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+
+        try:
+            os.write(fd, token)
+        finally:
+            os.close(fd)
+
+        # Done markers are written before leases are released, so once we hold the lease this
+        # tells for sure whether someone finished the message since it was listed
+        if self.is_done(key):
+            self.release(key, token)
+            return False
+        return True
+
+    def renew(self, key):
+        """
+        Resets the expiry of a lease (call it regularly while working on the message).
+        """
+        try:
+            os.utime(os.path.join(self.lease_dir, key), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def owns(self, key, token):
+        """
+        :return bool Whether the lease of the message is (still) held with this token
+        """
+        try:
+            with open(os.path.join(self.lease_dir, key), 'rb') as f:
+                return f.read() == token
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def release(self, key, token):
+        if self.owns(key, token):
+            _unlink(os.path.join(self.lease_dir, key))
+
+    def is_done(self, key):
+        return os.path.exists(os.path.join(self.done_dir, key))
+
+    def mark_done(self, key, worker_id):
+        """
+        :param str key: The message's key
+        :param str worker_id: Recorded in the marker, to know who decoded the message
+        """
+        with open(os.path.join(self.done_dir, key), 'wb') as f:
+            f.write(worker_id)
+
+    def progress(self):
+        """
+        :return dict Number of messages done, leased and not done (leased ones included)
+        """
+        return {
+            "done": len(os.listdir(self.done_dir)),
+            "leased": len(os.listdir(self.lease_dir)),
+            "pending": len(self.pending()),
+        }
+
+    def _break_abandoned(self, lease):
+        """
+        Removes a lease that hasn't been renewed in time.
+
+        :return bool Whether the lease is gone (so it can be claimed)
+        """
+        try:
+            before = os.stat(lease)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return True
+        if before.st_mtime + self.lease_seconds > time.time():
+            return False
+
+        # Several workers can find the same abandoned lease. Moving it away is atomic, so only
+        # one of them gets it; but by then it may be the fresh lease of a worker that broke the
+        # old one first, in which case it is put back.
+        moved = '%s.abandoned-%s' % (lease, uuid.uuid4().hex)
+        try:
+            os.rename(lease, moved)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return True
+
+        after = os.stat(moved)
+        if (after.st_ino, after.st_mtime) != (before.st_ino, before.st_mtime):
+            try:
+                os.link(moved, lease)
+            except OSError:
+                pass
+            _unlink(moved)
+            return False
+
+        _unlink(moved)
+        return True
+
+
+class _Heartbeat(object):
+    """
+    Renews a set of leases from a background thread, so they stay alive however long a single
+    message takes to decode.
+    """
+
+    def __init__(self, spool, keys):
+        self.spool = spool
+        self.keys = keys
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        # A few renewals per lease period, so one late wake-up doesn't let a lease expire
+        interval = self.spool.lease_seconds / 4.0
+        while not self._stopped.wait(interval):
+            for key in self.keys:
+                self.spool.renew(key)
+
+
+def message_key(relative_path):
+    """
+    :param str relative_path: Path of a message relative to the spool
+    :return str The name of its lease and done marker
+    """
+    return urllib.quote(relative_path.replace(os.sep, '/'), safe='')
+
+
+def default_worker_id():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def run_spool_worker(spool, out_dir, fmt='json', claim_size=16, headers_only=False, poll_seconds=5.0, worker_id=None):
+    """
+    Decodes messages from the spool until all of them are done. Messages are claimed claim_size at a
+    time; their records are written and synced to the output file before they are marked done.
+
+    :param Spool spool: The spool
+    :param str out_dir: Directory the worker's output file is written to
+    :param str fmt: 'json', 'msgpack' or 'columnar' (see email_decoder.batch.run_batch)
+    :param int claim_size: Number of messages claimed (and written) at a time
+    :param bool headers_only: Only parse the header block of each message
+    :param float poll_seconds: How long to wait before looking again when all remaining messages are leased by others
+    :param str worker_id: Name of the worker, used for its output file (defaults to host and pid)
+    :return tuple[int, int] Number of messages this worker processed and number of failures
+    """
+    if fmt not in batch.FORMATS:
+        raise ValueError("Unsupported batch format: %s" % fmt)
+
+    worker_id = worker_id or default_worker_id()
+    token = '%s %s' % (worker_id, uuid.uuid4().hex)
+    out_path = os.path.join(out_dir, '%s-%s.%s' % (worker_id, time.strftime('%Y%m%d%H%M%S'), EXTENSIONS[fmt]))
+
+    total = 0
+    failed = 0
+    with open(out_path, 'wb') as out:
+        columnar = ColumnarWriter(out, chunk_rows=claim_size) if fmt == 'columnar' else None
+        while True:
+            pending = spool.pending()
+            if not pending:
+                break
+
+            # Start at a different place than the other workers, so they rarely go for the same messages
+            start = zlib.crc32(token) % len(pending)
+            claimed = []
+            worked = False
+            for key, path in pending[start:] + pending[:start]:
+                if spool.claim(key, token):
+                    claimed.append((key, path))
+                if len(claimed) == claim_size:
+                    processed, failures = _process_claimed(spool, claimed, token, worker_id, out, columnar, fmt, headers_only)
+                    total += processed
+                    failed += failures
+                    claimed = []
+                    worked = True
+            if claimed:
+                processed, failures = _process_claimed(spool, claimed, token, worker_id, out, columnar, fmt, headers_only)
+                total += processed
+                failed += failures
+                worked = True
+
+            if not worked:
+                # Everything left is leased by other workers: wait for them to finish (or for
+                # their leases to expire)
+                time.sleep(poll_seconds)
+
+        if columnar is not None:
+            columnar.close()
+    return total, failed
+
+
+def _process_claimed(spool, claimed, token, worker_id, out, columnar, fmt, headers_only):
+    try:
+        results = []
+        with _Heartbeat(spool, [key for key, _ in claimed]):
+            for key, path in claimed:
+                record = batch.decode_path(path, headers_only=headers_only)
+                if fmt == 'columnar':
+                    results.append((key, batch.record_rows(record), 'error' not in record))
+                else:
+                    results.append((key, batch.encode_record(record, fmt), 'error' not in record))
+
+        # Leave out messages another worker took over in the meantime (if we were stalled for
+        # longer than the lease)
+        results = [result for result in results if spool.owns(result[0], token)]
+        for _, encoded, _ in results:
+            if columnar is not None:
+                columnar.add_rows(encoded)
+            else:
+                out.write(encoded)
+        if columnar is not None:
+            columnar.flush()
+        out.flush()
+        os.fsync(out.fileno())
+
+        for key, _, _ in results:
+            spool.mark_done(key, worker_id)
+        return len(results), sum(1 for _, _, ok in results if not ok)
+    finally:
+        # Done or not, the messages are free again (for someone else to retry, if not done)
+        for key, _ in claimed:
+            spool.release(key, token)
+
+
+def _spool_worker(args):
+    spool, out_dir, fmt, claim_size, headers_only, poll_seconds = args
+    return run_spool_worker(spool, out_dir, fmt, claim_size, headers_only, poll_seconds)
+
+
+def run_spool(spool_path, out_dir, fmt='json', workers=None, claim_size=16, headers_only=False, lease_seconds=600, poll_seconds=5.0,
+              result_cache=None, engine='flanker', html_text=None):
+    """
+    Runs workers (in a process pool) on a shared spool until every message in it is done. Run this
+    on as many hosts as needed.
+
+    :param str spool_path: The spool directory
+    :param str out_dir: Directory the workers write their output files to
+    :param str fmt: 'json', 'msgpack' or 'columnar'
+    :param int workers: Number of worker processes (defaults to the CPU count)
+    :param int claim_size: Number of messages a worker claims (and writes) at a time
+    :param bool headers_only: Only parse the header block of each message
+    :param int lease_seconds: A lease that hasn't been renewed for this long is taken over by other workers
+    :param float poll_seconds: How long idle workers wait before looking for work again
+    :param email_decoder.resultcache.ResultCache result_cache: Read results back from (and add new ones to) this cache
+    :param str engine: How the parsers find the parts of a message (see Parser.engine)
+    :param str html_text: Derive body_text from HTML bodies when there is no text part (see Parser.html_text)
+    :return tuple[int, int] Number of messages processed on this host and number of failures
+    """
+    if os.path.abspath(out_dir).startswith(os.path.join(os.path.abspath(spool_path), '')):
+        # The output files would be taken for messages
+        raise ValueError("The output directory can't be inside the spool")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    spool = Spool(spool_path, lease_seconds).create()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if result_cache is not None:
+        result_cache.create().close()
+
+    args = [(spool, out_dir, fmt, claim_size, headers_only, poll_seconds)] * workers
+    if workers <= 1:
+        batch.init_worker(result_cache=result_cache, engine=engine, html_text=html_text)
+        results = [_spool_worker(args[0])]
+    else:
+        pool = multiprocessing.Pool(workers, initializer=batch.init_worker, initargs=(None, result_cache, engine, html_text))
+        try:
+            results = pool.map(_spool_worker, args, chunksize=1)
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    return sum(total for total, _ in results), sum(failed for _, failed in results)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
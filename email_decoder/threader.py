@@ -0,0 +1,370 @@
+"""
+Incremental conversation threading.
+
+Messages are added to a ThreadIndex one at a time as they are parsed. Each message is linked to
+the messages it references (JWZ-style: Message-ID, In-Reply-To and References), and to the thread
+of an earlier message with the same normalised subject when it is a reply without usable
+references. The id -> thread mapping is kept in SQLite, so looking up the thread of a message is a
+single indexed lookup no matter how large the archive is, and adding a message only touches the
+threads it links.
+"""
+import calendar
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+_MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+
+# Reply and forward markers: "Re:", "RE[2]:", "Fwd:", "AW:", "SV:" ... and list tags such as "[dev]"
+_SUBJECT_PREFIX = re.compile(r'^\s*(?:(?:re|fwd?|aw|sv|wg|antw|vs)\s*(?:\[\d+\]|\(\d+\))?\s*:|\[[^\]]*\])\s*', re.I)
+_REPLY_PREFIX = re.compile(r'^\s*(?:\[[^\]]*\]\s*)*(?:re|aw|sv|antw|vs)\s*(?:\[\d+\]|\(\d+\))?\s*:', re.I)
+_WHITESPACE = re.compile(r'\s+')
+
+# Maximum number of ids in a single "IN (...)" query (SQLite limits bound parameters)
+_MAX_VARIABLES = 500
+
+
+def normalize_message_id(value):
+    """
+    :param str value: A Message-ID header value or a single reference, with or without angle brackets
+    :return unicode|None The id without brackets or surrounding whitespace
+    """
+    if not value:
+        return None
+    value = _text(value)
+    match = _MESSAGE_ID.search(value)
+    if match:
+        return match.group(1)
+    value = value.strip().strip('<>')
+    return value or None
+
+
+def normalize_references(values):
+    """
+    :param list[str] values: References as parsed by parse_references_hval_list
+    :return list[unicode] Normalised ids, oldest first, without duplicates
+    """
+    ids = []
+    seen = set()
+    for value in values or ():
+        for found in _MESSAGE_ID.findall(_text(value)) or [normalize_message_id(value)]:
+            if found and found not in seen:
+                seen.add(found)
+                ids.append(found)
+    return ids
+
+
+def normalize_subject(subject):
+    """
+    Strips reply/forward prefixes and list tags and collapses whitespace, so that all messages of
+    a conversation have the same normalised subject.
+
+    :param str subject:
+    :return unicode
+    """
+    subject = _text(subject or '')
+    while True:
+        stripped = _SUBJECT_PREFIX.sub('', subject, 1)
+        if stripped == subject:
+            break
+        subject = stripped
+    return _WHITESPACE.sub(' ', subject).strip().lower()
+
+
+def is_reply_subject(subject):
+    return bool(_REPLY_PREFIX.match(_text(subject or '')))
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    return value.decode('utf-8', 'replace')
+
+
+class ThreadIndex(object):
+    """
+    A persistent index from message ids to thread ids.
+
+    Every id a message mentions is recorded: the message's own id, and each id it references
+    (as a placeholder until that message itself is added). All of them map to the same thread,
+    so a reply that arrives before its parent still ends up in the right thread. When a message
+    links two existing threads they are merged, moving the ids of the smaller thread.
+    """
+
+    def __init__(self, path, merge_subjects=True):
+        """
+        :param str path: Path of the SQLite database (created if it doesn't exist)
+        :param bool merge_subjects: Put replies without known references into the latest thread with the same normalised
+            subject (and a message into a thread that so far only has replies with its subject)
+        """
+        self.path = path
+        self.merge_subjects = merge_subjects
+        self._db = None
+        self._db_pid = None
+        self._in_transaction = False
+
+    def _connection(self):
+        # Connections can't be shared with forked children, so each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._upgrade(self._db)
+            # AUTOINCREMENT: the ids of threads that were merged away are never handed out again,
+            # so a thread id that was already reported can't come to mean another conversation
+            self._db.executescript(
+                'CREATE TABLE IF NOT EXISTS threads ('
+                '  thread_id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT,'
+                '  size INTEGER NOT NULL, ids INTEGER NOT NULL, last_date REAL);'
+                'CREATE TABLE IF NOT EXISTS messages ('
+                '  message_id TEXT PRIMARY KEY, thread_id INTEGER NOT NULL,'
+                '  parent_id TEXT, present INTEGER NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id);'
+                'CREATE TABLE IF NOT EXISTS subjects ('
+                '  subject TEXT PRIMARY KEY, thread_id INTEGER NOT NULL, orphan INTEGER NOT NULL);'
+            )
+            self._db_pid = os.getpid()
+            self._in_transaction = False
+        return self._db
+
+    def _upgrade(self, db):
+        # Indexes created before thread ids were AUTOINCREMENT get their threads table rebuilt
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'threads'").fetchone()
+            if row is not None and 'AUTOINCREMENT' not in row[0].upper():
+                db.execute('ALTER TABLE threads RENAME TO threads_old')
+                db.execute(
+                    'CREATE TABLE threads ('
+                    '  thread_id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT,'
+                    '  size INTEGER NOT NULL, ids INTEGER NOT NULL, last_date REAL)')
+                # Also starts the sequence at the highest id
+                db.execute('INSERT INTO threads SELECT * FROM threads_old')
+                db.execute('DROP TABLE threads_old')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def create(self):
+        """
+        Creates the database if it doesn't exist yet. Processes that create the same new index at
+        the same time get in each other's way, so when several processes will use the index, call
+        this once before starting them.
+        """
+        self._connection()
+        return self
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups several add() calls into one transaction, which is much faster when adding many
+        messages at once. Other processes can't write to the index in the meantime.
+        """
+        db = self._connection()
+        if self._in_transaction:
+            yield
+            return
+
+        db.execute('BEGIN IMMEDIATE')
+        self._in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self._in_transaction = False
+            db.execute('ROLLBACK')
+            raise
+        self._in_transaction = False
+        db.execute('COMMIT')
+
+    def add(self, message, message_id=None):
+        """
+        Adds a parsed message to the index. Adding the same message again is a no-op.
+
+        :param email_decoder.models.message.Message message: The message
+        :param str message_id: Overrides the message's own Message-ID (e.g. a generated one for messages without)
+        :return int The id of the thread the message is in
+        """
+        mid = normalize_message_id(message_id or message.message_id)
+        references = [r for r in normalize_references(message.references) if r != mid]
+        date = _timestamp(message.message_date)
+        return self.add_ids(mid, references, message.subject, date)
+
+    def add_all(self, messages):
+        """
+        Adds several messages in a single transaction.
+
+        :param iterable[email_decoder.models.message.Message] messages:
+        :return list[int] The thread of each message
+        """
+        with self.transaction():
+            return [self.add(message) for message in messages]
+
+    def add_ids(self, message_id, references, subject=None, date=None):
+        """
+        Adds a message by its (normalised) id and references.
+
+        :param unicode message_id: The message's id, None if it has none
+        :param list[unicode] references: Referenced ids, oldest first (the last one is the parent)
+        :param str subject: The message's subject
+        :param float date: Unix timestamp of the message
+        :return int The thread id
+        """
+        with self.transaction():
+            db = self._connection()
+            known = self._lookup(db, ([message_id] if message_id else []) + references)
+
+            if message_id in known and known[message_id][1]:
+                # Already added
+                return known[message_id][0]
+
+            normalized = normalize_subject(subject)
+            is_reply = is_reply_subject(subject)
+            # Whether the thread is only known by the subject of a reply, i.e. its first message
+            # hasn't been seen; the first message (not a reply itself) can then join by subject
+            orphan = False
+
+            thread_ids = set(thread_id for thread_id, _ in known.values())
+            if not thread_ids and normalized and self.merge_subjects:
+                row = db.execute('SELECT thread_id, orphan FROM subjects WHERE subject = ?', (normalized,)).fetchone()
+                if row is not None and (is_reply or row[1]):
+                    thread_ids.add(row[0])
+                    orphan = is_reply and bool(row[1])
+
+            if not thread_ids:
+                thread_id = self._new_thread(db, subject)
+                orphan = is_reply and not references
+            else:
+                thread_id = self._merge(db, thread_ids)
+
+            # Link each reference to the one before it, unless we already know its parent
+            new_ids = 0
+            parent = None
+            for ref in references:
+                if ref not in known:
+                    db.execute(
+                        'INSERT INTO messages (message_id, thread_id, parent_id, present) VALUES (?, ?, ?, 0)',
+                        (ref, thread_id, parent))
+                    new_ids += 1
+                parent = ref
+
+            if message_id is not None:
+                if message_id in known:
+                    db.execute('UPDATE messages SET parent_id = ?, present = 1 WHERE message_id = ?', (parent, message_id))
+                else:
+                    db.execute(
+                        'INSERT INTO messages (message_id, thread_id, parent_id, present) VALUES (?, ?, ?, 1)',
+                        (message_id, thread_id, parent))
+                    new_ids += 1
+
+            db.execute(
+                'UPDATE threads SET size = size + 1, ids = ids + ?, last_date = MAX(COALESCE(last_date, 0), ?) WHERE thread_id = ?',
+                (new_ids, date or 0, thread_id))
+
+            if normalized:
+                db.execute(
+                    'INSERT OR REPLACE INTO subjects (subject, thread_id, orphan) VALUES (?, ?, ?)',
+                    (normalized, thread_id, int(orphan)))
+
+            return thread_id
+
+    def thread_for(self, message_id):
+        """
+        :param str message_id: The id of a message that was added or referenced
+        :return int|None The thread id
+        """
+        mid = normalize_message_id(message_id)
+        if mid is None:
+            return None
+        row = self._connection().execute('SELECT thread_id FROM messages WHERE message_id = ?', (mid,)).fetchone()
+        return row[0] if row else None
+
+    def thread_info(self, thread_id):
+        """
+        :param int thread_id:
+        :return dict|None Subject, root id, number of messages and date of the latest message
+        """
+        db = self._connection()
+        row = db.execute('SELECT subject, size, last_date FROM threads WHERE thread_id = ?', (thread_id,)).fetchone()
+        if row is None:
+            return None
+        # The oldest id without a parent; threads merge, so this isn't fixed when the thread is created
+        root = db.execute(
+            'SELECT message_id FROM messages WHERE thread_id = ? AND parent_id IS NULL ORDER BY rowid LIMIT 1',
+            (thread_id,)).fetchone()
+        return {"thread_id": thread_id, "subject": row[0], "root_id": root[0] if root else None, "size": row[1], "last_date": row[2]}
+
+    def thread_messages(self, thread_id):
+        """
+        All ids in a thread with their parents, which is enough to draw the thread as a tree.
+        Ids that are referenced but haven't been added have present=False.
+
+        :param int thread_id:
+        :return list[dict]
+        """
+        rows = self._connection().execute(
+            'SELECT message_id, parent_id, present FROM messages WHERE thread_id = ? ORDER BY rowid', (thread_id,))
+        return [{"message_id": mid, "parent_id": parent, "present": bool(present)} for mid, parent, present in rows]
+
+    def stats(self):
+        db = self._connection()
+        return {
+            "threads": db.execute('SELECT COUNT(*) FROM threads').fetchone()[0],
+            "messages": db.execute('SELECT COUNT(*) FROM messages WHERE present = 1').fetchone()[0],
+            "ids": db.execute('SELECT COUNT(*) FROM messages').fetchone()[0],
+        }
+
+    def _lookup(self, db, ids):
+        known = {}
+        for i in xrange(0, len(ids), _MAX_VARIABLES):
+            chunk = ids[i:i + _MAX_VARIABLES]
+            rows = db.execute(
+                'SELECT message_id, thread_id, present FROM messages WHERE message_id IN (%s)' % ','.join('?' * len(chunk)),
+                chunk)
+            for mid, thread_id, present in rows:
+                known[mid] = (thread_id, present)
+        return known
+
+    def _new_thread(self, db, subject):
+        cursor = db.execute(
+            'INSERT INTO threads (subject, size, ids, last_date) VALUES (?, 0, 0, NULL)',
+            (_text(subject) if subject else None,))
+        return cursor.lastrowid
+
+    def _merge(self, db, thread_ids):
+        """
+        Merges threads into the one with the most ids, so every id only moves O(log n) times.
+
+        :return int The remaining thread
+        """
+        if len(thread_ids) == 1:
+            return next(iter(thread_ids))
+
+        rows = db.execute(
+            'SELECT thread_id, size, ids, last_date FROM threads WHERE thread_id IN (%s)' % ','.join('?' * len(thread_ids)),
+            list(thread_ids)).fetchall()
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        target = rows[0][0]
+
+        for thread_id, size, ids, last_date in rows[1:]:
+            db.execute('UPDATE messages SET thread_id = ? WHERE thread_id = ?', (target, thread_id))
+            db.execute('UPDATE subjects SET thread_id = ? WHERE thread_id = ?', (target, thread_id))
+            db.execute(
+                'UPDATE threads SET size = size + ?, ids = ids + ?, last_date = MAX(COALESCE(last_date, 0), ?) WHERE thread_id = ?',
+                (size, ids, last_date or 0, target))
+            db.execute('DELETE FROM threads WHERE thread_id = ?', (thread_id,))
+        return target
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple())
+    return float(value)
@@ -0,0 +1,203 @@
+"""
+    python -m unittest discover tests
+"""
+import hashlib
+import unittest
+from flanker import mime
+from email_decoder.parser import Parser
+from email_decoder.parser import _Base64Decoder
+from email_decoder.limits import Limits
+from email_decoder.metrics import Metrics
+from email_decoder.scanner import scan_parts
+
+HEADERS = 'From: a@example.com\r\nTo: b@example.com\r\nSubject: Test\r\nMIME-Version: 1.0\r\n'
+
+
+def attachment_message(encoded):
+    return (
+        HEADERS + 'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+        '--b\r\nContent-Type: text/plain\r\n\r\nSee attached\r\n'
+        '--b\r\nContent-Type: application/octet-stream; name="a.bin"\r\n'
+        'Content-Disposition: attachment; filename="a.bin"\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+        + encoded + '\r\n--b--\r\n'
+    )
+
+
+def text_message(subtype, encoded):
+    return (
+        HEADERS + 'Content-Type: text/%s; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n' % subtype + encoded + '\r\n'
+    )
+
+
+class Base64BodyTest(unittest.TestCase):
+    """
+    Bodies are decoded in chunks, but must come out as flanker decodes the whole body.
+    """
+
+    BROKEN = [
+        'QUJD!RA==',
+        'aGVsbG8gd29y.bGQ=',
+        # Padding in the middle: decoding stops there
+        'QUJD\r\nRA==\r\nRUZH\r\n',
+        'QUI=QUJD',
+        # Padding that can't end the data is skipped
+        'QQ=QUJD',
+        'Q=UJD',
+        # No padding at all, and a dangling character
+        'QUJDRA',
+        'QUJDR',
+    ]
+
+    def setUp(self):
+        self.parsers = [Parser(), Parser(engine='scanner')]
+
+    def test_attachments(self):
+        for encoded in self.BROKEN:
+            raw = attachment_message(encoded)
+            expected = mime.from_string(raw).parts[1].body
+            for parser in self.parsers:
+                files = parser.message_from_bytes(raw).files
+                self.assertEqual(len(files), 1, encoded)
+                self.assertEqual(files[0].size, len(expected), encoded)
+                self.assertEqual(files[0].digest, hashlib.sha256(expected).hexdigest(), encoded)
+
+    def test_text_bodies(self):
+        for encoded in self.BROKEN:
+            for subtype, field in (('plain', 'body_text'), ('html', 'body_html')):
+                raw = text_message(subtype, encoded)
+                expected = mime.from_string(raw).body.encode('utf-8') or None
+                for parser in self.parsers:
+                    self.assertEqual(getattr(parser.message_from_bytes(raw), field), expected, encoded)
+
+    def test_chunks(self):
+        encoded = 'QUJD\r\nR!A=\r\n=RUZH' * 3
+        expected = mime.from_string(attachment_message(encoded)).parts[1].body
+        for size in xrange(1, len(encoded) + 1):
+            decoder = _Base64Decoder()
+            chunks = []
+            for i in xrange(0, len(encoded), size):
+                chunks.append(decoder.decode(encoded[i:i + size]))
+                if decoder.done:
+                    break
+            chunks.append(decoder.flush())
+            self.assertEqual(''.join(chunks), expected, size)
+
+
+class NullLogger(object):
+    def _log(self, *args, **kwargs):
+        pass
+
+    debug = info = warning = error = _log
+
+
+class ManyPartsTest(unittest.TestCase):
+    """
+    flanker gives up on messages with more than about 2500 parts; they are truncated instead.
+    """
+
+    def message(self, count):
+        return (
+            HEADERS + 'Content-Type: multipart/mixed; boundary="b"\r\n\r\n' + ''.join(
+                '--b\r\nContent-Type: application/octet-stream\r\nContent-Disposition: attachment; filename="f%d"\r\n\r\n%d\r\n' % (i, i)
+                for i in xrange(count)) +
+            '--b--\r\n'
+        )
+
+    def test_truncated(self):
+        raw = self.message(3000)
+        for engine in ('flanker', 'scanner'):
+            for limits in (None, Limits()):
+                msg = Parser(logger=NullLogger(), engine=engine, limits=limits).message_from_bytes(raw)
+                self.assertEqual(msg.truncated['reason'], 'max_parts')
+                self.assertEqual(len(msg.files), msg.truncated['limit'])
+                self.assertEqual([f.filename for f in msg.files[:2]], ['f0', 'f1'])
+
+    def test_scanner_truncates(self):
+        # Rather than leaving the message to flanker, which would reject it
+        table = scan_parts(self.message(3000))
+        self.assertEqual(table.truncated.reason, 'max_parts')
+        self.assertEqual(len(table.parts), table.truncated.limit + 1)
+
+
+class BoundaryParamTest(unittest.TestCase):
+    """
+    flanker splits any part at the boundary its Content-Type declares, multipart or not.
+    """
+
+    CONTENT_TYPES = ['mule; boundary=a1', 'multipat/mixed; boundary=a1', 'text/plain; boundary=a1']
+
+    def message(self, content_type):
+        return (
+            HEADERS + 'Content-Type: %s\r\n\r\npre\r\n'
+            '--a1\r\nContent-Type: text/html\r\n\r\n<b>in</b>\r\n--a1--\r\n' % content_type
+        )
+
+    def test_engines_agree(self):
+        for content_type in self.CONTENT_TYPES:
+            raw = self.message(content_type)
+            self.assertIsNone(scan_parts(raw))
+            expected, actual = [
+                Parser(logger=NullLogger(), engine=engine).message_from_bytes(raw)
+                for engine in ('flanker', 'scanner')
+            ]
+            self.assertEqual(actual.body_text, expected.body_text)
+            self.assertEqual(actual.body_html, expected.body_html)
+            self.assertEqual([(f.size, f.digest) for f in actual.files], [(f.size, f.digest) for f in expected.files])
+
+
+
+class EnclosedMessageTest(unittest.TestCase):
+    """
+    The parts of a message/rfc822 part are read like the others; the part itself isn't stored.
+    """
+
+    RAW = (
+        HEADERS + 'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+        '--b\r\nContent-Type: text/plain\r\n\r\nOuter\r\n'
+        '--b\r\nContent-Type: message/rfc822\r\nContent-Disposition: attachment\r\n\r\n'
+        'From: c@example.com\r\nSubject: Inner\r\nContent-Type: multipart/mixed; boundary="c"\r\n\r\n'
+        '--c\r\nContent-Type: text/plain\r\n\r\nInner\r\n'
+        '--c\r\nContent-Type: application/pdf\r\nContent-Disposition: attachment; filename="x.pdf"\r\n\r\n'
+        'PDF\r\n--c--\r\n'
+        '\r\n--b--\r\n'
+    )
+
+    def test_parts(self):
+        for engine in ('flanker', 'scanner'):
+            msg = Parser(logger=NullLogger(), engine=engine).message_from_bytes(self.RAW)
+            self.assertEqual(msg.body_text, 'Outer\nInner')
+            self.assertEqual([f.filename for f in msg.files], ['x.pdf'])
+
+
+
+class RecordingMetrics(Metrics):
+    def __init__(self):
+        self.events = []
+
+    def start_message(self):
+        self.events.append('start')
+
+    def end_message(self, message_id=None):
+        self.events.append('end')
+
+    def timing(self, stage, seconds):
+        self.events.append(stage)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_stages_within_message(self):
+        raw = attachment_message('QUJD')
+        for engine in ('flanker', 'scanner'):
+            metrics = RecordingMetrics()
+            parser = Parser(logger=NullLogger(), engine=engine, metrics=metrics)
+            parser.message_from_bytes(raw)
+            parser.message_from_bytes(raw)
+            events = metrics.events[:len(metrics.events) // 2]
+            self.assertEqual(metrics.events, events * 2)
+            self.assertEqual((events[0], events[-1]), ('start', 'end'))
+            self.assertEqual(events.count('start'), 1)
+            self.assertEqual('scan' in events, engine == 'scanner')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import shutil
+import tempfile
+import unittest
+from email_decoder.parser import Parser
+from email_decoder.search import IndexWriter
+from email_decoder.search import Searcher
+from email_decoder.search import parse_query
+
+
+def message(message_id, subject, body):
+    return Parser().message_from_bytes(
+        'From: a@example.com\r\nTo: b@example.com\r\nMessage-ID: <%s>\r\nSubject: %s\r\n'
+        'Content-Type: text/plain\r\n\r\n%s\r\n' % (message_id, subject, body)
+    )
+
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = IndexWriter(self.directory, background_merge=False)
+        writer.add(message('1@example.com', 'Quarterly report', 'Figures for Q3'), key='1')
+        writer.add(message('2@example.com', 'Lunch', 'The usual place'), key='2')
+        writer.close()
+        self.searcher = Searcher(self.directory)
+
+    def tearDown(self):
+        self.searcher.close()
+        shutil.rmtree(self.directory)
+
+    def keys(self, query):
+        return [hit['key'] for hit in self.searcher.search(query)]
+
+    def test_parts_without_words(self):
+        # Parts with nothing to search for are left out, rather than matching nothing
+        self.assertEqual(self.keys('quarterly - report'), ['1'])
+        self.assertEqual(self.keys('report Q3 -'), ['1'])
+        self.assertEqual(self.keys('lunch OR "--"'), ['2'])
+
+    def test_empty(self):
+        for query in ('', '-', '- "..." OR ?'):
+            self.assertRaises(ValueError, parse_query, query)
+
+
+
+class MergeErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_raised_to_the_writer(self):
+        writer = IndexWriter(self.directory, buffer_postings=1, merge_factor=2)
+
+        def fail(segments):
+            raise IOError(28, 'No space left on device')
+        writer._merge = fail
+
+        added = []
+
+        def write():
+            try:
+                for i in xrange(4):
+                    writer.add(message('%d@example.com' % i, 'Report', 'Text'), key=str(i))
+                    added.append(i)
+            finally:
+                writer.close()
+        self.assertRaises(IOError, write)
+
+        # The documents added were written even though they weren't merged, and the index was released
+        writer = IndexWriter(self.directory, merge_factor=2)
+        writer.close()
+        searcher = Searcher(self.directory)
+        self.assertEqual(searcher.count('report'), len(added))
+        searcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
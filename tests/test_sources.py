@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from email_decoder.sources import iter_maildir
+from email_decoder.sources import iter_mbox
+
+
+class MaildirTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subdir in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.path, subdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deliver(self, name, subdir='new'):
+        with open(os.path.join(self.path, subdir, name), 'wb') as f:
+            f.write('Subject: %s\r\n\r\n' % name)
+
+    def read(self, offset=None):
+        return [(start, end, raw.split('\r\n')[0]) for start, end, raw in iter_maildir(self.path, offset)]
+
+    def test_read(self):
+        self.deliver('2.b', 'new')
+        self.deliver('1.a:2,S', 'cur')
+        self.assertEqual(self.read(), [('1.a', '1.a', 'Subject: 1.a:2,S'), ('2.b', '2.b', 'Subject: 2.b')])
+
+    def test_resume(self):
+        self.deliver('1.a')
+        self.deliver('2.b')
+        self.deliver('3.c')
+        end = self.read()[1][1]
+
+        # Messages moving to cur, getting flags or arriving don't shift where reading resumes
+        os.rename(os.path.join(self.path, 'new', '1.a'), os.path.join(self.path, 'cur', '1.a:2,S'))
+        os.rename(os.path.join(self.path, 'new', '2.b'), os.path.join(self.path, 'cur', '2.b:2,RS'))
+        self.deliver('4.d')
+        self.assertEqual([start for start, _, _ in self.read(end)], ['3.c', '4.d'])
+
+    def test_position_offset(self):
+        self.deliver('1.a')
+        self.assertRaises(ValueError, list, iter_maildir(self.path, 1))
+
+    def test_unreadable(self):
+        self.deliver('1.a')
+        os.symlink('/nonexistent', os.path.join(self.path, 'new', '2.b'))
+        self.deliver('3.c')
+        self.assertEqual([start for start, _, _ in self.read()], ['1.a', '3.c'])
+
+
+class MboxTest(unittest.TestCase):
+    MBOX = (
+        'From a@example.com Thu Jan  1 00:00:00 2015\n'
+        'Subject: One\n\n>From the start\n\n'
+        'From b@example.com Thu Jan  1 00:00:00 2015\n'
+        'Subject: Two\n\nSecond\n\n'
+        'From c@example.com Thu Jan  1 00:00:00 2015\n'
+        'Subject: Three\n\nThird\n'
+    )
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mbox')
+        with open(self.path, 'wb') as f:
+            f.write(self.MBOX)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_offsets(self):
+        messages = list(iter_mbox(self.path))
+        self.assertEqual([raw for _, _, raw in messages], [
+            'Subject: One\n\nFrom the start\n', 'Subject: Two\n\nSecond\n', 'Subject: Three\n\nThird\n'
+        ])
+        for (start, end, _), (next_start, _, _) in zip(messages, messages[1:]):
+            self.assertEqual(self.MBOX[start:start + 5], 'From ')
+            self.assertEqual(end, next_start)
+        self.assertEqual(messages[0][0], 0)
+        self.assertEqual(messages[-1][1], len(self.MBOX))
+
+    def test_resume(self):
+        messages = list(iter_mbox(self.path))
+        self.assertEqual(list(iter_mbox(self.path, messages[0][1])), messages[1:])
+        self.assertEqual(list(iter_mbox(self.path, messages[-1][1])), [])
+
+        # Messages appended since are read when resuming
+        with open(self.path, 'ab') as f:
+            f.write('\nFrom d@example.com Thu Jan  1 00:00:00 2015\nSubject: Four\n\nFourth\n')
+        resumed = list(iter_mbox(self.path, messages[-1][1]))
+        self.assertEqual([raw for _, _, raw in resumed], ['Subject: Four\n\nFourth\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from email_decoder.threader import ThreadIndex
+
+
+class ThreadIdTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'threads.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merged_ids_are_not_reused(self):
+        index = ThreadIndex(self.path, merge_subjects=False)
+        a = index.add_ids(u'a', [], 'First')
+        x = index.add_ids(u'x', [], 'Second')
+        # Links both threads, so x's is merged into a's
+        self.assertEqual(index.add_ids(u'y', [u'a', u'x'], 'Re: First'), a)
+        z = index.add_ids(u'z', [], 'Unrelated')
+        self.assertNotIn(z, (a, x))
+
+    def test_upgrade(self):
+        db = sqlite3.connect(self.path)
+        db.executescript(
+            'CREATE TABLE threads (thread_id INTEGER PRIMARY KEY, subject TEXT,'
+            '  size INTEGER NOT NULL, ids INTEGER NOT NULL, last_date REAL);'
+            "INSERT INTO threads VALUES (1, 'First', 1, 1, NULL);"
+            "INSERT INTO threads VALUES (3, 'Second', 1, 1, NULL);")
+        db.close()
+
+        index = ThreadIndex(self.path, merge_subjects=False)
+        self.assertEqual(index.thread_info(3)['subject'], 'Second')
+        self.assertEqual(index.add_ids(u'z', [], 'Third'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()